@@ -0,0 +1,63 @@
+import sys
+import tempfile
+import time
+from pathlib import Path
+root = Path(__file__).resolve().parents[1]
+sys.path.append(str(root))
+
+import numpy as np
+
+from hrrrstore import ColumnStore, ingest_grib, ingest_netcdf
+from sounding import SoundingData
+from synthwrf import write_hrrr, write_hrrr_grib
+
+# ingest_grib against ingest_netcdf on the same synthetic HRRR analysis,
+# written as a GRIB2 (eccodes) and as an ncl_convert2nc style netCDF: the
+# stores and the soundings from them have to agree to the GRIB packing.
+
+
+def _same_store(a, b):
+    with ColumnStore(a) as sa, ColumnStore(b) as sb:
+        assert sa.meta["shape"] == sb.meta["shape"] and sa.meta["window"] == sb.meta["window"], (sa.meta, sb.meta)
+        assert np.allclose(sa.levels, sb.levels), (sa.levels, sb.levels)
+        assert sa.meta["fields"] == sb.meta["fields"]
+        for name in sa.meta["fields"]:
+            x, y = sa.read(name), sb.read(name)
+            assert np.allclose(x, y, rtol=1e-4, atol=1e-5*np.nanmax(np.abs(x))), name
+        return sa.meta["shape"], len(sa.levels)
+
+
+def main(ny=120, nx=180, bbox=(35., 42., -124., -114.), levels=(500., 700., 850., 1000., 1013.2)):
+    try:
+        import eccodes, cfgrib, xarray
+    except ImportError as e:
+        print("skipped: {}".format(e))
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        lat, lon = write_hrrr_grib(tmp/"hrrr.grib2", ny, nx)
+        write_hrrr(tmp/"hrrr.nc", lat=lat, lon=lon)
+        for cut in ({}, {"bbox": bbox}, {"bbox": bbox, "levels": levels}):
+            times = {}
+            for ingest, src in ((ingest_grib, "hrrr.grib2"), (ingest_netcdf, "hrrr.nc")):
+                t0 = time.perf_counter()
+                ingest(tmp/src, tmp/(src + ".columns"), **cut)
+                times[src] = time.perf_counter() - t0
+            shape, nlev = _same_store(tmp/"hrrr.grib2.columns", tmp/"hrrr.nc.columns")
+            print("{}: {} columns x {} levels, grib {:.2f} s, netCDF {:.2f} s".format(
+                cut or "whole grid", shape, nlev, times["hrrr.grib2"], times["hrrr.nc"]))
+
+        lats, lons = np.array([36., 38.5, 41.]), np.array([-122., -119., -115.])
+        from_grib = SoundingData.from_points("hrrr", str(tmp/"hrrr.grib2.columns"), lats, lons)
+        from_nc = SoundingData.from_points("hrrr", str(tmp/"hrrr.nc"), lats, lons)
+        for a, b in zip(from_grib, from_nc):
+            # The last grib store only has some of the levels
+            pb = b.profile[np.isin(b.profile["P"], a.profile["P"])]
+            for name in ("P", "Z", "T", "Td", "U", "V", "Theta", "w"):
+                assert np.allclose(a.profile[name], pb[name], rtol=1e-4, atol=1e-3), name
+            assert np.allclose((a.sfc_P, a.sfc_Theta, a.sfc_w), (b.sfc_P, b.sfc_Theta, b.sfc_w), rtol=1e-4)
+        print("{} soundings from the grib store match the netCDF".format(len(from_grib)))
+
+
+if __name__ == "__main__":
+    main()
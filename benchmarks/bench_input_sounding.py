@@ -0,0 +1,49 @@
+import sys
+import tempfile
+import time
+from pathlib import Path
+root = Path(__file__).resolve().parents[1]
+sys.path.append(str(root))
+
+import pandas as pd
+
+from input_sounding import format_input_sounding, read_input_sounding, write_ensemble
+
+
+# What SoundingData.gen_wrf_sounding used to do, kept as the reference
+def format_iterrows(sfc, profile):
+    sounding_str = ""
+    sounding_str += " " + str(sfc[0]) + " " + str(sfc[1]) + " " + str(sfc[2]) + "\n"
+    for _, row in profile.iterrows():
+        sounding_str += "  " + str(row["Z"]) + " " + str(row["Theta"]) + " " + str(row["w"]) + " " + str(row["U"]) + " " + str(row["V"]) + "\n"
+    return sounding_str
+
+
+def main(base=root/"creek"/"soundings"/"input_sounding", repeat=200, members=1000):
+    sfc, profile = read_input_sounding(base)
+    df = pd.DataFrame(profile, columns=["Z", "Theta", "w", "U", "V"])
+    assert format_iterrows(sfc, df) == format_input_sounding(sfc, profile)
+
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        format_iterrows(sfc, df)
+    old = (time.perf_counter() - t0)/repeat
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        format_input_sounding(sfc, profile)
+    new = (time.perf_counter() - t0)/repeat
+    print("format one {}-level sounding: iterrows {:.2f} ms, vectorized {:.3f} ms ({:.0f}x)".format(
+        len(profile), old*1e3, new*1e3, old/new))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for processes in (1, None):
+            t0 = time.perf_counter()
+            write_ensemble(base, Path(tmp)/str(processes), members, seed=1, processes=processes,
+                           rotate_sd=10., speed_sd=0.1, theta_sd=0.5, theta_level_sd=0.2, moisture_sd=0.1)
+            t = time.perf_counter() - t0
+            print("write_ensemble, {} members, processes={}: {:.2f} s ({:.0f} members/s)".format(
+                members, processes, t, members/t))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+root = Path(__file__).resolve().parents[1]
+sys.path.append(str(root))
+
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+
+from render_soundings import SkewTRenderer, render_soundings
+from sounding import SoundingEnsemble, HRRR_LEVELS
+
+
+def synthetic_columns(n=16, seed=0):
+    # Plausible warm-season profiles on the HRRR pressure levels, (level, member) like hrrr_columns
+    rng = np.random.default_rng(seed)
+    p = np.array(HRRR_LEVELS[::-1], dtype=np.float64)[:, None]      # top first, as in the file
+    sfc_T = 300. + rng.normal(0, 3, n)
+    lapse = 0.0065 + rng.normal(0, 0.0005, n)
+    Z = 44330.*(1 - (p/1013.25)**0.1903) + rng.normal(0, 5, (p.size, n))
+    T = np.maximum(sfc_T - lapse*Z, 210.)
+    Td = T - np.clip(5 + rng.normal(0, 2, n) + Z/800., 1, 40)
+    e = 6.112*np.exp(17.67*(Td-273.15)/(Td-29.65))
+    q = 0.622*e/(p - 0.378*e)
+    U = 5 + Z/600. + rng.normal(0, 2, (p.size, n))
+    V = 3*np.sin(Z/3000. + rng.uniform(0, 6, n)) + rng.normal(0, 1, (p.size, n))
+    ter = rng.uniform(0, 500, n)
+    f = lambda a: a.astype(np.float32)
+    return {"ter": f(ter), "sfc_P": f(np.full(n, 101000.) - ter*11.5), "sfc_Theta": f(sfc_T + 1),
+            "sfc_q": f(q[-1]), "lat": f(rng.uniform(35, 40, n)), "lon": f(rng.uniform(-120, -115, n)),
+            "Z": f(Z), "T": f(T), "q": f(q), "Td": f(Td), "U": f(U), "V": f(V)}
+
+
+def main(n=24, processes=os.cpu_count()):
+    date = datetime(2020, 9, 5, 21)
+    ens = SoundingEnsemble(synthetic_columns(n), date)
+    sample = min(n, 6)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        t0 = time.perf_counter()
+        for i in range(sample):
+            ens.member(i).plot(date, str(tmp/"plot{}.png".format(i)), "member {}".format(i))
+        old = sample/(time.perf_counter() - t0)
+
+        renderer = SkewTRenderer()
+        profs = [ens.member(i).sharppy_profile(date) for i in range(sample)]
+        t0 = time.perf_counter()
+        for i, prof in enumerate(profs):
+            renderer.render(prof, tmp/"reuse{}.png".format(i), "member {}".format(i))
+        reuse = sample/(time.perf_counter() - t0)
+
+        files = [tmp/"batch{}.png".format(i) for i in range(n)]
+        t0 = time.perf_counter()
+        render_soundings([ens._profile_args(i) for i in range(n)], files, processes=1)
+        serial = n/(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        render_soundings([ens._profile_args(i) for i in range(n)], files, processes=processes)
+        parallel = n/(time.perf_counter() - t0)
+
+    print("SoundingData.plot (profile + indices + new figure): {:.2f} soundings/s".format(old))
+    print("SkewTRenderer.render, indices + redraw (profile built beforehand): {:.2f} soundings/s".format(reuse))
+    print("render_soundings, 1 process: {:.2f} soundings/s".format(serial))
+    print("render_soundings, {} processes: {:.2f} soundings/s".format(processes, parallel))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+root = Path(__file__).resolve().parents[1]
+sys.path.append(str(root))
+
+import stages
+from stages import stage
+
+
+def _per_call(fn, n):
+    t0 = time.perf_counter()
+    fn(n)
+    return (time.perf_counter() - t0)/n
+
+
+def bare(n):
+    for _ in range(n):
+        pass
+
+
+def staged(n):
+    for i in range(n):
+        with stage("x"):
+            pass
+
+
+def staged_args(n):
+    for i in range(n):
+        with stage("x", frame=i):
+            pass
+
+
+def main(n=1000000):
+    stages.disable()
+    loop = _per_call(bare, n)
+    off = _per_call(staged, n) - loop
+    off_args = _per_call(staged_args, n) - loop
+    print("stage() switched off: {:.0f} ns per stage, {:.0f} ns with an argument".format(off*1e9, off_args*1e9))
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ("stages.jsonl", "stages.json"):
+            stages.enable(os.path.join(tmp, name), print_summary=False)
+            on = _per_call(staged, n//10) - loop
+            stages.disable()
+            print("stage() writing {}: {:.1f} us per stage".format(name, on*1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import sys
+import time
+from pathlib import Path
+root = Path(__file__).resolve().parents[1]
+sys.path.append(str(root))
+
+import numpy as np
+from wrf import interplevel, to_np
+
+from vinterp import interp_levels, SMOKE_LEVELS
+
+
+def synthetic_column(nz=51, ny=206, nx=206, seed=0):
+    rng = np.random.default_rng(seed)
+    eta = np.linspace(0, 1, nz)
+    base = 20 + 5000*eta**1.5
+    hgt = base[:, None, None] + rng.uniform(-10, 10, (nz, ny, nx))*eta[:, None, None]
+    field = rng.standard_normal((nz, ny, nx)).astype(np.float32)
+    return hgt.astype(np.float32), field
+
+
+def dstack_loop(field, hgt, levels):
+    out = interplevel(field, hgt, levels[0])
+    for h in levels[1:]:
+        out = np.dstack((out, interplevel(field, hgt, h)))
+    return out.transpose(2, 0, 1)
+
+
+def _as_nan(a):
+    return np.ma.filled(np.ma.masked_invalid(np.ma.asarray(to_np(a), dtype=np.float64)), np.nan)
+
+
+def main(repeat=3):
+    hgt, field = synthetic_column()
+    levels = SMOKE_LEVELS
+
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        ref = dstack_loop(field, hgt, levels)
+    t_loop = (time.perf_counter() - t0)/repeat
+
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        res = interp_levels(field, hgt, levels)
+    t_vec = (time.perf_counter() - t0)/repeat
+
+    np.testing.assert_array_equal(_as_nan(res), _as_nan(ref))
+    print("levels: {}, grid: {}".format(len(levels), hgt.shape))
+    print("interplevel + dstack: {:.3f} s".format(t_loop))
+    print("vinterp:              {:.3f} s ({:.1f}x)".format(t_vec, t_loop/t_vec))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import sys
+import time
+from pathlib import Path
+root = Path(__file__).resolve().parents[1]
+sys.path.append(str(root))
+
+import numpy as np
+
+from vort import kvort3d, jvort3d
+
+
+# The np.vectorize kernels vort.py used before the stencil versions, kept
+# here as the reference for both speed and results
+def _discrete_curl(a0, a1, b0, b1, da, db):
+    return ((b1-b0)/da)-((a1-a0)/db)
+
+def _mean_interp(x0, x1, y0, y1):
+    return np.mean([x0, x1, y0, y1])
+
+def kvort_vectorize(U_wrf, V_wrf, level):
+    u = U_wrf.transpose(2, 1, 0)[:,:,level]
+    v = V_wrf.transpose(2, 1, 0)[:,:,level]
+    _,usize = u.shape
+    vsize,_ = v.shape
+    u0 = u[1:usize,0:usize-1]
+    u1 = u[1:usize,1:usize]
+    v0 = v[0:vsize-1,1:vsize]
+    v1 = v[1:vsize,1:vsize]
+    curl = np.vectorize(_discrete_curl, excluded=['da', 'db'])
+    interp = np.vectorize(_mean_interp)
+    rawvort = curl(u0, u1, v0, v1, 50, 50)
+    num_x, num_y = rawvort.shape
+    a = np.zeros((usize,vsize))
+    a[1:usize-1, 1:vsize-1] = interp(rawvort[0:num_x-1,0:num_y-1], rawvort[0:num_x-1,1:num_y],
+                                     rawvort[1:num_x,0:num_y-1], rawvort[1:num_x,1:num_y])
+    return a
+
+def jvort_vectorize(U_wrf, W_wrf, level):
+    u = U_wrf.transpose(2, 1, 0)[:,level,:]
+    w = W_wrf.transpose(2, 1, 0)[:,level,:]
+    usize,_ = u.shape
+    usize-=1
+    _,wsize = w.shape
+    wsize-=1
+    curl = np.vectorize(_discrete_curl, excluded=['da', 'db'])
+    interp = np.vectorize(_mean_interp)
+    rawvort = curl(w[0:usize,0:wsize], w[1:usize+1,0:wsize], u[0:usize,0:wsize], u[0:usize,1:wsize+1], 50, 50)
+    num_x, num_y = rawvort.shape
+    a = np.zeros((usize+1,wsize+1))
+    a[1:usize, 1:wsize] = interp(rawvort[0:num_x-1,0:num_y-1], rawvort[0:num_x-1,1:num_y],
+                                 rawvort[1:num_x,0:num_y-1], rawvort[1:num_x,1:num_y])
+    return a
+
+
+def _timed(fn, *args):
+    t0 = time.perf_counter()
+    out = fn(*args)
+    return out, time.perf_counter() - t0
+
+
+def main(nz=51, ny=206, nx=206, sample=5):
+    rng = np.random.default_rng(0)
+    U = rng.standard_normal((nz, ny, nx+1)).astype(np.float32)
+    V = rng.standard_normal((nz, ny+1, nx)).astype(np.float32)
+    W = rng.standard_normal((nz, ny, nx)).astype(np.float32)
+    Uc = U[:, :, 1:]
+
+    # The old kernels only do one level/slice per call, so time a few and scale up
+    levels = np.linspace(0, nz-1, sample).astype(int)
+    old_k = 0.
+    for k in levels:
+        ref, t = _timed(kvort_vectorize, U, V, k)
+        old_k += t
+    old_k *= nz/sample
+    new, new_k = _timed(kvort3d, U, V, 50., 50.)
+    np.testing.assert_allclose(new[levels[-1]].T, ref, rtol=1e-5, atol=1e-6)
+
+    slices = np.linspace(0, ny-1, sample).astype(int)
+    old_j = 0.
+    for j in slices:
+        ref, t = _timed(jvort_vectorize, Uc, W, j)
+        old_j += t
+    old_j *= ny/sample
+    new, new_j = _timed(jvort3d, Uc, W, 50., 50.)
+    np.testing.assert_allclose(new[slices[-1]], ref, rtol=1e-5, atol=1e-6)
+
+    print("grid: {}x{}x{}".format(nx, ny, nz))
+    print("kvort, all {} levels: vectorize ~{:.2f} s, stencil {:.3f} s ({:.0f}x)".format(nz, old_k, new_k, old_k/new_k))
+    print("jvort, all {} slices: vectorize ~{:.2f} s, stencil {:.3f} s ({:.0f}x)".format(ny, old_j, new_j, old_j/new_j))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+from pathlib import Path
+root = Path(__file__).resolve().parents[1]
+sys.path.append(str(root))
+
+import numpy as np
+
+import stages
+from synthwrf import grid_from_namelist, write_case, write_hrrr
+
+# The post-processing hot paths on synthetic wrfout files of a few grid sizes.
+# Every benchmark runs in a fresh process, so its peak RSS is its own.
+
+BENCHMARKS = {}
+HRRR_BENCHMARKS = set()
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def hrrr_benchmark(fn):
+    # Run once on the synthetic HRRR file rather than for every wrfout grid
+    HRRR_BENCHMARKS.add(fn.__name__)
+    return benchmark(fn)
+
+
+def _points(data):
+    g = data["grid"]
+    return g["nx"]*g["ny"]*g["nz"], "points"
+
+
+@benchmark
+def smoke_and_area(data):
+    from smoke import smoke_and_area
+    smoke_and_area(data["files"][-1])
+    return _points(data)
+
+
+@benchmark
+def kvort(data):
+    from vort import kvort3d
+    from wrfout import WrfoutFile
+    with WrfoutFile(data["files"][-1]) as wf:
+        kvort3d(wf.read("U"), wf.read("V"), wf.dx, wf.dy)
+    return _points(data)
+
+
+@benchmark
+def jvort(data):
+    from vort import interp_uw, jvort3d, JVORT_LEVELS
+    from wrfout import WrfoutFile
+    with WrfoutFile(data["files"][-1]) as wf:
+        U, W = interp_uw(wf)
+        jvort3d(U, W, wf.dx, JVORT_LEVELS[1] - JVORT_LEVELS[0])
+    return _points(data)
+
+
+@benchmark
+def plotjvort(data, slices=8):
+    from vort import plotjvort_sweep
+    file = Path(data["files"][-1])
+    levels = np.linspace(0, data["grid"]["ny"]-1, slices).astype(int)
+    plotjvort_sweep(file.name, file.parent, Path(data["tmp"]), levels)
+    return slices, "frames"
+
+
+@benchmark
+def plotkvortw(data, levels=8):
+    from vort import plotkvortw_sweep
+    file = Path(data["files"][-1])
+    g = data["grid"]
+    plotkvortw_sweep(file.name, (0, g["nx"], 0, g["ny"]), file.parent, Path(data["tmp"]), list(range(levels)))
+    return levels, "frames"
+
+
+@benchmark
+def diagnostics(data, tile=64):
+    # One process, so the peak RSS is one worker's worth of tiles
+    from diagnostics import compute_diagnostics
+    compute_diagnostics(Path(data["files"][0]).parent, Path(data["tmp"])/"diagnostics.nc", tile, processes=1)
+    count, unit = _points(data)
+    return count*len(data["files"]), unit
+
+
+@benchmark
+def fire_front(data):
+    from firefront import fire_front
+    fire_front(Path(data["files"][0]).parent, Path(data["tmp"])/"fire_front.csv", processes=1)
+    return len(data["files"]), "frames"
+
+
+@benchmark
+def scrub(data, levels=8):
+    # Steps through the frames, then the levels, of each ScrubViewer view
+    # from a cold cache, each drawn to a png
+    from scrub import ScrubViewer, VIEWS
+    frames = len(data["files"])
+    with ScrubViewer(Path(data["files"][0]).parent) as viewer:
+        for view in VIEWS:
+            for t in range(frames):
+                viewer.render(view, t, 0)
+            for k in range(1, levels):
+                viewer.render(view, frames-1, k)
+    return len(VIEWS)*(frames + levels - 1), "steps"
+
+
+@hrrr_benchmark
+def sounding(data, points=100):
+    from sounding import GridIndex, SoundingData
+    from wrfout import NcFile
+    # The KD-tree is built once per file; time the lookups, not the build
+    with NcFile(data["hrrr"]) as nc:
+        GridIndex.for_file(nc, cache=False)
+    rng = np.random.default_rng(0)
+    lats, lons = rng.uniform(30., 45., points), rng.uniform(-115., -85., points)
+    for lat, lon in zip(lats, lons):
+        SoundingData("hrrr", data["hrrr"], lat, lon)
+    return points, "soundings"
+
+
+@hrrr_benchmark
+def sounding_batch(data, points=1000):
+    from sounding import GridIndex, SoundingData
+    from wrfout import NcFile
+    with NcFile(data["hrrr"]) as nc:
+        GridIndex.for_file(nc, cache=False)
+    rng = np.random.default_rng(0)
+    SoundingData.from_points("hrrr", data["hrrr"], rng.uniform(30., 45., points), rng.uniform(-115., -85., points))
+    return points, "soundings"
+
+
+@hrrr_benchmark
+def sounding_store(data, points=100):
+    # sounding, from a hrrrstore column store of the same file (converted
+    # on the warm-up call)
+    from hrrrstore import ColumnStore, ingest_netcdf, store_path
+    from sounding import GridIndex, SoundingData
+    store = store_path(data["hrrr"])
+    if not ColumnStore.is_store(store):
+        ingest_netcdf(data["hrrr"], store, bbox=(30., 45., -115., -85.))
+    with ColumnStore(store) as nc:
+        GridIndex.for_file(nc, cache=False)
+    rng = np.random.default_rng(0)
+    lats, lons = rng.uniform(30., 45., points), rng.uniform(-115., -85., points)
+    for lat, lon in zip(lats, lons):
+        SoundingData("hrrr", str(store), lat, lon)
+    return points, "soundings"
+
+
+@benchmark
+def plot3d(data):
+    import mayavi.mlab as mlab
+    import mayaviplot
+    from smoke import smoke_and_area, aniFunc
+    mlab.options.offscreen = True
+    x3, y3, z3, smoke, x2, y2, elevation, burn_area = smoke_and_area(data["files"][-1])
+    figure = mayaviplot.plot3d(x3, y3, z3, smoke, x2, y2, elevation, burn_area, aniFunc["creek"], 0, 1,
+                               out_filename=str(Path(data["tmp"])/"plot3d.png"))
+    mlab.close(figure)
+    return 1, "frames"
+
+
+def _maxrss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+
+def _run(name, data, repeat):
+    # In the child: a warm-up call (imports, caches), the timed calls, then
+    # one more under tracemalloc for the peak of numpy/Python allocations
+    fn = BENCHMARKS[name]
+    try:
+        fn(data)
+        rss0 = _maxrss_mb()
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            count, unit = fn(data)
+            times.append(time.perf_counter() - t0)
+        rss1 = _maxrss_mb()
+        tracemalloc.start()
+        fn(data)
+        traced = tracemalloc.get_traced_memory()[1]/2**20
+        tracemalloc.stop()
+    except ImportError as e:
+        return {"skipped": str(e)}
+    except Exception as e:
+        return {"error": "{}: {}".format(type(e).__name__, e)}
+    best = min(times)
+    return {
+        "times": times,
+        "best": best,
+        "median": float(np.median(times)),
+        "throughput": count/best,
+        "unit": unit + "/s",
+        "peak_rss_mb": rss1,
+        "rss_growth_mb": rss1 - rss0,
+        "peak_traced_mb": traced,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True,
+                              text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(old, new):
+    # Ratio of best times, per benchmark and grid, between two results files
+    with open(old) as f:
+        old = {(r["benchmark"], r["grid"]): r for r in json.load(f)["results"]}
+    with open(new) as f:
+        new = {(r["benchmark"], r["grid"]): r for r in json.load(f)["results"]}
+    for key in sorted(set(old) & set(new)):
+        if "best" in old[key] and "best" in new[key]:
+            print("{:16s} {:12s} {:8.3f} s -> {:8.3f} s  ({:.2f}x)".format(
+                *key, old[key]["best"], new[key]["best"], old[key]["best"]/new[key]["best"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the post-processing hot paths on synthetic wrfout files.")
+    parser.add_argument("--namelist", default=str(root/"creek"/"namelist.input"),
+                        help="base grid (e_we/e_sn/e_vert, dx/dy, sr_x/sr_y)")
+    parser.add_argument("--scales", type=float, nargs="+", default=[0.5, 1.],
+                        help="horizontal size factors on the namelist grid")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--hrrr-size", type=int, nargs=2, default=[530, 900], metavar=("NY", "NX"))
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="only compare two results files")
+    parser.add_argument("--stages", metavar="PATH", help="also record the stages.py breakdown of every call to PATH")
+    args = parser.parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.stages:
+        # The benchmark processes inherit this and append to the same file
+        stages.enable(args.stages)
+
+    base = grid_from_namelist(args.namelist)
+    names = args.only or list(BENCHMARKS)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        hrrr = write_hrrr(tmp/"hrrr.nc", *args.hrrr_size)
+        runs = [("hrrr{}x{}".format(*args.hrrr_size), {"hrrr": str(hrrr)}, [n for n in names if n in HRRR_BENCHMARKS])]
+        for scale in args.scales:
+            grid = {"nx": int(round(base["nx"]*scale)), "ny": int(round(base["ny"]*scale)), "nz": base["nz"],
+                    "dx": base["dx"], "dy": base["dy"], "sr_x": base["sr_x"], "sr_y": base["sr_y"]}
+            label = "{nx}x{ny}x{nz}".format(**grid)
+            files = write_case(tmp/label/"nc", frames=2, **grid)
+            out = tmp/label/"plots"
+            out.mkdir()
+            runs.append((label, {"files": [str(f) for f in files], "grid": grid, "tmp": str(out)},
+                         [n for n in names if n not in HRRR_BENCHMARKS]))
+
+        for label, data, run_names in runs:
+            if run_names:
+                print(label)
+            for name in run_names:
+                # A fresh spawned process per benchmark, for a clean peak RSS
+                with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+                    result = pool.submit(_run, name, data, args.repeat).result()
+                result.update(benchmark=name, grid=label)
+                results.append(result)
+                if "best" in result:
+                    print("  {:16s} {:8.3f} s  {:12.4g} {:12s} peak RSS {:7.1f} MB, traced {:7.1f} MB".format(
+                        name, result["best"], result["throughput"], result["unit"], result["peak_rss_mb"],
+                        result["peak_traced_mb"]))
+                else:
+                    print("  {:16s} {}".format(name, result.get("skipped") or result.get("error")))
+
+    with open(args.out, "w") as f:
+        json.dump({
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "cpus": os.cpu_count(),
+            "repeat": args.repeat,
+            "results": results,
+        }, f, indent=1)
+    print("results in {}".format(args.out))
+
+
+if __name__ == "__main__":
+    main()
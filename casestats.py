@@ -0,0 +1,126 @@
+import json
+from pathlib import Path
+
+import numpy as np
+from smoke import smoke_cube
+from vinterp import WeightsCache, JVORT_LEVELS
+from vort import kvort3d, jvort3d, interp_uw
+from wrfout import list_wrfout, WrfoutFile
+
+DEFAULT_FIELDS = ("fire_smoke", "FIRE_AREA", "kvort", "jvort")
+DEFAULT_PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+
+
+def _fire_smoke(wf, weights_cache):
+    # The interpolated cube, since that is what plot3d colours
+    return smoke_cube(wf, weights_cache)
+
+def _fire_area(wf, weights_cache):
+    return wf.read("FIRE_AREA")
+
+def _kvort(wf, weights_cache):
+    return kvort3d(wf.read("U"), wf.read("V"), wf.dx, wf.dy)
+
+def _jvort(wf, weights_cache):
+    Uinterp, Winterp = interp_uw(wf, weights_cache)
+    return jvort3d(Uinterp, Winterp, wf.dx, JVORT_LEVELS[1] - JVORT_LEVELS[0])
+
+FIELDS = {
+    "fire_smoke": _fire_smoke,
+    "FIRE_AREA": _fire_area,
+    "kvort": _kvort,
+    "jvort": _jvort,
+}
+
+
+def sidecar_path(ncdir):
+    return Path(ncdir)/"case_stats.json"
+
+
+def _mtimes(files):
+    return {f.name: f.stat().st_mtime for f in files}
+
+
+def _frames(files, fields):
+    # One wrfout file (and one set of derived fields) in memory at a time
+    for f in files:
+        weights_cache = WeightsCache()
+        with WrfoutFile(f) as wf:
+            for name in fields:
+                data = np.ma.filled(np.ma.asarray(FIELDS[name](wf, weights_cache), dtype=np.float64), np.nan)
+                yield name, data[np.isfinite(data)]
+
+
+def _percentiles(hist, edges, percentiles):
+    cdf = np.concatenate(([0], np.cumsum(hist)))/max(hist.sum(), 1)
+    return {str(float(p)): float(np.interp(p/100, cdf, edges)) for p in percentiles}
+
+
+def compute_stats(files, fields=DEFAULT_FIELDS, percentiles=DEFAULT_PERCENTILES, bins=4096):
+    files = [Path(f) for f in files]
+    stats = {name: {"min": np.inf, "max": -np.inf, "count": 0} for name in fields}
+    for name, data in _frames(files, fields):
+        if data.size:
+            stats[name]["min"] = min(stats[name]["min"], float(data.min()))
+            stats[name]["max"] = max(stats[name]["max"], float(data.max()))
+            stats[name]["count"] += int(data.size)
+
+    if percentiles:
+        # Percentiles over the whole run from a fixed-range histogram, so the
+        # second pass also only needs one frame at a time
+        hists = {name: np.zeros(bins, dtype=np.int64) for name in fields}
+        edges = {name: np.linspace(stats[name]["min"], stats[name]["max"], bins+1)
+                 for name in fields if stats[name]["count"]}
+        for name, data in _frames(files, fields):
+            if name in edges:
+                hists[name] += np.histogram(data, bins=edges[name])[0]
+        for name in fields:
+            if name in edges:
+                stats[name]["percentiles"] = _percentiles(hists[name], edges[name], percentiles)
+    for s in stats.values():
+        if not s["count"]:
+            # Absent or empty: null in the json rather than +-Infinity, and
+            # no range for the plots to fix their colours to
+            s["min"] = s["max"] = None
+
+    return {
+        "files": _mtimes(files),
+        "bins": bins,
+        "percentiles": [float(p) for p in percentiles],
+        "fields": stats,
+    }
+
+
+def load_stats(sidecar, files=None, fields=(), percentiles=()):
+    sidecar = Path(sidecar)
+    if not sidecar.exists():
+        return None
+    with open(sidecar) as f:
+        stats = json.load(f)
+    if files is not None and stats["files"] != _mtimes(files):
+        return None
+    if not set(fields) <= set(stats["fields"]) or not {float(p) for p in percentiles} <= set(stats["percentiles"]):
+        return None
+    return stats
+
+
+def case_stats(ncdir, fields=DEFAULT_FIELDS, percentiles=DEFAULT_PERCENTILES, sidecar=None, recompute=False):
+    files = list_wrfout(ncdir)
+    sidecar = sidecar_path(ncdir) if sidecar is None else Path(sidecar)
+    stats = None if recompute else load_stats(sidecar, files, fields, percentiles)
+    if stats is None:
+        stats = compute_stats(files, fields, percentiles)
+        with open(sidecar, "w") as f:
+            json.dump(stats, f, indent=1)
+    return stats
+
+
+def field_range(stats, field, lo=None, hi=None):
+    # (min, max) of a field over the run, or a percentile range, e.g. lo=1,
+    # hi=99; None if the field had no values
+    s = stats["fields"][field]
+    if not s["count"]:
+        return None
+    vmin = s["min"] if lo is None else s["percentiles"][str(float(lo))]
+    vmax = s["max"] if hi is None else s["percentiles"][str(float(hi))]
+    return vmin, vmax
@@ -7,6 +7,7 @@ conda install cartopy=0.21.1
 conda install jupyter=1.0.0
 conda install -c conda-forge wrf-python=1.3.4.1
 conda install -c conda-forge sharppy
+conda install -c conda-forge cfgrib
 
 pip install pint==0.20.1
 pip install metpy==1.3.0
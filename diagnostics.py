@@ -0,0 +1,221 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+
+import numpy as np
+from netCDF4 import Dataset
+
+from stages import stage
+from vinterp import Weights, SMOKE_LEVELS
+from wrfout import WrfoutCase, WrfoutFile, format_wrf_time
+
+# Full-run diagnostics, one product file per case:
+#   vort_i, vort_j, vort_k  the three vorticity components on the mass grid
+#   height_agl              mass level heights, for plotting the above
+#   smoke_column            fire_smoke integrated over the column (g kg-1 m)
+#   w_max                   max updraft over the domain on each height level
+# Each frame is done in horizontal tiles read with a one-cell halo, so memory
+# per worker stays at a few tiles whatever the domain size, and tiles of all
+# frames are spread over a process pool. The product keeps wrfout's Time,
+# Times and dimension names, so WrfoutFile(product, timeidx) reads it.
+#
+# The derivatives are centred differences on the model levels (one-sided at
+# the domain edges and the top/bottom, like np.gradient), with the vertical
+# ones taken against the actual level heights. Horizontal derivatives are
+# along the model levels, with no correction for the terrain slope.
+
+G = 9.81
+W_LEVELS = SMOKE_LEVELS
+
+
+def tiles(ny, nx, tile):
+    # (j0, j1, i0, i1) of every tile, row by row
+    return [(j0, min(j0+tile, ny), i0, min(i0+tile, nx)) for j0 in range(0, ny, tile) for i0 in range(0, nx, tile)]
+
+
+def _pad_edges(a, lo_y, hi_y, lo_x, hi_x):
+    # One cell of linear extrapolation on the sides where the domain ends
+    # instead of a halo, which turns the centred differences there into
+    # one-sided ones
+    if lo_y:
+        a = np.concatenate([2*a[:, :1] - a[:, 1:2], a], axis=1)
+    if hi_y:
+        a = np.concatenate([a, 2*a[:, -1:] - a[:, -2:-1]], axis=1)
+    if lo_x:
+        a = np.concatenate([2*a[..., :1] - a[..., 1:2], a], axis=2)
+    if hi_x:
+        a = np.concatenate([a, 2*a[..., -1:] - a[..., -2:-1]], axis=2)
+    return a
+
+
+def _ddz(f, z):
+    d = np.empty_like(f)
+    d[1:-1] = (f[2:] - f[:-2])/(z[2:] - z[:-2])
+    d[0] = (f[1] - f[0])/(z[1] - z[0])
+    d[-1] = (f[-1] - f[-2])/(z[-1] - z[-2])
+    return d
+
+
+def tile_diagnostics(wf, tile, levels=W_LEVELS):
+    # Everything for one tile of one frame, as float32 arrays of the tile's
+    # size (w_max: the tile's own maximum on each level)
+    j0, j1, i0, i1 = tile
+    ny, nx = wf.ny, wf.nx
+    ja, jb, ia, ib = max(j0-1, 0), min(j1+1, ny), max(i0-1, 0), min(i1+1, nx)
+    js, is_ = slice(ja, jb), slice(ia, ib)
+    with stage("read"):
+        U = np.ma.getdata(wf.read("U", slice(None), js, slice(ia, ib+1))).astype(np.float64)
+        V = np.ma.getdata(wf.read("V", slice(None), slice(ja, jb+1), is_)).astype(np.float64)
+        W = np.ma.getdata(wf.read("W", slice(None), js, is_)).astype(np.float64)
+        zw = np.ma.getdata(wf.read("PH", slice(None), js, is_) + wf.read("PHB", slice(None), js, is_))/G
+        hgt = np.ma.getdata(wf.read("HGT", js, is_))
+        smoke = np.ma.getdata(wf.read("fire_smoke", slice(None), js, is_)) if "fire_smoke" in wf.nc.variables else None
+
+    with stage("curl"):
+        # Destagger onto the mass grid, then pad the domain edges
+        edges = (j0 == 0, j1 == ny, i0 == 0, i1 == nx)
+        u = _pad_edges(0.5*(U[..., :-1] + U[..., 1:]), *edges)
+        v = _pad_edges(0.5*(V[:, :-1] + V[:, 1:]), *edges)
+        w = _pad_edges(0.5*(W[:-1] + W[1:]), *edges)
+        z = _pad_edges(0.5*(zw[:-1] + zw[1:]), *edges)
+        dx, dy = wf.dx, wf.dy
+        core = (slice(None), slice(1, -1), slice(1, -1))
+        ddx = lambda f: (f[:, 1:-1, 2:] - f[:, 1:-1, :-2])/(2*dx)
+        ddy = lambda f: (f[:, 2:, 1:-1] - f[:, :-2, 1:-1])/(2*dy)
+        zc = z[core]
+        out = {
+            "vort_i": ddy(w) - _ddz(v[core], zc),
+            "vort_j": _ddz(u[core], zc) - ddx(w),
+            "vort_k": ddx(v) - ddy(u),
+        }
+
+    # The tile itself within the (unpadded) arrays that were read
+    tj, ti = slice(j0-ja, j1-ja), slice(i0-ia, i1-ia)
+    height = zc - hgt[tj, ti]
+    out["height_agl"] = height
+    if smoke is not None:
+        out["smoke_column"] = (smoke[:, tj, ti]*np.diff(zw[:, tj, ti], axis=0)).sum(axis=0)
+    with stage("interp"):
+        wl = Weights(height, levels).interp(w[core])
+        out["w_max"] = np.where(np.isnan(wl), -np.inf, wl).max(axis=(1, 2))
+    return {k: v.astype(np.float32) for k, v in out.items()}
+
+
+def _tile_task(args):
+    frame, path, timeidx, tile, levels = args
+    with stage("tile", frame=frame, tile=list(tile)), WrfoutFile(path, timeidx) as wf:
+        return frame, tile, tile_diagnostics(wf, tile, levels)
+
+
+VARIABLES = {
+    # name: (dims, units, description)
+    "vort_i": (("Time", "bottom_top", "south_north", "west_east"), "s-1", "x (i) vorticity, dw/dy - dv/dz"),
+    "vort_j": (("Time", "bottom_top", "south_north", "west_east"), "s-1", "y (j) vorticity, du/dz - dw/dx"),
+    "vort_k": (("Time", "bottom_top", "south_north", "west_east"), "s-1", "vertical (k) vorticity, dv/dx - du/dy"),
+    "height_agl": (("Time", "bottom_top", "south_north", "west_east"), "m", "height of the mass levels above ground"),
+    "smoke_column": (("Time", "south_north", "west_east"), "g kg-1 m", "fire_smoke integrated over height"),
+    "w_max": (("Time", "level"), "m s-1", "maximum w over the domain on each height level"),
+}
+
+
+def _create(path, case, first, tile, levels, complevel, has_smoke):
+    nc = Dataset(path, "w", format="NETCDF4")
+    sizes = {"Time": None, "DateStrLen": 19, "bottom_top": first.nz, "south_north": first.ny,
+             "west_east": first.nx, "level": len(levels)}
+    for name, size in sizes.items():
+        nc.createDimension(name, size)
+    nc.DX = np.float32(first.dx)
+    nc.DY = np.float32(first.dy)
+    nc.source = str(case.ncdir)
+    nc.tile = np.int32(tile)
+    times = nc.createVariable("Times", "S1", ("Time", "DateStrLen"))
+    for t, time in enumerate(case.times):
+        times[t] = np.array(list(format_wrf_time(time)), dtype="S1")
+    level = nc.createVariable("level", "f4", ("level",))
+    level.units = "m"
+    level.description = "height above ground of the w_max levels"
+    level[:] = levels
+    for name, (dims, units, description) in VARIABLES.items():
+        if name == "smoke_column" and not has_smoke:
+            continue
+        # Chunked like the tiles, so each tile is written without touching another chunk
+        chunks = [1] + [{"bottom_top": first.nz, "level": len(levels)}.get(d, min(tile, sizes[d])) for d in dims[1:]]
+        var = nc.createVariable(name, "f4", dims, zlib=complevel > 0, complevel=max(complevel, 1), shuffle=True,
+                                chunksizes=chunks, fill_value=np.float32(np.nan))
+        var.units = units
+        var.description = description
+    return nc
+
+
+def compute_diagnostics(ncdir, out=None, tile=64, processes=None, levels=W_LEVELS, complevel=4, max_pending=None):
+    # Writes the product for every frame in ncdir (default <case>/diagnostics.nc)
+    # and returns its path. At most max_pending tiles (default 2 per process)
+    # are in flight, which bounds the memory of results waiting to be written.
+    case = WrfoutCase(ncdir)
+    if not len(case):
+        raise ValueError("no wrfout files in {}".format(ncdir))
+    out = Path(ncdir).parent/"diagnostics.nc" if out is None else Path(out)
+    first = case[0]
+    with first:
+        ny, nx = first.ny, first.nx
+        has_smoke = "fire_smoke" in first.nc.variables
+        tmp = out.with_name(out.name + ".{}.tmp".format(os.getpid()))
+        nc = _create(tmp, case, first, tile, levels, complevel, has_smoke)
+    tasks = [(t, str(case[t].path), case[t].timeidx, box, levels)
+             for t in range(len(case)) for box in tiles(ny, nx, tile)]
+    w_max = np.full((len(case), len(levels)), -np.inf, dtype=np.float32)
+
+    def write(result):
+        t, (j0, j1, i0, i1), arrays = result
+        with stage("write", frame=t):
+            for name, data in arrays.items():
+                if name == "w_max":
+                    np.maximum(w_max[t], data, out=w_max[t])
+                elif data.ndim == 3:
+                    nc[name][t, :, j0:j1, i0:i1] = data
+                else:
+                    nc[name][t, j0:j1, i0:i1] = data
+
+    try:
+        if processes == 1:
+            for task in tasks:
+                write(_tile_task(task))
+        else:
+            with ProcessPoolExecutor(processes) as pool:
+                max_pending = max_pending or 2*(processes or os.cpu_count())
+                pending = set()
+                for task in tasks:
+                    pending.add(pool.submit(_tile_task, task))
+                    if len(pending) >= max_pending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            write(future.result())
+                for future in pending:
+                    write(future.result())
+        w_max[np.isneginf(w_max)] = np.nan
+        nc["w_max"][:] = w_max
+    except BaseException:
+        # A failed tile or a Ctrl-C doesn't leave a full-size tmp file behind
+        nc.close()
+        tmp.unlink(missing_ok=True)
+        raise
+    nc.close()
+    os.replace(tmp, out)
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Vorticity, column smoke and max updraft for every frame of a case, "
+                                                 "computed in tiles and written to one netCDF product.")
+    parser.add_argument("ncdir", help="a case's nc/ directory")
+    parser.add_argument("-o", "--out", help="product file (default: <case>/diagnostics.nc)")
+    parser.add_argument("--tile", type=int, default=64, help="tile size in grid points")
+    parser.add_argument("-j", "--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--complevel", type=int, default=4)
+    args = parser.parse_args(argv)
+    print(compute_diagnostics(args.ncdir, args.out, args.tile, args.processes, complevel=args.complevel))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import argparse
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+
+from stages import stage
+from wrfout import WrfoutCase
+
+# Fire metrics for every frame of a case, on the refined fire grid:
+#   area_m2                 burnt area, the sum of FIRE_AREA over the cells
+#   perimeter_m             length of the burnt region's outline
+#   front_x_m, front_y_m    centroid of the front cells (burnt, with an unburnt neighbour)
+#   head_x_m, head_y_m      the front cell farthest from the ignition point
+#   head_distance_m         and how far it is from the ignition point
+#   ros_mean/median/p90/max rate of spread (m s-1) along the front since the last frame
+#   x0_m, x1_m, y0_m, y1_m  extent of the burnt region
+# A cell counts as burnt at FIRE_AREA >= threshold. The ignition point is
+# the centroid of the first frame with anything burnt. Rate of spread is
+# each new front cell's distance to the previous frame's burnt region
+# (a Euclidean distance transform) over the time between the frames.
+#
+# Frames are split into runs of consecutive frames, one per task, and each
+# task streams through its run holding two frames' fire grids at once. Only
+# the box around the burnt cells of the pair is worked on.
+
+COLUMNS = ["frame", "time", "area_m2", "perimeter_m", "front_cells", "front_x_m", "front_y_m", "head_x_m",
+           "head_y_m", "head_distance_m", "ros_mean", "ros_median", "ros_p90", "ros_max",
+           "x0_m", "x1_m", "y0_m", "y1_m"]
+
+
+def _box(*masks, pad=1):
+    # (j0, j1, i0, i1) around the True cells of all masks, padded by pad
+    # cells, or None
+    rows = np.logical_or.reduce([m.any(axis=1) for m in masks])
+    cols = np.logical_or.reduce([m.any(axis=0) for m in masks])
+    if not rows.any():
+        return None
+    js, is_ = np.flatnonzero(rows), np.flatnonzero(cols)
+    ny, nx = masks[0].shape
+    return max(js[0]-pad, 0), min(js[-1]+pad+1, ny), max(is_[0]-pad, 0), min(is_[-1]+pad+1, nx)
+
+
+def front_cells(burnt):
+    # Burnt cells with an unburnt 4-neighbour; outside the grid counts as unburnt
+    padded = np.pad(burnt, 1)
+    inner = padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+    return burnt & ~inner
+
+
+def perimeter(burnt, dx, dy):
+    # Burnt/unburnt cell edges, scaled by pi/4: counting edges measures a
+    # curve in steps along x and y, which overestimates a randomly oriented
+    # outline by 4/pi on average
+    padded = np.pad(burnt, 1)
+    ex = np.count_nonzero(padded[:, 1:] != padded[:, :-1])    # edges of length dy
+    ey = np.count_nonzero(padded[1:] != padded[:-1])          # edges of length dx
+    return np.pi/4*(ex*dy + ey*dx)
+
+
+def frame_metrics(area, prev_burnt, dt, dx, dy, threshold=0.5, ignition=None):
+    # Metrics of one fire grid (a row of COLUMNS without frame/time).
+    # prev_burnt: the previous frame's burnt mask or None; dt: seconds since it
+    row = dict.fromkeys(COLUMNS[2:], np.nan)
+    row["area_m2"] = float(area.sum(dtype=np.float64))*dx*dy
+    row["perimeter_m"] = row["front_cells"] = 0
+    burnt = area >= threshold
+    box = _box(burnt) if prev_burnt is None else _box(burnt, prev_burnt)
+    if box is None or not burnt.any():
+        return row, burnt
+    j0, j1, i0, i1 = box
+    b = burnt[j0:j1, i0:i1]
+    row["perimeter_m"] = perimeter(b, dx, dy)
+    fj, fi = np.nonzero(front_cells(b))
+    # Cell centres in metres from the fire grid origin
+    fx, fy = (fi + i0 + 0.5)*dx, (fj + j0 + 0.5)*dy
+    row["front_cells"] = fj.size
+    row["front_x_m"], row["front_y_m"] = float(fx.mean()), float(fy.mean())
+    if ignition is not None:
+        d = np.hypot(fx - ignition[0], fy - ignition[1])
+        k = int(d.argmax())
+        row["head_x_m"], row["head_y_m"], row["head_distance_m"] = float(fx[k]), float(fy[k]), float(d[k])
+    bj, bi = np.flatnonzero(b.any(axis=1)), np.flatnonzero(b.any(axis=0))
+    row["x0_m"], row["x1_m"] = (bi[0] + i0)*dx, (bi[-1] + i0 + 1)*dx
+    row["y0_m"], row["y1_m"] = (bj[0] + j0)*dy, (bj[-1] + j0 + 1)*dy
+
+    if prev_burnt is not None and dt and prev_burnt.any():
+        with stage("ros"):
+            prev = prev_burnt[j0:j1, i0:i1]
+            dist = distance_transform_edt(~prev, sampling=(dy, dx))[fj, fi]
+            # Only front cells that burnt since the last frame have moved
+            ros = dist[dist > 0]/dt
+            if ros.size:
+                row["ros_mean"], row["ros_max"] = float(ros.mean()), float(ros.max())
+                row["ros_median"], row["ros_p90"] = np.percentile(ros, [50, 90]).tolist()
+    return row, burnt
+
+
+def _ignition(burnt, dx, dy):
+    j, i = np.nonzero(burnt)
+    return float((i + 0.5).mean()*dx), float((j + 0.5).mean()*dy)
+
+
+def _run_task(args):
+    # One run of consecutive frames; first is the frame before the run (or
+    # None at the start), only used for the rates of spread
+    ncdir, frames, first, threshold, ignition = args
+    case = WrfoutCase(ncdir)
+    rows, prev_burnt, prev_time = [], None, None
+    for t in ([first] if first is not None else []) + frames:
+        with stage("fire_frame", frame=t), case[t] as wf:
+            with stage("read"):
+                area = np.ma.filled(wf.fire_area(), 0).astype(np.float32)
+            sr_x, sr_y = wf.refinement
+            dx, dy = wf.dx/sr_x, wf.dy/sr_y
+            time = wf.time
+            if t == first:
+                prev_burnt, prev_time = area >= threshold, time
+                continue
+            dt = (time - prev_time).total_seconds() if prev_time is not None else None
+            row, prev_burnt = frame_metrics(area, prev_burnt, dt, dx, dy, threshold, ignition)
+            prev_time = time
+        row.update(frame=t, time=time.isoformat())
+        rows.append(row)
+    return rows
+
+
+def fire_front(ncdir, out=None, processes=None, threshold=0.5, run=8):
+    # Writes the metrics of every frame of a case to a CSV (default
+    # <case>/plots/fire_front.csv) and returns its path
+    case = WrfoutCase(ncdir)
+    if not len(case):
+        raise ValueError("no wrfout files in {}".format(ncdir))
+    out = Path(ncdir).parent/"plots"/"fire_front.csv" if out is None else Path(out)
+
+    # The ignition point, from the first frame with anything burnt
+    ignition = None
+    for t in range(len(case)):
+        with case[t] as wf:
+            burnt = np.ma.filled(wf.fire_area(), 0) >= threshold
+            if burnt.any():
+                sr_x, sr_y = wf.refinement
+                ignition = _ignition(burnt, wf.dx/sr_x, wf.dy/sr_y)
+                break
+
+    frames = list(range(len(case)))
+    tasks = [(str(case.ncdir), frames[s:s+run], s-1 if s else None, threshold, ignition)
+             for s in range(0, len(frames), run)]
+    rows = []
+    if processes == 1:
+        for task in tasks:
+            rows += _run_task(task)
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            for result in pool.map(_run_task, tasks):
+                rows += result
+
+    out.parent.mkdir(parents=True, exist_ok=True)
+    tmp = out.with_name(out.name + ".tmp")
+    with open(tmp, "w", newline="") as f:
+        writer = csv.DictWriter(f, COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({k: "" if isinstance(v, float) and np.isnan(v) else
+                             "{:.6g}".format(v) if isinstance(v, float) else v for k, v in row.items()})
+    os.replace(tmp, out)
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Burnt area, perimeter, fire front position and rate of spread "
+                                                 "for every frame of a case, from the refined FIRE_AREA grid.")
+    parser.add_argument("ncdir", help="a case's nc/ directory")
+    parser.add_argument("-o", "--out", help="CSV file (default: <case>/plots/fire_front.csv)")
+    parser.add_argument("-j", "--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--threshold", type=float, default=0.5, help="FIRE_AREA at which a cell counts as burnt")
+    parser.add_argument("--run", type=int, default=8, help="consecutive frames per task")
+    args = parser.parse_args(argv)
+    print(fire_front(args.ncdir, args.out, args.processes, args.threshold, args.run))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import shutil
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+VIDEO_SUFFIXES = (".mp4", ".mkv", ".mov", ".avi", ".webm")
+
+
+def figure_rgb(fig):
+    # The figure's current pixels as (height, width, 3) uint8, no encoding
+    fig.canvas.draw()
+    return np.asarray(fig.canvas.buffer_rgba())[..., :3]
+
+
+class FrameSink:
+    # Where rendered frames go, in order. Subclasses implement _write.
+    def __init__(self):
+        self.frames = 0
+        self.shape = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # A failed run leaves nothing half-written behind
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, rgb):
+        rgb = np.ascontiguousarray(rgb, dtype=np.uint8)
+        if self.shape is None:
+            self.shape = rgb.shape
+        elif rgb.shape != self.shape:
+            raise ValueError("frame {} is {}, earlier frames were {}".format(self.frames, rgb.shape, self.shape))
+        self._write(rgb)
+        self.frames += 1
+
+    def close(self):
+        pass
+
+    def abort(self):
+        self.close()
+
+
+class PPMSequence(FrameSink):
+    # Uncompressed binary PPMs, <directory>/00000.ppm, 00001.ppm, ...
+    def __init__(self, directory, start=0, pattern="{:05d}.ppm"):
+        super().__init__()
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.start = start
+        self.pattern = pattern
+
+    def _write(self, rgb):
+        h, w, _ = rgb.shape
+        with open(self.directory/self.pattern.format(self.start + self.frames), "wb") as f:
+            f.write("P6\n{} {}\n255\n".format(w, h).encode())
+            f.write(rgb.tobytes())
+
+
+class FFmpegSink(FrameSink):
+    # Raw RGB frames piped into a local ffmpeg, which is started on the
+    # first frame once the frame size is known
+    def __init__(self, filename, fps=10, codec="libx264", crf=18, ffmpeg="ffmpeg", extra_args=()):
+        super().__init__()
+        self.filename = Path(filename)
+        self.fps = fps
+        self.codec = codec
+        self.crf = crf
+        self.ffmpeg = shutil.which(ffmpeg)
+        if self.ffmpeg is None:
+            raise FileNotFoundError("{} not found on PATH".format(ffmpeg))
+        self.extra_args = list(extra_args)
+        self._proc = None
+
+    def _start(self, h, w):
+        cmd = [self.ffmpeg, "-y", "-loglevel", "error",
+               "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", "{}x{}".format(w, h), "-r", str(self.fps), "-i", "-",
+               # yuv420p wants even sizes
+               "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+               "-c:v", self.codec, "-pix_fmt", "yuv420p"]
+        if self.crf is not None:
+            cmd += ["-crf", str(self.crf)]
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        self._proc = subprocess.Popen(cmd + self.extra_args + [str(self.filename)], stdin=subprocess.PIPE)
+
+    def _write(self, rgb):
+        if self._proc is None:
+            self._start(*rgb.shape[:2])
+        self._proc.stdin.write(rgb.tobytes())
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.stdin.close()
+            if self._proc.wait() != 0:
+                raise RuntimeError("ffmpeg exited with status {} writing {}".format(self._proc.returncode, self.filename))
+            self._proc = None
+
+    def abort(self):
+        # Stops ffmpeg and removes the partial video
+        if self._proc is not None:
+            self._proc.kill()
+            try:
+                self._proc.stdin.close()
+            except OSError:
+                pass
+            self._proc.wait()
+            self._proc = None
+        if self.filename.exists():
+            self.filename.unlink()
+
+
+def open_sink(target, fps=10, **kwargs):
+    # A video file for the usual video suffixes, otherwise a PPM directory
+    target = Path(target)
+    if target.suffix.lower() in VIDEO_SUFFIXES:
+        return FFmpegSink(target, fps, **kwargs)
+    return PPMSequence(target, **kwargs)
@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from wrfout import NcFile
+
+# HRRR soundings without NCL: the fields SoundingData uses, cut to a lat/lon
+# box (and optionally some of the pressure levels), stored as one float32
+# record per grid column:
+#
+#   <name>.columns/columns.npy  (ny, nx, record), memory-mapped when read
+#   <name>.columns/meta.json    field offsets in the record, levels, window
+#
+# A record holds every level of every profile field and the surface fields
+# of one column, so a sounding is one contiguous read. The fields keep the
+# ncl_convert2nc names and levels stay top first, as in the out.nc files.
+# SoundingData('hrrr', store, lat, lon) and SoundingEnsemble read a store
+# wherever they take a netCDF file.
+
+# name: (cfgrib filter_by_keys, cfgrib variable); profile fields are on
+# isobaricInhPa
+GRIB_FIELDS = {
+    "HGT_P0_L100_GLC0": ({"typeOfLevel": "isobaricInhPa"}, "gh"),
+    "TMP_P0_L100_GLC0": ({"typeOfLevel": "isobaricInhPa"}, "t"),
+    "SPFH_P0_L100_GLC0": ({"typeOfLevel": "isobaricInhPa"}, "q"),
+    "DPT_P0_L100_GLC0": ({"typeOfLevel": "isobaricInhPa"}, "dpt"),
+    "UGRD_P0_L100_GLC0": ({"typeOfLevel": "isobaricInhPa"}, "u"),
+    "VGRD_P0_L100_GLC0": ({"typeOfLevel": "isobaricInhPa"}, "v"),
+    "HGT_P0_L1_GLC0": ({"typeOfLevel": "surface", "stepType": "instant"}, "orog"),
+    "PRES_P0_L1_GLC0": ({"typeOfLevel": "surface", "stepType": "instant"}, "sp"),
+    "POT_P0_L103_GLC0": ({"typeOfLevel": "heightAboveGround", "level": 2}, "pt"),
+    "SPFH_P0_L103_GLC0": ({"typeOfLevel": "heightAboveGround", "level": 2}, "sh2"),
+}
+PROFILE_FIELDS = [name for name in GRIB_FIELDS if "_L100_" in name]
+LAT, LON = "gridlat_0", "gridlon_0"
+
+
+class ColumnStore:
+    # Reads a store like NcFile reads a file: read(name, *index) with the
+    # levels first, shape(name), plus gather() for whole columns
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path/"meta.json") as f:
+            self.meta = json.load(f)
+        self.levels = np.array(self.meta["levels"], dtype=np.float64)
+        self._columns = None
+
+    @staticmethod
+    def is_store(path):
+        return (Path(path)/"meta.json").exists()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._columns = None
+
+    @property
+    def columns(self):
+        if self._columns is None:
+            self._columns = np.load(self.path/"columns.npy", mmap_mode="r")
+        return self._columns
+
+    def shape(self, name):
+        offset, nlev = self.meta["fields"][name]
+        ny, nx = self.meta["shape"]
+        return (nlev, ny, nx) if nlev else (ny, nx)
+
+    def read(self, name, *index):
+        # Strided over the records, so meant for the 2D fields (lat/lon)
+        # rather than whole profile fields
+        offset, nlev = self.meta["fields"][name]
+        if nlev:
+            data = np.moveaxis(self.columns[..., offset:offset+nlev], -1, 0)
+        else:
+            data = self.columns[..., offset]
+        return np.asarray(data[index])
+
+    def gather(self, rows, cols):
+        # {name: values} at the (rows, cols) columns: (level, point) for the
+        # profile fields, (point,) for the rest
+        records = np.asarray(self.columns[np.asarray(rows), np.asarray(cols)], dtype=np.float64)
+        out = {}
+        for name, (offset, nlev) in self.meta["fields"].items():
+            out[name] = records[:, offset:offset+nlev].T if nlev else records[:, offset]
+        return out
+
+
+def write_store(path, fields, levels, **meta):
+    # fields: {name: (level, y, x) or (y, x) array}; levels in hPa, in the
+    # order of the profile fields' first axis. Written next to path and
+    # swapped in whole, so readers never see half a store.
+    path = Path(path)
+    tmp = path.with_name(path.name + ".{}.tmp".format(os.getpid()))
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    offsets, size = {}, 0
+    for name, data in fields.items():
+        nlev = data.shape[0] if data.ndim == 3 else 0
+        offsets[name] = (size, nlev)
+        size += max(nlev, 1)
+    shape = next(iter(fields.values())).shape[-2:]
+    columns = np.lib.format.open_memmap(tmp/"columns.npy", mode="w+", dtype=np.float32, shape=shape + (size,))
+    for name, data in fields.items():
+        offset, nlev = offsets[name]
+        data = np.ma.filled(np.ma.asarray(data, dtype=np.float32), np.nan)
+        if nlev:
+            columns[..., offset:offset+nlev] = np.moveaxis(data, 0, -1)
+        else:
+            columns[..., offset] = data
+    columns.flush()
+    del columns
+    meta = dict(meta, shape=list(shape), levels=[float(p) for p in levels], fields=offsets)
+    with open(tmp/"meta.json", "w") as f:
+        json.dump(meta, f, indent=1)
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+    return path
+
+
+def window(lat, lon, bbox=None, pad=2):
+    # (rows, cols) slices of the part of the grid covering bbox (lat0, lat1,
+    # lon0, lon1), padded by pad points; the whole grid without a bbox
+    if bbox is None:
+        return slice(None), slice(None)
+    lat0, lat1, lon0, lon1 = bbox
+    inside = (lat >= lat0) & (lat <= lat1) & (lon >= lon0) & (lon <= lon1)
+    if not inside.any():
+        raise ValueError("no grid points in {}".format(bbox))
+    rows = np.flatnonzero(inside.any(axis=1))
+    cols = np.flatnonzero(inside.any(axis=0))
+    return (slice(max(int(rows[0])-pad, 0), int(rows[-1])+pad+1),
+            slice(max(int(cols[0])-pad, 0), int(cols[-1])+pad+1))
+
+
+def _level_index(file_levels, levels):
+    # Positions of the wanted levels (hPa) in file_levels, in file order
+    if levels is None:
+        return np.arange(len(file_levels))
+    k = [int(np.argmin(np.abs(file_levels - p))) for p in levels]
+    missing = [p for p, i in zip(levels, k) if abs(file_levels[i] - p) > 0.05]
+    if missing:
+        raise ValueError("levels not in the file: {}".format(missing))
+    return np.array(sorted(set(k)))
+
+
+def ingest_netcdf(src, out, bbox=None, levels=None):
+    # An existing ncl_convert2nc out.nc to a store
+    with NcFile(src) as nc:
+        lat, lon = np.ma.getdata(nc.read(LAT)), np.ma.getdata(nc.read(LON))
+        rows, cols = window(lat, lon, bbox)
+        file_levels = np.ma.getdata(nc.read("lv_ISBL0"))/100.
+        k = _level_index(file_levels, levels)
+        fields = {}
+        for name in GRIB_FIELDS:
+            fields[name] = nc.read(name, k, rows, cols) if name in PROFILE_FIELDS else nc.read(name, rows, cols)
+        fields[LAT], fields[LON] = lat[rows, cols], lon[rows, cols]
+    return write_store(out, fields, file_levels[k], source=str(src), bbox=bbox,
+                       window=[rows.start or 0, cols.start or 0])
+
+
+def _open_grib(src, keys):
+    import xarray as xr
+    # squeeze=False: a lone level, time or step stays a dimension instead of
+    # turning into a scalar that can't be indexed
+    return xr.open_dataset(src, engine="cfgrib",
+                           backend_kwargs={"filter_by_keys": keys, "indexpath": "", "squeeze": False})
+
+
+def _grib_window(da, rows, cols, **level):
+    # One level of a cfgrib variable cut to the window, as (y, x); the other
+    # dimensions (time, step, the level) are down to length 1
+    y, x = da.dims[-2:]
+    data = da.isel({y: rows, x: cols, **level}).values
+    return data.reshape(data.shape[-2:])
+
+
+def ingest_grib(src, out, bbox=None, levels=None):
+    # A HRRR wrfprs grib2 to a store, through cfgrib (only needed here).
+    # Every field is cut to the window as it is decoded, so at most one
+    # full-grid level is in memory at a time.
+    datasets = {}
+
+    def dataset(keys):
+        key = json.dumps(keys, sort_keys=True)
+        if key not in datasets:
+            datasets[key] = _open_grib(src, keys)
+        return datasets[key]
+
+    try:
+        first = dataset(GRIB_FIELDS[PROFILE_FIELDS[0]][0])
+        lat = first["latitude"].values
+        lon = (first["longitude"].values + 180.) % 360. - 180.
+        rows, cols = window(lat, lon, bbox)
+        # The HRRR's 1013.2 hPa level is 101320 Pa in the file, but eccodes
+        # only gives isobaricInhPa levels in whole hPa
+        hpa = first["isobaricInhPa"].values.astype(np.float64)
+        hpa[hpa == 1013.] = 1013.2
+        # Anything eccodes puts on isobaricInPa instead (it does for levels
+        # under 1 hPa); the filter comes back empty if there's none
+        extra = dataset({"typeOfLevel": "isobaricInPa"})
+        pa = extra["isobaricInPa"].values.astype(np.float64)/100. if "isobaricInPa" in extra.coords else np.array([])
+        file_levels = np.concatenate([hpa, pa])
+        order = np.argsort(file_levels)            # top first, like the netCDF files
+        k = order[_level_index(file_levels[order], levels)]
+
+        fields = {}
+        for name, (keys, var) in GRIB_FIELDS.items():
+            ds = dataset(keys)
+            if name not in PROFILE_FIELDS:
+                fields[name] = _grib_window(ds[var], rows, cols)
+                continue
+            profile = []
+            for i in k:
+                if i < len(hpa):
+                    profile.append(_grib_window(ds[var], rows, cols, isobaricInhPa=int(i)))
+                else:
+                    profile.append(_grib_window(extra[var], rows, cols, isobaricInPa=int(i - len(hpa))))
+            fields[name] = np.stack(profile)
+        fields[LAT], fields[LON] = lat[rows, cols], lon[rows, cols]
+        valid = str(first["valid_time"].values.ravel()[0])
+    finally:
+        for ds in datasets.values():
+            ds.close()
+    return write_store(out, fields, file_levels[k], source=str(src), valid_time=valid, bbox=bbox,
+                       window=[rows.start or 0, cols.start or 0])
+
+
+def store_path(src, outdir=None):
+    src = Path(src)
+    return (src.parent if outdir is None else Path(outdir))/(src.name + ".columns")
+
+
+def _ingest(args):
+    src, out, bbox, levels = args
+    ingest = ingest_netcdf if Path(src).suffix == ".nc" else ingest_grib
+    return ingest(src, out, bbox, levels)
+
+
+def ingest_many(sources, outdir=None, bbox=None, levels=None, processes=None):
+    # Several HRRR cycles (grib2 or out.nc), one process per file
+    tasks = [(src, store_path(src, outdir), bbox, levels) for src in sources]
+    if processes == 1:
+        return list(map(_ingest, tasks))
+    with ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(_ingest, tasks))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cut HRRR grib2 (or ncl out.nc) files to a lat/lon box and write "
+                                                 "column stores for SoundingData.")
+    parser.add_argument("sources", nargs="+", help="HRRR wrfprs grib2 files, or .nc files from the NCL script")
+    parser.add_argument("-o", "--outdir", help="where the <file>.columns stores go (default: next to each file)")
+    parser.add_argument("--bbox", type=float, nargs=4, metavar=("LAT0", "LAT1", "LON0", "LON1"))
+    parser.add_argument("--levels", type=float, nargs="+", help="pressure levels to keep (hPa); default all")
+    parser.add_argument("-j", "--processes", type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+    for path in ingest_many(args.sources, args.outdir, args.bbox, args.levels, args.processes):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+# WRF ideal.exe input_sounding: a surface line " P Theta w" then one
+# "  Z Theta w U V" line per level. Values are written with str(), which is
+# what SoundingData has always written, so files stay byte-for-byte the same.
+MISSING = -9999.00
+
+
+def parse_input_sounding(text):
+    # (surface (3,), profile (nlev, 5)) as float64
+    head, _, body = text.partition("\n")
+    sfc = np.array(head.split(), dtype=np.float64)
+    profile = np.array(body.split(), dtype=np.float64).reshape(-1, 5)
+    return sfc, profile
+
+
+def read_input_sounding(filename):
+    with open(filename, "r") as f:
+        return parse_input_sounding(f.read())
+
+
+def format_input_sounding(sfc, profile):
+    # sfc values keep their own str() (a float32 prints as float32);
+    # profile values are written as float64, as the DataFrame rows always were
+    lines = [" " + " ".join(str(v) for v in sfc)]
+    lines += ["  " + " ".join(map(str, row)) for row in np.asarray(profile, dtype=np.float64).tolist()]
+    return "\n".join(lines) + "\n"
+
+
+def write_input_sounding(filename, sfc, profile):
+    with open(filename, "w") as f:
+        f.write(format_input_sounding(sfc, profile))
+
+
+def wrfout_column(wf, i, j):
+    # (sfc, profile) of the model column at mass point (i, j) of a
+    # wrfout.WrfoutFile, heights above ground, e.g. to compare a run's
+    # evolving environment with the input_sounding it started from
+    z = wf.height_agl(slice(j, j+1), slice(i, i+1))[:, 0, 0]
+    u = np.ma.getdata(wf.read("U", slice(None), j, slice(i, i+2))).mean(axis=1)
+    v = np.ma.getdata(wf.read("V", slice(None), slice(j, j+2), i)).mean(axis=1)
+    theta = np.ma.getdata(wf.read("T", slice(None), j, i)) + 300.
+    w = np.ma.getdata(wf.read("QVAPOR", slice(None), j, i))*1000.
+    psfc = float(wf.read("PSFC", j, i))
+    sfc = (psfc/100., float(wf.read("T2", j, i))*(1e5/psfc)**0.2854, float(wf.read("Q2", j, i))*1000.)
+    return np.array(sfc), np.column_stack([z, theta, w, u, v]).astype(np.float64)
+
+
+def perturb(sfc, profile, rotate=0., speed=1., theta=0., theta_levels=None, moisture=1.):
+    # rotate: degrees the wind profile is turned (clockwise, i.e. veered);
+    # speed/moisture: factors on wind speed and mixing ratio; theta: K added
+    # everywhere, theta_levels: optional extra K per level
+    sfc = np.array(sfc, dtype=np.float64)
+    profile = np.array(profile, dtype=np.float64)
+    sfc[1] += theta
+    sfc[2] *= moisture
+    profile[:, 1] += theta
+    if theta_levels is not None:
+        profile[:, 1] += theta_levels
+    profile[:, 2] *= moisture
+
+    U, V = profile[:, 3], profile[:, 4]
+    valid = (U != MISSING) & (V != MISSING)
+    a = np.radians(rotate)
+    Ur = speed*(U*np.cos(a) + V*np.sin(a))
+    Vr = speed*(-U*np.sin(a) + V*np.cos(a))
+    profile[:, 3] = np.where(valid, Ur, U)
+    profile[:, 4] = np.where(valid, Vr, V)
+    return sfc, profile
+
+
+def draw_perturbation(rng, nlev, rotate_sd=0., speed_sd=0., theta_sd=0., theta_level_sd=0., moisture_sd=0.):
+    # One member's perturbation parameters, for perturb(**params)
+    params = {
+        "rotate": float(rng.normal(0., rotate_sd)),
+        "speed": float(max(1. + rng.normal(0., speed_sd), 0.)),
+        "theta": float(rng.normal(0., theta_sd)),
+        "moisture": float(max(1. + rng.normal(0., moisture_sd), 0.)),
+    }
+    if theta_level_sd:
+        params["theta_levels"] = rng.normal(0., theta_level_sd, nlev).tolist()
+    return params
+
+
+def _write_member(args):
+    sfc, profile, path, seed, member, spread = args
+    # Each member has its own stream, so the ensemble doesn't depend on how
+    # the members are split between processes
+    rng = np.random.default_rng([seed, member])
+    params = draw_perturbation(rng, len(profile), **spread)
+    write_input_sounding(path, *perturb(sfc, profile, **params))
+    return member, params
+
+
+def write_ensemble(base, outdir, members, seed=0, processes=1, chunksize=16, **spread):
+    # Writes outdir/member_XXXX/input_sounding for each member plus
+    # outdir/ensemble.json with the perturbation drawn for each one.
+    # spread: rotate_sd, speed_sd, theta_sd, theta_level_sd, moisture_sd.
+    # Serial by default: a member takes about half a millisecond, and a
+    # process pool was no faster even for 1000 members
+    sfc, profile = read_input_sounding(base)
+    outdir = Path(outdir)
+    paths = []
+    for member in range(members):
+        d = outdir/"member_{:04d}".format(member)
+        d.mkdir(parents=True, exist_ok=True)
+        paths.append(d/"input_sounding")
+    args = [(sfc, profile, path, seed, member, spread) for member, path in enumerate(paths)]
+    if processes == 1:
+        drawn = list(map(_write_member, args))
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            drawn = list(pool.map(_write_member, args, chunksize=chunksize))
+    with open(outdir/"ensemble.json", "w") as f:
+        json.dump({"base": str(base), "seed": seed, "spread": spread,
+                   "members": {str(path.relative_to(outdir)): params for path, (_, params) in zip(paths, drawn)}},
+                  f, indent=1)
+    return paths
+
+
+def check_round_trip(filenames=None):
+    # Reads and rewrites the existing soundings. The values have to come back
+    # exactly and the text may only differ in trailing whitespace.
+    if filenames is None:
+        filenames = sorted(Path(__file__).resolve().parent.glob("*/soundings/input_sounding"))
+    ok = True
+    for filename in filenames:
+        with open(filename, "r") as f:
+            original = f.read()
+        sfc, profile = parse_input_sounding(original)
+        text = format_input_sounding(sfc, profile)
+        sfc2, profile2 = parse_input_sounding(text)
+        same_values = np.array_equal(sfc, sfc2) and np.array_equal(profile, profile2)
+        same_text = [l.rstrip() for l in text.splitlines()] == [l.rstrip() for l in original.splitlines()]
+        print("{}: {}{}".format(filename, "ok" if same_values and same_text else "MISMATCH",
+                                "" if text == original else " (trailing whitespace differs)" if same_text else ""))
+        ok &= same_values and same_text
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if check_round_trip(sys.argv[1:] or None) else 1)
@@ -0,0 +1,47 @@
+from collections import OrderedDict
+from threading import RLock
+
+
+def _nbytes(value):
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    return getattr(value, "nbytes", 0)
+
+
+class LRUCache:
+    def __init__(self, max_bytes=512*2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = RLock()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, value):
+        size = _nbytes(value)
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self.nbytes += size
+            # Always keep the newest entry, even if it alone is over budget
+            while self.nbytes > self.max_bytes and len(self._items) > 1:
+                _, (_, old) = self._items.popitem(last=False)
+                self.nbytes -= old
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
@@ -4,9 +4,17 @@ import mayavi.mlab as mlab
 from tvtk.util.ctf import ColorTransferFunction, PiecewiseFunction
 from matplotlib.pyplot import cm
 from math import exp
+import time
+import json
+from stages import stage, staged
 
-def _cmap_to_ctf(data, cmap_name):
-    values = list(np.linspace(np.nanmin(data), np.nanmax(data), 256))
+def _data_range(data, vrange=None):
+    if vrange is None:
+        return np.nanmin(data), np.nanmax(data)
+    return vrange
+
+def _cmap_to_ctf(data, cmap_name, vrange=None):
+    values = list(np.linspace(*_data_range(data, vrange), 256))
     colors = list(np.linspace(0, 1, 256))
     cmap = cm.get_cmap(cmap_name)(colors)
     transfer_function = ColorTransferFunction()
@@ -14,56 +22,191 @@ def _cmap_to_ctf(data, cmap_name):
         transfer_function.add_rgb_point(values[i], cmap[i, 0], cmap[i, 1], cmap[i, 2])
     return transfer_function
 
-def _modify_opacity(data, Squish, Disp):
-    values = list(np.linspace(np.nanmin(data), np.nanmax(data), 256))
+def _modify_opacity(data, Squish, Disp, vrange=None):
+    values = list(np.linspace(*_data_range(data, vrange), 256))
     opacities = list(np.linspace(0, 1, 256))
     otf = PiecewiseFunction()
     for i in range(255, -1, -1):
         otf.add_point(values[i], 1/(1+exp((-Squish)*(opacities[i]-Disp))))
     return otf
 
+def _set_transfer_functions(vol, vol_scalar, mpl_vol_cmap, squish, disp, ctf=None, otf=None, vrange=None):
+    if ctf is None:
+        ctf = _cmap_to_ctf(vol_scalar, mpl_vol_cmap, vrange)
+    if otf is None:
+        otf = _modify_opacity(vol_scalar, Squish=squish, Disp=disp, vrange=vrange)
+    vol._volume_property.set_color(ctf)
+    vol._ctf = ctf
+    vol.update_ctf = True
+    vol._otf = otf
+    vol._volume_property.set_scalar_opacity(otf)
+    return ctf, otf
+
+def _stats_ranges(stats):
+    # (volume, surface) ranges from a casestats sidecar (path or loaded dict)
+    if stats is None:
+        return None, None
+    if not isinstance(stats, dict):
+        with open(stats) as f:
+            stats = json.load(f)
+    fields = stats["fields"]
+    # None (each frame's own range) for a field that had no values
+    ranges = [(fields[name]["min"], fields[name]["max"]) if fields.get(name, {}).get("count") else None
+              for name in ("fire_smoke", "FIRE_AREA")]
+    return tuple(ranges)
+
+def _build_surface(x2, y2, z2, surf_scalar, mv_ter_cmap, r_mv_cmap, surf_range=None):
+    # Create the data source
+    src = mlab.pipeline.array2d_source(x2, y2, z2)
+
+    dataset = src.mlab_source.dataset
+    array_id = dataset.point_data.add_array(surf_scalar.T.ravel())
+    dataset.point_data.get_array(array_id).name = 'color'
+    dataset.point_data.update()
+
+    # Here, we build the very exact pipeline of surf, but add a
+    # set_active_attribute filter to switch the color, this is code very
+    # similar to the code introduced in:
+    # http://code.enthought.com/projects/mayavi/docs/development/html/mayavi/mlab.html#assembling-pipelines-with-mlab
+    warp = mlab.pipeline.warp_scalar(src, warp_scale=.5)
+    normals = mlab.pipeline.poly_data_normals(warp)
+    active_attr = mlab.pipeline.set_active_attribute(normals,
+                                                point_scalars='color')
+    surf = mlab.pipeline.surface(active_attr, colormap=mv_ter_cmap)
+    surf.module_manager.scalar_lut_manager.reverse_lut = r_mv_cmap
+    if not(surf_range is None):
+        surf.module_manager.scalar_lut_manager.use_default_range = False
+        surf.module_manager.scalar_lut_manager.data_range = surf_range
+    return src, surf
+
+def _set_view(view, frame_num, num_frames, figure=None):
+    a, e, d, f = view(frame_num, num_frames)
+    mlab.view(azimuth=a, elevation=e, distance=d, focalpoint=f, figure=figure)
+
+@staged("plot3d")
 def plot3d(x3, y3, z3, vol_scalar, x2, y2, z2, surf_scalar,
            view, frame_num, num_frames, squish=15, disp=0.5, 
            out_filename = None,
-           mpl_vol_cmap = "YlOrBr", mv_ter_cmap = "RdYlGn", r_mv_cmap = False):
+           mpl_vol_cmap = "YlOrBr", mv_ter_cmap = "RdYlGn", r_mv_cmap = False,
+           stats = None):
+    # stats: casestats sidecar (path or dict) to colour every frame with the
+    # run's global ranges instead of this frame's min/max
+    vol_range, surf_range = _stats_ranges(stats)
     # Plot scatter with mayavi
     figure = mlab.figure('DensityPlot', size =(1920, 1080))
     try:
-        grid = mlab.pipeline.scalar_field(x3, y3, z3, vol_scalar)
-        vol = mlab.pipeline.volume(grid)
-        ctf = _cmap_to_ctf(vol_scalar, mpl_vol_cmap)
-        vol._volume_property.set_color(ctf)
-        vol._ctf = ctf
-        vol.update_ctf = True
-        otf = _modify_opacity(vol_scalar, Squish=squish, Disp=disp)
-        vol._otf = otf
-        vol._volume_property.set_scalar_opacity(otf)
-
-        # Create the data source
-        src = mlab.pipeline.array2d_source(x2, y2, z2)
-
-        dataset = src.mlab_source.dataset
-        array_id = dataset.point_data.add_array(surf_scalar.T.ravel())
-        dataset.point_data.get_array(array_id).name = 'color'
-        dataset.point_data.update()
+        with stage("vtk_pipeline"):
+            grid = mlab.pipeline.scalar_field(x3, y3, z3, vol_scalar)
+            vol = mlab.pipeline.volume(grid)
+            _set_transfer_functions(vol, vol_scalar, mpl_vol_cmap, squish, disp, vrange=vol_range)
 
-        # Here, we build the very exact pipeline of surf, but add a
-        # set_active_attribute filter to switch the color, this is code very
-        # similar to the code introduced in:
-        # http://code.enthought.com/projects/mayavi/docs/development/html/mayavi/mlab.html#assembling-pipelines-with-mlab
-        warp = mlab.pipeline.warp_scalar(src, warp_scale=.5)
-        normals = mlab.pipeline.poly_data_normals(warp)
-        active_attr = mlab.pipeline.set_active_attribute(normals,
-                                                    point_scalars='color')
-        surf = mlab.pipeline.surface(active_attr, colormap=mv_ter_cmap)
-        surf.module_manager.scalar_lut_manager.reverse_lut = r_mv_cmap
+            _build_surface(x2, y2, z2, surf_scalar, mv_ter_cmap, r_mv_cmap, surf_range)
 
-        a, e, d, f = view(frame_num, num_frames)
-        mlab.view(azimuth=a, elevation=e, distance=d, focalpoint=f)
+        _set_view(view, frame_num, num_frames)
 
         if not(out_filename is None):
-            mlab.savefig(out_filename)
+            with stage("savefig"):
+                mlab.savefig(out_filename)
     except Exception:
         mlab.close(figure)
         raise
-    return figure
\ No newline at end of file
+    return figure
+
+
+class SmokeAnimation:
+    # Builds the plot3d scene once and then only swaps the data arrays,
+    # transfer functions and camera for each new frame.
+    def __init__(self, view, num_frames, squish=15, disp=0.5,
+                 mpl_vol_cmap = "YlOrBr", mv_ter_cmap = "RdYlGn", r_mv_cmap = False,
+                 stats = None):
+        self.view = view
+        self.fixed_vol_range, self.fixed_surf_range = _stats_ranges(stats)
+        self.num_frames = num_frames
+        self.squish = squish
+        self.disp = disp
+        self.mpl_vol_cmap = mpl_vol_cmap
+        self.mv_ter_cmap = mv_ter_cmap
+        self.r_mv_cmap = r_mv_cmap
+        self.figure = None
+        self.frame_times = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _build(self, x3, y3, z3, vol_scalar, x2, y2, z2, surf_scalar):
+        self.close()
+        self.figure = mlab.figure('DensityPlot', size =(1920, 1080))
+        try:
+            self._grid = mlab.pipeline.scalar_field(x3, y3, z3, vol_scalar)
+            self._vol = mlab.pipeline.volume(self._grid)
+            self._vol_range = _data_range(vol_scalar, self.fixed_vol_range)
+            self._ctf, self._otf = _set_transfer_functions(self._vol, vol_scalar, self.mpl_vol_cmap, self.squish, self.disp,
+                                                           vrange=self._vol_range)
+            self._src, self._surf = _build_surface(x2, y2, z2, surf_scalar, self.mv_ter_cmap, self.r_mv_cmap,
+                                                   self.fixed_surf_range)
+        except Exception:
+            self.close()
+            raise
+        self._shapes = (vol_scalar.shape, surf_scalar.shape)
+        self._x2, self._y2, self._z2 = x2, y2, z2
+
+    def _update(self, x3, y3, z3, vol_scalar, x2, y2, z2, surf_scalar):
+        self._grid.mlab_source.scalars = vol_scalar
+
+        vol_range = _data_range(vol_scalar, self.fixed_vol_range)
+        if vol_range != self._vol_range:
+            self._ctf, self._otf = _set_transfer_functions(self._vol, vol_scalar, self.mpl_vol_cmap, self.squish, self.disp,
+                                                           vrange=vol_range)
+            self._vol_range = vol_range
+        else:
+            # Data updates can reset the volume property, so re-attach the existing functions
+            _set_transfer_functions(self._vol, vol_scalar, self.mpl_vol_cmap, self.squish, self.disp, self._ctf, self._otf)
+
+        if not np.array_equal(z2, self._z2):
+            self._src.mlab_source.scalars = z2
+            self._z2 = z2
+        dataset = self._src.mlab_source.dataset
+        dataset.point_data.get_array('color').from_array(surf_scalar.T.ravel())
+        dataset.point_data.update()
+        dataset.modified()
+        self._src.mlab_source.update()
+        self._surf.module_manager.scalar_lut_manager.data_range = _data_range(surf_scalar, self.fixed_surf_range)
+
+    def screenshot(self):
+        # Current frame as (height, width, 3) uint8, straight from the render window
+        return mlab.screenshot(self.figure, mode='rgb', antialiased=False)
+
+    def render(self, frame_num, x3, y3, z3, vol_scalar, x2, y2, z2, surf_scalar, out_filename=None, sink=None):
+        # sink: a framesink sink that gets the raw frame instead of a saved image
+        t0 = time.perf_counter()
+        if self.figure is None or self._shapes != (vol_scalar.shape, surf_scalar.shape):
+            with stage("vtk_pipeline", frame=frame_num):
+                self._build(x3, y3, z3, vol_scalar, x2, y2, z2, surf_scalar)
+        else:
+            with stage("vtk_update", frame=frame_num):
+                self._update(x3, y3, z3, vol_scalar, x2, y2, z2, surf_scalar)
+
+        _set_view(self.view, frame_num, self.num_frames, self.figure)
+        if not(sink is None):
+            with stage("render", frame=frame_num):
+                self.figure.scene.render()
+            with stage("screenshot", frame=frame_num):
+                sink.write(self.screenshot())
+        elif not(out_filename is None):
+            with stage("savefig", frame=frame_num):
+                mlab.savefig(out_filename, figure=self.figure)
+        else:
+            with stage("render", frame=frame_num):
+                self.figure.scene.render()
+
+        elapsed = time.perf_counter() - t0
+        self.frame_times.append(elapsed)
+        return elapsed
+
+    def close(self):
+        if self.figure is not None:
+            mlab.close(self.figure)
+            self.figure = None
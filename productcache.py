@@ -0,0 +1,73 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from netCDF4 import Dataset
+
+from wrfout import NcFile
+
+
+class ProductCache:
+    # Derived per-file products (interpolated cubes etc.) stored as chunked,
+    # compressed netCDF4 next to the case. An entry is only used while the
+    # source wrfout's mtime/size and the settings it was built with match.
+    def __init__(self, root, complevel=4):
+        self.root = Path(root)
+        self.complevel = complevel
+
+    def path(self, source, product):
+        return self.root/"{}.{}.nc".format(Path(source).name, product)
+
+    @staticmethod
+    def _source_key(source):
+        st = Path(source).stat()
+        return json.dumps([st.st_mtime, st.st_size])
+
+    @staticmethod
+    def _settings_key(settings):
+        return json.dumps(settings, sort_keys=True, default=lambda a: np.asarray(a).tolist())
+
+    def valid(self, source, product, settings):
+        path = self.path(source, product)
+        if not path.exists():
+            return False
+        try:
+            with Dataset(path) as nc:
+                return nc.getncattr("source") == self._source_key(source) and \
+                       nc.getncattr("settings") == self._settings_key(settings)
+        except (OSError, AttributeError):
+            return False
+
+    def open(self, source, product, settings):
+        # Lazy reader over the entry (only the chunks actually indexed are
+        # read and decompressed), or None when there is no valid entry
+        if not self.valid(source, product, settings):
+            return None
+        return NcFile(self.path(source, product))
+
+    def put(self, source, product, settings, arrays, chunks=None):
+        # arrays: {name: (dims, ndarray)}; chunks: {name: chunk shape}
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = self.path(source, product)
+        tmp = path.with_name(path.name + ".{}.tmp".format(os.getpid()))
+        with Dataset(tmp, "w", format="NETCDF4") as nc:
+            nc.setncattr("source", self._source_key(source))
+            nc.setncattr("settings", self._settings_key(settings))
+            for name, (dims, data) in arrays.items():
+                data = np.ma.filled(np.ma.asarray(data, dtype=np.float32), np.nan)
+                for dim, size in zip(dims, data.shape):
+                    if dim not in nc.dimensions:
+                        nc.createDimension(dim, size)
+                var = nc.createVariable(name, "f4", dims, zlib=self.complevel > 0, complevel=max(self.complevel, 1),
+                                        shuffle=True, chunksizes=(chunks or {}).get(name), fill_value=False)
+                var[:] = data
+        # Atomic swap, so parallel renderers never see a half-written entry
+        os.replace(tmp, path)
+        return NcFile(path)
+
+    def get_or_compute(self, source, product, settings, compute, chunks=None):
+        entry = self.open(source, product, settings)
+        if entry is None:
+            entry = self.put(source, product, settings, compute(), chunks)
+        return entry
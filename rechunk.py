@@ -0,0 +1,252 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from netCDF4 import Dataset
+
+from stages import stage
+from wrfout import list_wrfout
+
+# Rewrites a case's wrfout files as compressed netCDF4 with chunks shaped for
+# how they get read, optionally keeping only some variables. The files keep
+# their names, dimensions and attributes, so everything that reads wrfout
+# (WrfoutFile, wrf-python) reads them the same way:
+#
+#   levels   one chunk per level of a 3D field: plotkvortw, kvort, level maps
+#   xz       one chunk per j slice (all levels): plotjvort, x-z cross sections
+#   columns  full-height columns in small horizontal tiles: soundings and
+#            other point/column extraction
+#
+# Time is always chunked one frame at a time.
+
+PRESETS = ("levels", "xz", "columns")
+
+# Variables each analysis reads (Times and XTIME are always kept)
+VARIABLE_SETS = {
+    "kvort": ["U", "V", "W"],
+    "jvort": ["U", "W", "PH", "PHB", "HGT"],
+    "smoke": ["fire_smoke", "FIRE_AREA", "PH", "PHB", "HGT"],
+    "columns": ["U", "V", "W", "T", "P", "PB", "QVAPOR", "PH", "PHB", "HGT", "PSFC", "T2", "Q2", "U10", "V10"],
+}
+ALWAYS = ("Times", "XTIME")
+
+
+def chunk_shape(var, preset, dims, tile=16):
+    # preset chunks for one variable; dims: {name: size} of the file, used to
+    # scale the column tiles on the fire subgrid by the refinement
+    chunks = []
+    vertical = any(d.startswith(("bottom_top", "soil_layers")) for d in var.dimensions)
+    for dim, size in zip(var.dimensions, var.shape):
+        if dim == "Time":
+            c = 1
+        elif dim.startswith(("bottom_top", "soil_layers")):
+            c = 1 if preset == "levels" else size
+        elif dim.startswith(("south_north", "west_east")):
+            mass = dims.get("south_north" if dim.startswith("south_north") else "west_east", size)
+            if preset == "columns":
+                c = tile*max(size//mass, 1)
+            elif preset == "xz" and vertical and dim.startswith("south_north"):
+                c = 1
+            else:
+                c = size
+        else:
+            c = size
+        chunks.append(max(1, min(c, size)))
+    return chunks
+
+
+def _variables(src, variables):
+    if variables is None:
+        return list(src.variables)
+    names = []
+    for v in variables:
+        names += VARIABLE_SETS.get(v, [v])
+    missing = [v for v in names if v not in src.variables]
+    if missing:
+        raise KeyError("not in {}: {}".format(src.filepath(), ", ".join(missing)))
+    return [v for v in src.variables if v in names or v in ALWAYS]
+
+
+def rechunk_file(src_path, dst_path, preset="levels", variables=None, complevel=4, significant_digits=None, tile=16):
+    # significant_digits: keep that many significant digits of the float
+    # fields (lossy, but compresses much better); None keeps them exact
+    if preset not in PRESETS:
+        raise ValueError("preset must be one of {}".format(", ".join(PRESETS)))
+    dst_path = Path(dst_path)
+    tmp = dst_path.with_name(dst_path.name + ".{}.tmp".format(os.getpid()))
+    with stage("rechunk", file=Path(src_path).name), Dataset(src_path) as src, \
+            Dataset(tmp, "w", format="NETCDF4") as dst:
+        dst.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+        dims = {name: len(dim) for name, dim in src.dimensions.items()}
+        names = _variables(src, variables)
+        used = {d for name in names for d in src[name].dimensions}
+        for name, dim in src.dimensions.items():
+            if name in used:
+                dst.createDimension(name, None if dim.isunlimited() else len(dim))
+        for name in names:
+            var = src[name]
+            var.set_auto_maskandscale(False)
+            attrs = {k: var.getncattr(k) for k in var.ncattrs()}
+            fill = attrs.pop("_FillValue", None)
+            if var.dtype.kind == "f":
+                # significant_digits only exists from netCDF4 1.6.0 (the env
+                # pins 1.5.7), so it's only passed when asked for
+                lossy = {} if significant_digits is None else {"significant_digits": significant_digits}
+                out = dst.createVariable(name, var.dtype, var.dimensions, zlib=complevel > 0,
+                                         complevel=max(complevel, 1), shuffle=True, fill_value=fill,
+                                         chunksizes=chunk_shape(var, preset, dims, tile), **lossy)
+            else:
+                out = dst.createVariable(name, var.dtype, var.dimensions, fill_value=fill)
+            out.set_auto_maskandscale(False)
+            out.setncatts(attrs)
+            # One frame at a time, so memory stays at one 3D field
+            if var.dimensions and var.dimensions[0] == "Time" and var.ndim > 1:
+                for t in range(var.shape[0]):
+                    out[t] = var[t]
+            else:
+                out[:] = var[:]
+    os.replace(tmp, dst_path)
+    return dst_path
+
+
+def verify_file(src_path, dst_path, significant_digits=None):
+    # Every variable of dst has to match src, exactly, or for files quantized
+    # to significant_digits to within that many digits of each frame's largest
+    # value (quantizing flushes values far below that to 0, which a relative
+    # tolerance alone would flag); returns the names that don't
+    rtol = 10.**(1 - significant_digits) if significant_digits else 0.
+    bad = []
+    with Dataset(src_path) as src, Dataset(dst_path) as dst:
+        for name, var in dst.variables.items():
+            a, b = src[name], var
+            a.set_auto_maskandscale(False)
+            b.set_auto_maskandscale(False)
+            if a.shape != b.shape or a.dtype != b.dtype:
+                bad.append(name)
+                continue
+            frames = range(a.shape[0]) if a.dimensions and a.dimensions[0] == "Time" and a.ndim > 1 else [slice(None)]
+            for t in frames:
+                x, y = a[t], b[t]
+                if rtol and x.dtype.kind == "f":
+                    scale = np.nanmax(np.abs(x)) if np.isfinite(x).any() else 0.
+                    same = np.allclose(x, y, rtol=rtol, atol=rtol*scale, equal_nan=True)
+                else:
+                    same = np.array_equal(x, y, equal_nan=x.dtype.kind == "f")
+                if not same:
+                    bad.append(name)
+                    break
+    return bad
+
+
+def _rechunk_task(args):
+    src, dst, kwargs, verify = args
+    t0 = time.perf_counter()
+    rechunk_file(src, dst, **kwargs)
+    elapsed = time.perf_counter() - t0
+    bad = verify_file(src, dst, kwargs.get("significant_digits")) if verify else []
+    return src, dst, elapsed, bad
+
+
+def rechunk_case(ncdir, outdir, preset="levels", variables=None, complevel=4, significant_digits=None, tile=16,
+                 processes=None, verify=True):
+    # Every wrfout in ncdir to outdir under the same name, in parallel.
+    # Returns [(src, dst, seconds, variables that failed verification)].
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    kwargs = {"preset": preset, "variables": variables, "complevel": complevel,
+              "significant_digits": significant_digits, "tile": tile}
+    tasks = [(src, outdir/src.name, kwargs, verify) for src in list_wrfout(ncdir)]
+    if processes == 1:
+        return list(map(_rechunk_task, tasks))
+    with ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(_rechunk_task, tasks))
+
+
+# Reads the plotting code does, by access pattern, at the i-th of n positions
+def _read_level(nc, i, n):
+    var = nc["U"]
+    return var[0, i*var.shape[1]//n]
+
+def _read_xz(nc, i, n):
+    var = nc["U"]
+    return var[0, :, i*var.shape[2]//n]
+
+def _read_column(nc, i, n):
+    out = []
+    for name in ("U", "V", "W", "PH", "PHB"):
+        if name in nc.variables:
+            var = nc[name]
+            out.append(var[0, :, i*var.shape[2]//n, (n-1-i)*var.shape[3]//n])
+    return out
+
+READS = {"levels": _read_level, "xz": _read_xz, "columns": _read_column}
+
+
+def _evict(path):
+    # Drop the file from the OS page cache so the next read comes from disk
+    # (Linux; elsewhere the cache stays warm)
+    if hasattr(os, "posix_fadvise"):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def read_times(path, n=10, repeat=3, cold=True):
+    # Mean time (s) per read of each access pattern over n positions in one
+    # open file, like a sweep does; best of repeat. cold: start every sweep
+    # with the file out of the page cache.
+    times = {}
+    for pattern, read in READS.items():
+        best = np.inf
+        for _ in range(repeat):
+            if cold:
+                _evict(path)
+            t0 = time.perf_counter()
+            with Dataset(path) as nc:
+                for i in range(n):
+                    read(nc, i, n)
+            best = min(best, (time.perf_counter() - t0)/n)
+        times[pattern] = best
+    return times
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rewrite a case's wrfout files chunked and compressed for one access pattern.")
+    parser.add_argument("ncdir")
+    parser.add_argument("outdir")
+    parser.add_argument("--preset", choices=PRESETS, default="levels")
+    parser.add_argument("--vars", nargs="+", help="variables or sets to keep ({}); default all".format(
+        ", ".join(VARIABLE_SETS)))
+    parser.add_argument("--complevel", type=int, default=4)
+    parser.add_argument("--digits", type=int, help="keep only this many significant digits (lossy)")
+    parser.add_argument("--tile", type=int, default=16, help="column tile size for --preset columns")
+    parser.add_argument("-j", "--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--no-verify", action="store_true")
+    parser.add_argument("--measure", action="store_true", help="compare sizes and read times with the originals")
+    args = parser.parse_args(argv)
+
+    results = rechunk_case(args.ncdir, args.outdir, args.preset, args.vars, args.complevel, args.digits, args.tile,
+                           args.processes, not args.no_verify)
+    failed = False
+    for src, dst, elapsed, bad in results:
+        status = "" if args.no_verify else " ok" if not bad else " MISMATCH in " + ", ".join(bad)
+        print("{} -> {} ({:.1f} s){}".format(src, dst, elapsed, status))
+        failed |= bool(bad)
+    if args.measure and results:
+        src_size = sum(Path(r[0]).stat().st_size for r in results)
+        dst_size = sum(Path(r[1]).stat().st_size for r in results)
+        print("size: {:.1f} MB -> {:.1f} MB ({:.1f}x smaller)".format(src_size/2**20, dst_size/2**20, src_size/dst_size))
+        before, after = read_times(results[0][0]), read_times(results[0][1])
+        for pattern in READS:
+            print("{:8s} read: {:8.2f} ms -> {:8.2f} ms ({:.1f}x)".format(
+                pattern, before[pattern]*1e3, after[pattern]*1e3, before[pattern]/after[pattern]))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,221 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
+from multiprocessing import get_context
+from pathlib import Path
+
+import mayavi.mlab as mlab
+
+import mayaviplot
+from casestats import case_stats, field_range
+from framesink import open_sink
+from productcache import ProductCache
+from smoke import smoke_and_area, aniFunc, crop_boxes
+from stages import stage, enable as enable_stages
+from wrfout import list_wrfout
+
+
+# One persistent scene per worker process, rebuilt only if the settings change
+_animation = None
+_animation_key = None
+
+
+def _init_worker():
+    # Every worker gets its own offscreen VTK render window
+    mlab.options.offscreen = True
+
+
+def _render_frame(case, file, frame, num_frames, out, plot_kwargs, product_cache, box=None, surface_px=None):
+    global _animation, _animation_key
+    key = (case, num_frames, sorted(plot_kwargs.items()))
+    if _animation is None or _animation_key != key:
+        if _animation is not None:
+            _animation.close()
+        _animation = mayaviplot.SmokeAnimation(aniFunc[case], num_frames, **plot_kwargs)
+        _animation_key = key
+    with stage("frame", frame=frame):
+        x3, y3, z3, smoke_interp, x2, y2, elevation, burn_area = smoke_and_area(
+            file, product_cache=product_cache, box=box, surface_px=surface_px)
+        if out is None:
+            # Video: hand the raw frame back to the parent, which writes them in order
+            elapsed = _animation.render(frame, x3, y3, z3, smoke_interp, x2, y2, elevation, burn_area)
+            with stage("screenshot"):
+                return frame, _animation.screenshot(), elapsed
+        elapsed = _animation.render(frame, x3, y3, z3, smoke_interp, x2, y2, elevation,
+                                    burn_area, out_filename=str(out))
+        return frame, out, elapsed
+
+
+def _up_to_date(out, file):
+    return out.exists() and out.stat().st_mtime >= file.stat().st_mtime
+
+
+class RenderLog:
+    # <outdir>/render.json: the settings the pngs in outdir were rendered
+    # with (camera path, num_frames, plot settings) and the frames done with
+    # them. When any setting changes, e.g. num_frames because the run got
+    # longer, every frame is rendered again.
+    def __init__(self, outdir, settings):
+        self.path = Path(outdir)/"render.json"
+        self.settings = json.loads(json.dumps(settings, sort_keys=True, default=str))
+        self.frames = set()
+        if self.path.exists():
+            with open(self.path) as f:
+                log = json.load(f)
+            if log.get("settings") == self.settings:
+                self.frames = set(log["frames"])
+
+    def done(self, frame, file, out):
+        return frame in self.frames and _up_to_date(out, file)
+
+    def record(self, frame):
+        self.frames.add(frame)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"settings": self.settings, "frames": sorted(self.frames)}, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+def pending_frames(case_dir, force=False, settings=None):
+    # (frames to render, num_frames, RenderLog); settings: whatever else the
+    # pngs depend on besides num_frames
+    case_dir = Path(case_dir)
+    files = list_wrfout(case_dir/"nc")
+    num_frames = max(len(files)-1, 1)
+    outdir = case_dir/"plots"/"smoke"
+    log = RenderLog(outdir, dict(settings or {}, num_frames=num_frames))
+    frames = [(frame, file, outdir/(str(frame) + ".png")) for frame, file in enumerate(files)]
+    if not force:
+        frames = [f for f in frames if not log.done(*f)]
+    return frames, num_frames, log
+
+
+def render_case(case_dir, case=None, processes=None, force=False, use_stats=True, cache_dir=None,
+                r_mv_cmap=True, squish=19.5, disp=0.5, video=None, fps=10, crop=None, surface_px=None,
+                **plot_kwargs):
+    # cache_dir: where interpolated smoke cubes are kept between runs
+    # (default <case>/cache, False to always recompute).
+    # video: an .mp4 etc. (piped through ffmpeg) or a directory for an
+    # uncompressed .ppm sequence, written instead of the per-frame pngs.
+    # crop: smoke threshold (or a dict of smoke.SmokeCrop arguments) to only
+    # interpolate/render the growing box around the smoke; surface_px: output
+    # width the fire area surface is decimated to
+    case_dir = Path(case_dir)
+    case = case_dir.name if case is None else case
+    if case not in aniFunc:
+        raise ValueError("no camera path for case {!r} in smoke.aniFunc".format(case))
+    plot_kwargs.update(r_mv_cmap=r_mv_cmap, squish=squish, disp=disp)
+    stats = ranges = None
+    if use_stats:
+        # Colour every frame with the run's global ranges (cached in the nc
+        # dir). The ranges are part of the settings, so when a rewritten file
+        # moves them every png is rendered again, not just that frame's.
+        stats = case_stats(case_dir/"nc", fields=("fire_smoke", "FIRE_AREA"), percentiles=())
+        ranges = {name: field_range(stats, name) for name in ("fire_smoke", "FIRE_AREA")}
+    settings = {"case": case, "plot_kwargs": plot_kwargs, "use_stats": use_stats, "stats_ranges": ranges,
+                "crop": crop, "surface_px": surface_px}
+    frames, num_frames, log = pending_frames(case_dir, force or video is not None, settings)
+    if video is not None:
+        frames = [(frame, file, None) for frame, file, _ in frames]
+    if stats is not None:
+        plot_kwargs["stats"] = stats
+    (case_dir/"plots"/"smoke").mkdir(parents=True, exist_ok=True)
+    if cache_dir is None:
+        cache_dir = case_dir/"cache"
+    product_cache = ProductCache(cache_dir) if cache_dir else None
+    boxes = {}
+    if crop is not None and frames:
+        # The boxes only grow, so they're worked out in time order before the
+        # frames are handed out
+        crop = crop if isinstance(crop, dict) else {"threshold": crop}
+        with stage("crop_boxes"):
+            boxes = dict(enumerate(crop_boxes(list_wrfout(case_dir/"nc"), **crop)))
+
+    done = []
+    render_times = []
+    # The sink is closed on success and aborted (ffmpeg stopped, partial
+    # video removed) if a frame fails
+    sink = open_sink(video, fps) if video is not None else None
+    # Frames rendering plus frames held for their turn in the video, so one
+    # slow early frame doesn't leave every later raw frame in memory
+    window = 2*(processes or os.cpu_count())
+    todo = iter(frames)
+    held = {}
+    # spawn, so no worker inherits a half-initialised VTK/GL context from the parent
+    with sink if sink is not None else nullcontext(), \
+            ProcessPoolExecutor(processes, mp_context=get_context("spawn"), initializer=_init_worker) as pool:
+        running = set()
+        while True:
+            while len(running) + len(held) < window:
+                item = next(todo, None)
+                if item is None:
+                    break
+                frame, file, out = item
+                running.add(pool.submit(_render_frame, case, file, frame, num_frames, out, plot_kwargs,
+                                        product_cache, boxes.get(frame), surface_px))
+            if not running:
+                break
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                frame, out, elapsed = future.result()
+                render_times.append(elapsed)
+                if sink is None:
+                    log.record(frame)
+                    done.append(out)
+                    continue
+                # Frames finish out of order; hold them until their turn
+                held[frame] = out
+                while sink.frames in held:
+                    with stage("encode", frame=sink.frames):
+                        sink.write(held.pop(sink.frames))
+    if sink is not None:
+        print("Wrote {} frames to {}".format(sink.frames, video))
+        return Path(video)
+    if render_times:
+        print("Finished Plotting: {} ({} frames rendered, {:.2f} s/frame render time)".format(
+            case_dir, len(done), sum(render_times)/len(render_times)))
+    else:
+        print("Finished Plotting: {} (up to date)".format(case_dir))
+    return sorted(done, key=lambda p: int(p.stem))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render the 3D smoke animation frames of one or more cases in parallel.")
+    parser.add_argument("cases", nargs="+", help="case names (creek, loyalton, tor) or case directories")
+    parser.add_argument("-j", "--processes", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--force", action="store_true", help="re-render frames whose png is already up to date")
+    parser.add_argument("--squish", type=float, default=19.5)
+    parser.add_argument("--disp", type=float, default=0.5)
+    parser.add_argument("--no-cache", action="store_true", help="don't read or write the <case>/cache smoke cubes")
+    parser.add_argument("--video", help="write <case>/plots/smoke.<VIDEO> (e.g. mp4) through ffmpeg, or a .ppm sequence "
+                                         "if VIDEO is 'ppm', instead of the per-frame pngs")
+    parser.add_argument("--fps", type=int, default=10)
+    parser.add_argument("--crop", type=float, metavar="THRESHOLD",
+                        help="only interpolate and render the (growing) box around smoke above THRESHOLD")
+    parser.add_argument("--surface-px", type=int, help="decimate the fire area surface to about this many points across")
+    parser.add_argument("--frame-range", action="store_true",
+                        help="scale colours to each frame's own min/max instead of the whole run's")
+    parser.add_argument("--stages", nargs="?", const="-", metavar="PATH",
+                        help="time every stage of every frame and print a summary at the end; with PATH also keep "
+                             "them as JSON lines (or a Chrome trace if PATH ends in .json)")
+    args = parser.parse_args(argv)
+    if args.stages:
+        enable_stages(None if args.stages == "-" else args.stages)
+
+    for case in args.cases:
+        case_dir = Path(case)
+        if not case_dir.is_dir():
+            case_dir = Path(__file__).resolve().parent/case
+        video = None
+        if args.video:
+            video = case_dir/"plots"/("smoke_ppm" if args.video == "ppm" else "smoke." + args.video)
+        render_case(case_dir, processes=args.processes, force=args.force, use_stats=not args.frame_range,
+                    cache_dir=False if args.no_cache else None,
+                    squish=args.squish, disp=args.disp, video=video, fps=args.fps,
+                    crop=args.crop, surface_px=args.surface_px)
+
+
+if __name__ == "__main__":
+    main()
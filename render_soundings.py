@@ -0,0 +1,137 @@
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from matplotlib import gridspec
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.ticker import ScalarFormatter, MultipleLocator
+
+warnings.filterwarnings("ignore")
+import sharppy.plot.skew as skew
+from skewx import SkewXAxes
+from sounding import _fmt, _sharppy_profile, sounding_indices, INDEX_FORMAT
+
+
+class SkewTRenderer:
+    # The SoundingData.plot layout, built once on a bare Agg figure. Each
+    # render() only swaps the line data, barbs, hodograph, title and index
+    # text, the grid/isotherms/axes/hodograph rings are reused.
+    def __init__(self, dpi=180, tight=True):
+        self.dpi = dpi
+        self.tight = tight
+        self.fig = Figure(figsize=(9, 8))
+        FigureCanvasAgg(self.fig)
+        # Margins given up front: gs.update only moves axes of pyplot figures
+        gs = gridspec.GridSpec(4, 4, figure=self.fig, width_ratios=[1, 5, 1, 1],
+                               left=0.05, bottom=0.05, top=0.95, right=1, wspace=0.025)
+        ax = self.fig.add_subplot(gs[0:3, 0:2], projection=SkewXAxes.name)
+        ax.grid(True)
+        self.tmpc, = ax.semilogy([], [], 'r', lw=2)
+        self.dwpc, = ax.semilogy([], [], 'g', lw=2)
+        self.vtmp, = ax.semilogy([], [], 'r--')
+        self.wetbulb, = ax.semilogy([], [], 'c-')
+        self.parcel, = ax.semilogy([], [], 'k--')
+        ax.axvline(0, color='b', ls='--')
+        ax.axvline(-20, color='b', ls='--')
+        ax.yaxis.set_major_formatter(ScalarFormatter())
+        ax.set_yticks(np.linspace(100, 1000, 10))
+        ax.set_ylim(1050, 100)
+
+        hodo = skew.draw_hodo_inset(ax, None)
+        self.hodo = [hodo.plot([], [], color + '-', lw=2)[0] for color in ['r', 'g', 'b', 'k']]
+
+        ax.xaxis.set_major_locator(MultipleLocator(10))
+        ax.set_xlim(-50, 50)
+        self.ax2 = self.fig.add_subplot(gs[0:3, 2])
+        ax3 = self.fig.add_subplot(gs[3, 0:3])
+        skew.plot_wind_axes(self.ax2)
+        self.barbs = None
+        ncols = -(-len(INDEX_FORMAT)//8)
+        self.text = [ax3.text(0.3*i, 1, '', verticalalignment='top', transform=ax3.transAxes, fontsize=11)
+                     for i in range(ncols)]
+        ax3.set_axis_off()
+        self.ax = ax
+        self.frame_times = []
+
+    def _update(self, prof, title, values):
+        self.ax.set_title(title, fontsize=14, loc='left')
+        self.tmpc.set_data(prof.tmpc[~prof.tmpc.mask], prof.pres[~prof.tmpc.mask])
+        self.dwpc.set_data(prof.dwpc[~prof.dwpc.mask], prof.pres[~prof.dwpc.mask])
+        self.vtmp.set_data(prof.vtmp[~prof.dwpc.mask], prof.pres[~prof.dwpc.mask])
+        self.wetbulb.set_data(prof.wetbulb[~prof.dwpc.mask], prof.pres[~prof.dwpc.mask])
+        try:
+            self.parcel.set_data(prof.mupcl.ttrace, prof.mupcl.ptrace)
+        except:
+            self.parcel.set_data([], [])
+
+        # Same segments as skew.plotHodo
+        for line, min_hght in zip(self.hodo, [3000, 6000, 9000, 12000]):
+            seg = np.where((prof.hght <= min_hght) & (prof.hght >= min_hght - 3000))[0]
+            line.set_data([], [])
+            if len(seg) == 0:
+                continue
+            seg = np.append(seg, seg[-1] + 1)
+            try:
+                line.set_data(prof.u[seg][~prof.u.mask[seg]], prof.v[seg][~prof.v.mask[seg]])
+            except:
+                continue
+
+        # One Barbs artist for all levels instead of one per level
+        if self.barbs is not None:
+            self.barbs.remove()
+        keep = (prof.pres > skew.pt_plot) & ~np.ma.getmaskarray(prof.v)
+        self.barbs = self.ax2.barbs(np.zeros(keep.sum()), np.ma.getdata(prof.pres)[keep], np.ma.getdata(prof.u)[keep],
+                                    np.ma.getdata(prof.v)[keep], length=7, clip_on=False, linewidth=1)
+
+        keys = np.sort(list(INDEX_FORMAT))
+        lines = [key + ': ' + str(_fmt(values[key], INDEX_FORMAT[key][1])) + ' ' + INDEX_FORMAT[key][0] + '\n'
+                 for key in keys]
+        for i, text in enumerate(self.text):
+            text.set_text(''.join(lines[8*i:8*i+8]))
+
+    def render(self, prof, filename, title='', values=None):
+        t0 = time.perf_counter()
+        self._update(prof, title, sounding_indices(prof) if values is None else values)
+        self.fig.savefig(filename, bbox_inches='tight' if self.tight else None, dpi=self.dpi)
+        elapsed = time.perf_counter() - t0
+        self.frame_times.append(elapsed)
+        return elapsed
+
+
+# One renderer per worker process
+_renderer = None
+
+
+def _render(args):
+    global _renderer
+    profile_args, filename, title, dpi = args
+    if _renderer is None or _renderer.dpi != dpi:
+        _renderer = SkewTRenderer(dpi)
+    prof = _sharppy_profile(*profile_args)
+    values = sounding_indices(prof)
+    _renderer.render(prof, filename, title, values)
+    return filename, {key: values[key] for key in INDEX_FORMAT}
+
+
+def render_soundings(profile_args, filenames, titles=None, processes=None, dpi=180, chunksize=4):
+    # profile_args: SoundingData._profile_args(date) / SoundingEnsemble._profile_args(i)
+    # per sounding. Returns the indices of each sounding, in order.
+    titles = [''] * len(filenames) if titles is None else titles
+    jobs = [(a, str(f), t, dpi) for a, f, t in zip(profile_args, filenames, titles)]
+    if processes == 1:
+        return [values for _, values in map(_render, jobs)]
+    with ProcessPoolExecutor(processes) as pool:
+        return [values for _, values in pool.map(_render, jobs, chunksize=chunksize)]
+
+
+def render_ensemble(ensemble, outdir, titles=None, processes=None, dpi=180):
+    # outdir/<member>.png for every member of a SoundingEnsemble
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    filenames = [outdir/"{}.png".format(i) for i in range(len(ensemble))]
+    render_soundings((ensemble._profile_args(i) for i in range(len(ensemble))), filenames,
+                     titles, processes, dpi)
+    return filenames
@@ -0,0 +1,392 @@
+import io
+import threading
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+import matplotlib.pyplot as plt
+import PIL.Image
+from matplotlib.artist import Artist
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import BoundaryNorm
+from matplotlib.figure import Figure
+
+from casestats import field_range
+from lru import LRUCache
+from smoke import SMOKE_SETTINGS
+from stages import stage
+from vinterp import Weights, SMOKE_LEVELS, JVORT_LEVELS
+from vort import _kvort_box, _vort_decorate, _w_contours, interp_uw, jvort3d, KVORTW_TITLE, JVORT_TITLE
+from wrfout import WrfoutCase
+
+# Scrubbing through a case in a notebook with sliders for time, level and
+# j slice, instead of writing a png per frame:
+#
+#     from scrub import ScrubViewer
+#     ScrubViewer("creek/nc").show()
+#
+# Views, and what the level/j index means for each:
+#   kvortw  k vorticity (shaded) and w (contours) on model level k
+#   jvort   j vorticity on the height levels of x-z slice j
+#   smoke   fire_smoke on height level SMOKE_LEVELS[k]
+# Every 2D field is computed from only the slab of the file it needs, kept
+# in an LRU cache, and the neighbouring frames and levels are computed on a
+# background thread while the current one is on screen. The figure is built
+# once per view; a step only swaps the image data (and w contours).
+
+VIEWS = ("kvortw", "jvort", "smoke")
+
+
+class FieldCache:
+    # 2D fields by (view, frame, index), computed on first use and kept
+    # under max_bytes. prefetch() queues keys for a background thread; it
+    # and get() take turns on the files, since netCDF can't be read from two
+    # threads at once. product_cache: a ProductCache whose smoke/uw entries
+    # are read instead when they exist. max_open: how many frames' files are
+    # kept open, least recently used closed first.
+    def __init__(self, case, max_bytes=512*2**20, product_cache=None, max_open=8):
+        self.case = case if isinstance(case, WrfoutCase) else WrfoutCase(case)
+        if not len(self.case):
+            raise ValueError("no wrfout files in {}".format(self.case.ncdir))
+        self.product_cache = product_cache
+        self._lru = LRUCache(max_bytes)
+        self._files = OrderedDict()
+        self.max_open = max(max_open, 1)
+        self._io = threading.Lock()
+        self._wanted = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        with self._io:
+            wf = self._file(0)
+            self.nx, self.ny, self.nz, self.dx, self.dy = wf.nx, wf.ny, wf.nz, wf.dx, wf.dy
+        self._thread = threading.Thread(target=self._prefetch_loop, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def frames(self):
+        return len(self.case)
+
+    @property
+    def cached(self):
+        # (fields, bytes) in the cache
+        return len(self._lru), self._lru.nbytes
+
+    def size(self, view):
+        # Number of levels (or j slices) of a view
+        return {"kvortw": self.nz, "jvort": self.ny, "smoke": len(SMOKE_LEVELS)}[view]
+
+    def _file(self, t):
+        # Kept open while it's in use, since reopening costs more than reading
+        # a level. Only called with the io lock held, so a file is never
+        # closed under another read.
+        if t in self._files:
+            self._files.move_to_end(t)
+        else:
+            self._files[t] = self.case[t]
+            while len(self._files) > self.max_open:
+                self._files.popitem(last=False)[1].close()
+        return self._files[t]
+
+    def _kvortw(self, t, k):
+        wf = self._file(t)
+        avo = _kvort_box(wf, [k], (0, self.nx, 0, self.ny))[0]
+        with stage("read"):
+            w = np.ma.filled(wf.level("W", k), np.nan)
+        return avo.astype(np.float32), w.astype(np.float32)
+
+    def _jvort(self, t, j):
+        wf = self._file(t)
+        U, W = interp_uw(wf, slices=[j], product_cache=self.product_cache)
+        with stage("curl"):
+            avo = jvort3d(U, W, self.dx, JVORT_LEVELS[1] - JVORT_LEVELS[0])[0]
+        # (levels, x), for imshow
+        return avo.T.astype(np.float32)
+
+    def _height(self, t):
+        key = ("height", t)
+        hgt = self._lru.get(key)
+        if hgt is None:
+            with stage("height"):
+                hgt = self._lru.put(key, self._file(t).height_agl())
+        return hgt
+
+    def _smoke(self, t, k):
+        wf = self._file(t)
+        entry = None if self.product_cache is None else self.product_cache.open(wf.path, "smoke", SMOKE_SETTINGS)
+        if entry is not None:
+            with stage("cache_read"), entry:
+                return np.ma.filled(entry.read("smoke", k), np.nan).astype(np.float32)
+        weights = Weights(self._height(t), SMOKE_LEVELS[k:k+1])
+        # Only the model levels around that height
+        levels, weights = weights.window()
+        with stage("read"):
+            smoke = wf.read("fire_smoke", levels)
+        with stage("interp"):
+            return weights.interp(smoke)[0].astype(np.float32)
+
+    def get(self, view, t, index):
+        key = (view, t, index)
+        value = self._lru.get(key)
+        if value is None:
+            with self._io:
+                # The prefetch thread may have just made it
+                value = self._lru.get(key)
+                if value is None:
+                    with stage("scrub_" + view, frame=t, index=index):
+                        compute = {"kvortw": self._kvortw, "jvort": self._jvort, "smoke": self._smoke}[view]
+                        value = self._lru.put(key, compute(t, index))
+        return value
+
+    def neighbours(self, view, t, index, reach=3):
+        # Keys around (t, index), nearest first, alternating time and index
+        keys = []
+        for d in range(1, reach+1):
+            for tt, ii in ((t+d, index), (t, index+d), (t-d, index), (t, index-d)):
+                if 0 <= tt < self.frames and 0 <= ii < self.size(view):
+                    keys.append((view, tt, ii))
+        return keys
+
+    def prefetch(self, keys):
+        # Replaces whatever was still queued, so scrubbing on doesn't leave a
+        # backlog of fields nobody is looking at any more
+        with self._cond:
+            self._wanted = deque(key for key in keys if key not in self._lru)
+            self._cond.notify()
+
+    def _prefetch_loop(self):
+        while True:
+            with self._cond:
+                while not self._wanted and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                key = self._wanted.popleft()
+            try:
+                self.get(*key)
+            except Exception:
+                # Raised again if it's ever asked for for real
+                pass
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        with self._io:
+            for wf in self._files.values():
+                wf.close()
+            self._files.clear()
+        self._lru.clear()
+
+
+def _contour_artists(layer):
+    # A ContourSet is one artist since matplotlib 3.8, a list of collections before
+    artists = [layer] if isinstance(layer, Artist) else list(layer.collections)
+    artists += getattr(layer, "labelTexts", [])
+    for a in artists:
+        a.set_animated(True)
+    return artists
+
+
+def _vort_image(ax, shape, extent):
+    cmap = plt.get_cmap("bwr").with_extremes(over='darkred', under='darkblue')
+    norm = BoundaryNorm(np.linspace(-0.2, 0.2, 33), cmap.N, extend='both')
+    return ax.imshow(np.zeros(shape), cmap=cmap, norm=norm, origin="lower", extent=extent, interpolation="nearest")
+
+
+class ScrubViewer:
+    # stats: a casestats dict, to fix the smoke colour range to the run's
+    # 99th percentile (otherwise it grows with the largest value shown)
+    def __init__(self, case, view="kvortw", max_bytes=512*2**20, product_cache=None, stats=None, reach=3, dpi=72):
+        if view not in VIEWS:
+            raise ValueError("view must be one of {}".format(", ".join(VIEWS)))
+        # Files open for the frames prefetched around the current one, and one more
+        self.fields = FieldCache(case, max_bytes, product_cache, max_open=2*reach + 2)
+        self.view = view
+        self.reach = reach
+        self.dpi = dpi
+        smoke_range = field_range(stats, "fire_smoke", hi=99) if stats else None
+        self._fixed_smoke_range = smoke_range is not None
+        self.smoke_range = smoke_range or (0., 0.)
+        self.t = 0
+        self.index = {"kvortw": 0, "jvort": self.fields.ny//2, "smoke": 0}
+        self._figures = {}
+        self._backgrounds = {}
+        self._contours = []
+        self._syncing = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _figure(self, view):
+        if view in self._figures:
+            return self._figures[view]
+        f = self.fields
+        if view == "jvort":
+            dz = JVORT_LEVELS[1] - JVORT_LEVELS[0]
+            shape, extent = (len(JVORT_LEVELS), f.nx), (0, f.nx*f.dx, JVORT_LEVELS[0] - dz/2, JVORT_LEVELS[-1] + dz/2)
+            figsize = (10, 6)
+        else:
+            shape, extent = (f.ny, f.nx), (0, f.nx*f.dx, 0, f.ny*f.dy)
+            figsize = (8*f.nx/f.ny, 8)
+        fig = Figure(figsize=figsize, dpi=self.dpi, layout="constrained")
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        if view == "smoke":
+            image = ax.imshow(np.zeros(shape), cmap="YlOrBr", origin="lower", extent=extent, interpolation="nearest")
+            cb = fig.colorbar(image, orientation='horizontal', fraction=0.05, pad=0.075, shrink=0.8)
+            cb.set_label(label='fire_smoke (g kg$^{-1}$)', size=12, weight='bold')
+            ax.set_aspect('equal')
+            ax.set_xlabel("x coordinate (m)", size=10)
+            ax.set_ylabel("y coordinate (m)", size=10)
+            image.set_clim(*self.smoke_range)
+        else:
+            image = _vort_image(ax, shape, extent)
+            title, ylabel = (KVORTW_TITLE, "y coordinate (m)") if view == "kvortw" else (JVORT_TITLE, "z coordinate (m)")
+            _vort_decorate(fig, ax, image, title, ylabel)
+            ax.title.set_size(11)
+        # Placeholder text, so the layout leaves room for the label
+        label = fig.suptitle(self._label(view, 0, 0), x=0.01, ha="left", size=12, weight="bold")
+        # The image and label are drawn over a saved background of the
+        # rest, which is laid out once and then kept as it is
+        image.set_animated(True)
+        label.set_animated(True)
+        fig.canvas.draw()
+        fig.set_layout_engine("none")
+        xm, ym = np.meshgrid(np.arange(f.nx)*f.dx, np.arange(f.ny)*f.dy)
+        self._figures[view] = (fig, ax, image, label, xm, ym)
+        self._backgrounds[view] = fig.canvas.copy_from_bbox(fig.bbox)
+        return self._figures[view]
+
+    def _label(self, view, t, index):
+        time = self.fields.case.times[t]
+        if view == "kvortw":
+            where = "model level {}".format(index)
+        elif view == "jvort":
+            where = "j = {}".format(index)
+        else:
+            where = "{:g} m AGL".format(SMOKE_LEVELS[index])
+        return "frame {}  {}  {}".format(t, time.strftime("%H:%M:%S"), where)
+
+    def render(self, view=None, t=None, index=None):
+        # PNG bytes of one step (defaults: the current one), then queues its
+        # neighbours for prefetching
+        view = self.view if view is None else view
+        t = self.t if t is None else t
+        index = self.index[view] if index is None else index
+        data = self.fields.get(view, t, index)
+        fig, ax, image, label, xm, ym = self._figure(view)
+        with stage("scrub_draw"):
+            for layer in self._contours:
+                for text in getattr(layer, "labelTexts", []):
+                    text.remove()
+                getattr(layer, "labelTexts", []).clear()
+                layer.remove()
+            self._contours = []
+            if view == "kvortw":
+                avo, w = data
+                image.set_data(avo)
+                self._contours = _w_contours(ax, xm, ym, np.nan_to_num(w))
+            else:
+                image.set_data(data)
+                if view == "smoke" and not self._fixed_smoke_range and np.nanmax(data) > self.smoke_range[1]:
+                    self.smoke_range = (0., float(np.nanmax(data)))
+                    image.set_clim(*self.smoke_range)
+                    # New colorbar, new background
+                    fig.canvas.draw()
+                    self._backgrounds[view] = fig.canvas.copy_from_bbox(fig.bbox)
+            label.set_text(self._label(view, t, index))
+            fig.canvas.restore_region(self._backgrounds[view])
+            contours = [a for layer in self._contours for a in _contour_artists(layer)]
+            for artist in [image] + contours + list(ax.spines.values()) + [label]:
+                fig.draw_artist(artist)
+        with stage("scrub_png"):
+            buf = io.BytesIO()
+            PIL.Image.fromarray(np.asarray(fig.canvas.buffer_rgba())).save(buf, format="png", compress_level=1)
+        self.fields.prefetch(self.fields.neighbours(view, t, index, self.reach))
+        return buf.getvalue()
+
+    def widget(self):
+        import ipywidgets as widgets
+        f = self.fields
+        self.image = widgets.Image(format="png")
+        self.view_buttons = widgets.ToggleButtons(options=VIEWS, value=self.view)
+        self.time_slider = widgets.IntSlider(value=self.t, min=0, max=f.frames-1, description="frame")
+        self.level_slider = widgets.IntSlider(value=0, min=0, max=f.size("kvortw")-1, description="level")
+        self.j_slider = widgets.IntSlider(value=self.index["jvort"], min=0, max=f.ny-1, description="j")
+        self.timing = widgets.Label()
+        self._sync_sliders()
+        for w in (self.view_buttons, self.time_slider, self.level_slider, self.j_slider):
+            w.observe(self._changed, names="value")
+        try:
+            from ipyevents import Event
+        except ImportError:
+            pass
+        else:
+            # Arrow keys over the image: left/right for time, up/down for level or j
+            self._events = Event(source=self.image, watched_events=["keydown"], prevent_default_action=True)
+            self._events.on_dom_event(self._key)
+        self._update()
+        return widgets.VBox([self.view_buttons, widgets.HBox([self.time_slider, self.level_slider, self.j_slider]),
+                             self.image, self.timing])
+
+    def show(self):
+        from IPython.display import display
+        display(self.widget())
+
+    def _index_slider(self):
+        return self.j_slider if self.view == "jvort" else self.level_slider
+
+    def _sync_sliders(self):
+        self._syncing = True
+        try:
+            if self.view != "jvort":
+                self.level_slider.max = self.fields.size(self.view) - 1
+                self.level_slider.value = self.index[self.view]
+            self.level_slider.disabled = self.view == "jvort"
+            self.j_slider.disabled = self.view != "jvort"
+        finally:
+            self._syncing = False
+
+    def _changed(self, change):
+        if self._syncing:
+            return
+        if change["owner"] is self.view_buttons:
+            self.view = change["new"]
+            self._sync_sliders()
+        else:
+            self.t = self.time_slider.value
+            self.index[self.view] = self._index_slider().value
+        self._update()
+
+    def _key(self, event):
+        key = event.get("key")
+        if key in ("ArrowLeft", "ArrowRight"):
+            slider, step = self.time_slider, 1 if key == "ArrowRight" else -1
+        elif key in ("ArrowUp", "ArrowDown"):
+            slider, step = self._index_slider(), 1 if key == "ArrowUp" else -1
+        else:
+            return
+        slider.value = min(max(slider.value + step, slider.min), slider.max)
+
+    def _update(self):
+        t0 = time.perf_counter()
+        self.image.value = self.render()
+        count, nbytes = self.fields.cached
+        self.timing.value = "{:.0f} ms, {} fields cached ({:.0f} MB)".format(
+            (time.perf_counter() - t0)*1e3, count, nbytes/2**20)
+
+    def close(self):
+        self.fields.close()
+        for fig, *_ in self._figures.values():
+            fig.clear()
+        self._figures.clear()
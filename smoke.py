@@ -0,0 +1,253 @@
+from pathlib import Path
+
+import numpy as np
+
+from stages import stage
+from vinterp import Weights, SMOKE_LEVELS
+from wrfout import WrfoutFile
+
+
+def root_transform(frame, max, root=2):
+    return np.power(frame/max, 1/root)
+
+
+def smoke_cube(wf, weights_cache=None, box=None):
+    # box: (number of levels, j0, j1, i0, i1) to only interpolate that sub-volume
+    if box is not None:
+        nl, js, is_ = _box_slices(box)
+        with stage("height"):
+            weights = Weights(wf.height_agl(js, is_), SMOKE_LEVELS[:nl])
+        with stage("read"):
+            smoke = wf.read("fire_smoke", slice(None), js, is_)
+        with stage("interp"):
+            return weights.interp(smoke)
+    with stage("height"):
+        if weights_cache is None:
+            # wrf-python only here, like vinterp.WeightsCache.height
+            from wrf import getvar, to_np
+            weights = Weights(to_np(getvar(wf.nc, 'height_agl', timeidx=wf.timeidx, units='m')), SMOKE_LEVELS)
+        else:
+            weights = weights_cache.weights(wf.nc, SMOKE_LEVELS, wf.timeidx)
+    with stage("read"):
+        smoke = wf.read("fire_smoke")
+    with stage("interp"):
+        return weights.interp(smoke)
+
+
+# Bump the version when the way the cube is built changes, to invalidate cached products
+SMOKE_SETTINGS = {"levels": SMOKE_LEVELS, "version": 1}
+
+
+def _smoke_product(wf, weights_cache):
+    return {
+        "smoke": (("level", "south_north", "west_east"), smoke_cube(wf, weights_cache)),
+        "fire_area": (("south_north_subgrid", "west_east_subgrid"), wf.fire_area()),
+    }
+
+
+def _box_slices(box):
+    nl, j0, j1, i0, i1 = box
+    return nl, slice(j0, j1), slice(i0, i1)
+
+
+def smoke_extent(wf, threshold):
+    # (levels needed, j0, j1, i0, i1) around every voxel with more than
+    # threshold smoke, from the model levels, or None if there are none
+    above = np.ma.filled(wf.read("fire_smoke"), 0) > threshold
+    cols = above.any(axis=0)
+    if not cols.any():
+        return None
+    js = np.flatnonzero(cols.any(axis=1))
+    is_ = np.flatnonzero(cols.any(axis=0))
+    j0, j1, i0, i1 = js[0], js[-1]+1, is_[0], is_[-1]+1
+    # Height levels up to the model level above the highest smoky one
+    ktop = min(np.flatnonzero(above.any(axis=(1, 2)))[-1] + 1, wf.nz - 1)
+    top = wf.height_agl(slice(j0, j1), slice(i0, i1))[ktop].max()
+    return (int(np.searchsorted(SMOKE_LEVELS, top, side="right")), int(j0), int(j1), int(i0), int(i1))
+
+
+def _fire_extent(wf):
+    # The burning/burnt area on the mass grid, to seed the box before there is any smoke
+    sr_x, sr_y = wf.refinement
+    burnt = np.ma.filled(wf.fire_area(), 0) > 0
+    if not burnt.any():
+        return None
+    js = np.flatnonzero(burnt.any(axis=1))//sr_y
+    is_ = np.flatnonzero(burnt.any(axis=0))//sr_x
+    return (2, int(js[0]), int(js[-1])+1, int(is_[0]), int(is_[-1])+1)
+
+
+class SmokeCrop:
+    # The part of the smoke cube worth interpolating and rendering: the box
+    # around all smoke above threshold seen so far, padded by pad cells and
+    # rounded out to multiples of step (levels by level_step). It only grows,
+    # so the scene changes shape rarely and nothing already drawn is cut off.
+    # Feed it the frames in time order.
+    def __init__(self, threshold=1e-3, pad=4, step=16, level_step=8):
+        self.threshold = threshold
+        self.pad = pad
+        self.step = step
+        self.level_step = level_step
+        self.box = None
+
+    def _round(self, lo, hi, n, step):
+        lo = max(lo - self.pad, 0)//step*step
+        hi = min(-(-(hi + self.pad)//step)*step, n)
+        return lo, hi
+
+    def update(self, wf):
+        extent = smoke_extent(wf, self.threshold)
+        if extent is None and self.box is None:
+            extent = _fire_extent(wf)
+        if extent is None:
+            # Nothing to show yet: a small empty corner, not kept as the box
+            return self.box or (2, 0, min(self.step, wf.ny), 0, min(self.step, wf.nx))
+        nl, j0, j1, i0, i1 = extent
+        nl = min(max(-(-nl//self.level_step)*self.level_step, 2), len(SMOKE_LEVELS))
+        j0, j1 = self._round(j0, j1, wf.ny, self.step)
+        i0, i1 = self._round(i0, i1, wf.nx, self.step)
+        if self.box is not None:
+            bl, bj0, bj1, bi0, bi1 = self.box
+            nl, j0, j1, i0, i1 = max(nl, bl), min(j0, bj0), max(j1, bj1), min(i0, bi0), max(i1, bi1)
+        self.box = (nl, j0, j1, i0, i1)
+        return self.box
+
+
+def crop_boxes(files, **kwargs):
+    # SmokeCrop box of every file, in the given (time) order
+    crop = SmokeCrop(**kwargs)
+    boxes = []
+    for file in files:
+        with WrfoutFile(file) as wf:
+            boxes.append(crop.update(wf))
+    return boxes
+
+
+def _halve(a):
+    # 2x2 block means, repeating the last row/column of odd sizes
+    a = np.pad(a, [(0, n % 2) for n in a.shape], mode="edge")
+    return 0.25*(a[0::2, 0::2] + a[1::2, 0::2] + a[0::2, 1::2] + a[1::2, 1::2])
+
+
+def area_pyramid(area, levels):
+    # [area, area at 1/2, 1/4, ...], levels+1 entries
+    pyramid = [np.asarray(np.ma.filled(area, 0), dtype=np.float64)]
+    for _ in range(levels):
+        pyramid.append(_halve(pyramid[-1]))
+    return pyramid
+
+
+def pyramid_level(n, out_px):
+    # Coarsest level that still has at least out_px points across n
+    return max(int(np.floor(np.log2(n/out_px))), 0) if out_px else 0
+
+
+def smoke_and_area(file, weights_cache=None, product_cache=None, box=None, surface_px=None):
+    # box: a SmokeCrop box to interpolate and return only that sub-volume;
+    # surface_px: output width in pixels, to return the fire area surface at
+    # the coarsest pyramid level that still resolves it
+    with stage("smoke_and_area", file=Path(file).name), WrfoutFile(file) as wf:
+        dx, dy = wf.dx, wf.dy
+        nx, ny = wf.nx, wf.ny
+        sr_x, sr_y = wf.refinement
+        entry = None
+        if product_cache is not None:
+            # With a box, only use a cube that's already there; computing the
+            # whole domain would defeat the point
+            entry = product_cache.get_or_compute(file, "smoke", SMOKE_SETTINGS, lambda: _smoke_product(wf, weights_cache)) \
+                if box is None else product_cache.open(file, "smoke", SMOKE_SETTINGS)
+        if entry is not None:
+            with stage("cache_read"), entry:
+                if box is None:
+                    smoke_interp = entry.read("smoke")
+                else:
+                    nl, js, is_ = _box_slices(box)
+                    smoke_interp = entry.read("smoke", slice(0, nl), js, is_)
+                burn_area = entry.read("fire_area")
+        else:
+            smoke_interp = smoke_cube(wf, weights_cache, box)
+            with stage("fire_area"):
+                burn_area = wf.fire_area()
+        with stage("grids"):
+            smoke_interp = smoke_interp.transpose(2, 1, 0)
+            burn_area = burn_area.transpose(1, 0)
+            num_x, num_y, nl = smoke_interp.shape
+            j0, i0 = (0, 0) if box is None else (box[1], box[3])
+            xi, yi, zi = np.mgrid[0:num_x, 0:num_y, 0:nl]
+            x3, y3, z3 = (i0 + xi)*dx, (j0 + yi)*dy, SMOKE_LEVELS[zi]
+            x2, y2 = np.mgrid[0:nx*dx:dx/sr_x, 0:ny*dy:dy/sr_y]
+            level = pyramid_level(burn_area.shape[0], surface_px)
+            if level:
+                burn_area = area_pyramid(burn_area, level)[-1]
+                x2, y2 = area_pyramid(x2, level)[-1], area_pyramid(y2, level)[-1]
+            elevation= 0*x2
+    return (x3, y3, z3, smoke_interp, x2, y2, elevation, burn_area)
+
+
+def max_smoke_by_height(case, weights_cache=None, prefetch=1):
+    # Max smoke on each height level for every frame of a WrfoutCase, one
+    # frame in memory at a time while the next one is read in the background
+    times, maxima = [], []
+    for t, cube in case.stream(lambda wf: smoke_cube(wf, weights_cache), prefetch):
+        times.append(t)
+        maxima.append(np.nanmax(cube, axis=(1, 2)))
+    return times, np.array(maxima)
+
+
+# Camera paths for each case: view(frame, num_frames) -> (azimuth, elevation, distance, focalpoint)
+def animateCreekSmoke(frame, num_frames, azumith, elevation, distance, focalpoint):
+    azumith -= 45*root_transform(frame, num_frames, 4)
+    elevation += 60*root_transform(frame, num_frames, 4)
+    distance += 3000*root_transform(frame, num_frames, 4)
+    focalpoint[0] += 600*root_transform(frame, num_frames, 4)
+    focalpoint[1] += 30*root_transform(frame, num_frames, 4)
+    focalpoint[2] += 900*root_transform(frame, num_frames, 4)
+    return (azumith, elevation, distance, focalpoint)
+
+def creekViewSmoke(frame, num_frames):
+    azumith = 315
+    elevation = 30
+    distance = 2000
+    focalpoint = [5000, 2000, 0]
+    a, e, d, f = animateCreekSmoke(frame, num_frames, azumith, elevation, distance, focalpoint)
+    return (a, e, d, f)
+
+def animateLoyaltonSmoke(frame, num_frames, azumith, elevation, distance, focalpoint):
+    azumith += 120*root_transform(frame, num_frames, 4)
+    elevation += 60*root_transform(frame, num_frames, 4)
+    distance += 5000*root_transform(frame, num_frames, 4)
+    focalpoint[0] += 1200*root_transform(frame, num_frames, 4)
+    focalpoint[1] += 1200*root_transform(frame, num_frames, 4)
+    focalpoint[2] += 1000*root_transform(frame, num_frames, 4)
+    return (azumith, elevation, distance, focalpoint)
+
+def loyaltonViewSmoke(frame, num_frames):
+    azumith = 225
+    elevation = 30
+    distance = 2000
+    focalpoint = [2000, 2000, 0]
+    a, e, d, f = animateLoyaltonSmoke(frame, num_frames, azumith, elevation, distance, focalpoint)
+    return (a, e, d, f)
+
+def animateTorSmoke(frame, num_frames, azumith, elevation, distance, focalpoint):
+    azumith -= 70*root_transform(frame, num_frames, 5)
+    elevation += 60*root_transform(frame, num_frames, 5)
+    distance += 8000*root_transform(frame, num_frames, 5)
+    focalpoint[0] += 1500*root_transform(frame, num_frames, 5)
+    focalpoint[1] += 1500*root_transform(frame, num_frames, 5)
+    focalpoint[2] += 1000*root_transform(frame, num_frames, 5)
+    return (azumith, elevation, distance, focalpoint)
+
+def torViewSmoke(frame, num_frames):
+    azumith = 180
+    elevation = 30
+    distance = 2000
+    focalpoint = [5000, 2000, 0]
+    a, e, d, f = animateTorSmoke(frame, num_frames, azumith, elevation, distance, focalpoint)
+    return (a, e, d, f)
+
+aniFunc = {
+    "creek": creekViewSmoke,
+    "loyalton": loyaltonViewSmoke,
+    "tor": torViewSmoke,
+}
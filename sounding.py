@@ -1,7 +1,17 @@
+import hashlib
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
 import numpy as np
 import pandas as pd
-from netCDF4 import Dataset
-from math import radians
+from scipy.spatial import cKDTree
+from input_sounding import read_input_sounding, write_input_sounding, MISSING
+from stages import stage, staged
+from hrrrstore import ColumnStore
+from wrfout import NcFile
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -18,15 +28,6 @@ from matplotlib.projections import register_projection
 
 register_projection(SkewXAxes)
 
-def _haversine(lon1, lat1, lon2, lat2):
-    lon1 = np.radians(lon1)
-    lat1 = np.radians(lat1)
-    lon2, lat2 = map(radians, [lon2, lat2])
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = np.arcsin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
-    return 2 * 6371 * np.arcsin(np.sqrt(a))
-
 def _fmt(value, fmt='int'):
     if fmt == 'int':
         try:
@@ -35,98 +36,316 @@ def _fmt(value, fmt='int'):
             val = str("M")
     else:
         try:
-            val = round(value,1)
+            val = round(value, 2 if fmt == 'flt2' else 1)
         except:
             val = "M"
     return val
 
 
+def wind_direction(u, v):
+    # Meteorological direction (where the wind blows from), degrees in [0, 360)
+    return np.degrees(np.arctan2(-np.asarray(u), -np.asarray(v))) % 360
+
+
+def _sharppy_profile(P, hght, tmpc, dwpc, wspd, wdir, date):
+    # SHARPpy needs the date (it picks the PWV climatology by month)
+    return profile.create_profile(pres=P, hght=hght, tmpc=tmpc, dwpc=dwpc, wspd=wspd, wdir=wdir, missing=-9999.00,
+                                  strictQC=False, profile='convective', date=date)
+
+
+# name: (units, _fmt format), in the order plot() lays them out
+INDEX_FORMAT = {
+    'SBCAPE': ('J/kg', 'int'), 'SBCIN': ('J/kg', 'int'), 'SBLCL': ('m AGL', 'int'), 'SBLFC': ('m AGL', 'int'),
+    'SBEL': ('m AGL', 'int'), 'SBLI': ('C', 'int'),
+    'MLCAPE': ('J/kg', 'int'), 'MLCIN': ('J/kg', 'int'), 'MLLCL': ('m AGL', 'int'), 'MLLFC': ('m AGL', 'int'),
+    'MLEL': ('m AGL', 'int'), 'MLLI': ('C', 'int'),
+    'MUCAPE': ('J/kg', 'int'), 'MUCIN': ('J/kg', 'int'), 'MULCL': ('m AGL', 'int'), 'MULFC': ('m AGL', 'int'),
+    'MUEL': ('m AGL', 'int'), 'MULI': ('C', 'int'),
+    '0-1 km SRH': ('m2/s2', 'int'), '0-1 km Shear': ('kts', 'int'), '0-3 km SRH': ('m2/s2', 'int'),
+    '0-6 km Shear': ('kts', 'int'), 'Eff. SRH': ('m2/s2', 'int'), 'EBWD': ('kts', 'int'),
+    'PWV': ('inch', 'flt2'), 'K-index': ('', 'int'),
+    'STP(fix)': ('', 'flt'), 'SHIP': ('', 'flt'), 'SCP': ('', 'flt'), 'STP(cin)': ('', 'flt'),
+}
+
+
+def sounding_indices(prof):
+    # Raw values of the indices shown under the Skew-T. More indices can be calculated here using the
+    # tutorial and reading the params module.
+    srwind = params.bunkers_storm_motion(prof)
+    p1km = interp.pres(prof, interp.to_msl(prof, 1000.))
+    p6km = interp.pres(prof, interp.to_msl(prof, 6000.))
+    sfc = prof.pres[prof.sfc]
+    sfc_1km_shear = winds.wind_shear(prof, pbot=sfc, ptop=p1km)
+    sfc_6km_shear = winds.wind_shear(prof, pbot=sfc, ptop=p6km)
+    srh3km = winds.helicity(prof, 0, 3000., stu = srwind[0], stv = srwind[1])
+    srh1km = winds.helicity(prof, 0, 1000., stu = srwind[0], stv = srwind[1])
+    scp = params.scp(prof.mupcl.bplus, prof.right_esrh[0], prof.ebwspd)
+    stp_cin = params.stp_cin(prof.mlpcl.bplus, prof.right_esrh[0], prof.ebwspd, prof.mlpcl.lclhght, prof.mlpcl.bminus)
+    stp_fixed = params.stp_fixed(prof.sfcpcl.bplus, prof.sfcpcl.lclhght, srh1km[0], utils.comp2vec(prof.sfc_6km_shear[0], prof.sfc_6km_shear[1])[1])
+    ship = params.ship(prof)
+
+    return {'SBCAPE': prof.sfcpcl.bplus, 'SBCIN': prof.sfcpcl.bminus, 'SBLCL': prof.sfcpcl.lclhght,
+            'SBLFC': prof.sfcpcl.lfchght, 'SBEL': prof.sfcpcl.elhght, 'SBLI': prof.sfcpcl.li5,
+            'MLCAPE': prof.mlpcl.bplus, 'MLCIN': prof.mlpcl.bminus, 'MLLCL': prof.mlpcl.lclhght,
+            'MLLFC': prof.mlpcl.lfchght, 'MLEL': prof.mlpcl.elhght, 'MLLI': prof.mlpcl.li5,
+            'MUCAPE': prof.mupcl.bplus, 'MUCIN': prof.mupcl.bminus, 'MULCL': prof.mupcl.lclhght,
+            'MULFC': prof.mupcl.lfchght, 'MUEL': prof.mupcl.elhght, 'MULI': prof.mupcl.li5,
+            '0-1 km SRH': srh1km[0],
+            '0-1 km Shear': utils.comp2vec(sfc_1km_shear[0], sfc_1km_shear[1])[1],
+            '0-3 km SRH': srh3km[0],
+            '0-6 km Shear': utils.comp2vec(sfc_6km_shear[0], sfc_6km_shear[1])[1],
+            'Eff. SRH': prof.right_esrh[0], 'EBWD': prof.ebwspd, 'PWV': prof.pwat,
+            'K-index': params.k_index(prof), 'STP(fix)': stp_fixed, 'SHIP': ship, 'SCP': scp, 'STP(cin)': stp_cin}
+
+
+EARTH_RADIUS_KM = 6371.
+
+
+def _unit_xyz(lat, lon):
+    # Points on the unit sphere, so euclidean nearest == great-circle nearest
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    return np.stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)], axis=-1)
+
+
+class GridIndex:
+    # KD-tree over a 2D lat/lon grid. Built once per grid and kept in memory
+    # per process. The grid's points on the unit sphere are saved next to the
+    # file it was first built from as <file>.kdtree.npz (plain arrays, read
+    # without pickle), and later processes only rebuild the tree from them.
+    # spacing is the grid's typical point spacing (km), which query() uses to
+    # catch points off the grid (a column store only covers a small window).
+    _memo = {}      # (path, size, mtime, shape): index
+    _grids = {}     # grid_key: index, for files sharing a grid
+
+    def __init__(self, lat, lon, key=None, points=None):
+        lat = np.ma.getdata(lat)
+        lon = np.ma.getdata(lon)
+        self.shape = lat.shape
+        self.key = self.grid_key(lat, lon) if key is None else key
+        self.points = _unit_xyz(lat.ravel(), lon.ravel()) if points is None else points
+        self.tree = cKDTree(self.points)
+        xyz = self.points.reshape(self.shape + (3,))
+        steps = [np.median(np.linalg.norm(np.diff(xyz, axis=a), axis=-1)) for a in (0, 1) if self.shape[a] > 1]
+        self.spacing = EARTH_RADIUS_KM*max(steps) if steps else np.inf
+
+    @staticmethod
+    def grid_key(lat, lon):
+        h = hashlib.sha1()
+        for a in (lat, lon):
+            a = np.ascontiguousarray(np.ma.getdata(a), dtype=np.float32)
+            h.update(str(a.shape).encode())
+            h.update(a.tobytes())
+        return h.hexdigest()
+
+    @classmethod
+    def for_file(cls, nc, lat_name="gridlat_0", lon_name="gridlon_0", cache=True):
+        # The file's lat/lon are only read and hashed the first time a
+        # process sees it (or after it changes)
+        path = Path(nc.path)
+        st = path.stat()
+        file_key = (str(path.resolve()), st.st_size, st.st_mtime_ns, tuple(nc.shape(lat_name)))
+        if file_key in cls._memo:
+            return cls._memo[file_key]
+        lat = nc.read(lat_name)
+        lon = nc.read(lon_name)
+        key = cls.grid_key(lat, lon)
+        index = cls._grids.get(key)
+        if index is None:
+            saved = path.with_name(path.name + ".kdtree.npz")
+            points = None
+            if cache and saved.exists():
+                try:
+                    with np.load(saved, allow_pickle=False) as f:
+                        if str(f["key"]) == key and f["points"].shape == (lat.size, 3):
+                            points = f["points"]
+                except (OSError, ValueError, KeyError):
+                    points = None
+            index = cls(lat, lon, key, points)
+            if cache and points is None:
+                tmp = saved.with_name(saved.name + ".{}.tmp".format(os.getpid()))
+                try:
+                    with open(tmp, "wb") as f:
+                        np.savez(f, key=key, points=index.points)
+                    os.replace(tmp, saved)
+                except OSError:
+                    pass
+            cls._grids[key] = index
+        cls._memo[file_key] = index
+        return index
+
+    def query(self, lat, lon, max_spacings=1.):
+        # (rows, cols, km) of the nearest grid point to each lat/lon. Points
+        # more than max_spacings grid spacings from it are off the grid (the
+        # nearest point is just the edge) and raise; None lets them through.
+        chord, idx = self.tree.query(_unit_xyz(lat, lon))
+        km = 2*EARTH_RADIUS_KM*np.arcsin(np.minimum(chord/2, 1.))
+        if max_spacings is not None:
+            off = np.flatnonzero(km > max_spacings*self.spacing)
+            if off.size:
+                raise ValueError("{} of {} points are off the grid (grid spacing {:.1f} km), e.g. point {} is "
+                                 "{:.1f} km from the nearest grid point".format(
+                                     off.size, km.size, self.spacing, off[0], km[off[0]]))
+        rows, cols = np.unravel_index(idx, self.shape)
+        return rows, cols, km
+
+
+HRRR_LEVELS = (list(range(50, 1001, 25)) + [1013.2])[::-1]
+HRRR_PROFILE_VARS = {
+    "Z": "HGT_P0_L100_GLC0",
+    "T": "TMP_P0_L100_GLC0",
+    "q": "SPFH_P0_L100_GLC0",
+    "Td": "DPT_P0_L100_GLC0",
+    "U": "UGRD_P0_L100_GLC0",
+    "V": "VGRD_P0_L100_GLC0",
+}
+HRRR_SURFACE_VARS = {
+    "ter": "HGT_P0_L1_GLC0",
+    "sfc_P": "PRES_P0_L1_GLC0",
+    "sfc_Theta": "POT_P0_L103_GLC0",
+    "sfc_q": "SPFH_P0_L103_GLC0",
+    "lat": "gridlat_0",
+    "lon": "gridlon_0",
+}
+
+
+def _gather(nc, name, rows, cols, block=64):
+    # Values of name at (rows, cols) for every leading level, shape (..., npts).
+    # Reads the points' bounding box a strip of rows at a time, so scattered
+    # points never pull in the whole grid at once.
+    rows = np.asarray(rows)
+    cols = np.asarray(cols)
+    c0, c1 = cols.min(), cols.max() + 1
+    out = None
+    for r0 in range(rows.min(), rows.max() + 1, block):
+        pts = np.flatnonzero((rows >= r0) & (rows < r0 + block))
+        if not pts.size:
+            continue
+        r1 = rows[pts].max() + 1
+        strip = np.ma.getdata(nc.read(name, Ellipsis, slice(r0, r1), slice(c0, c1)))
+        vals = strip[..., rows[pts] - r0, cols[pts] - c0]
+        if out is None:
+            out = np.empty(vals.shape[:-1] + rows.shape, dtype=vals.dtype)
+        out[..., pts] = vals
+    return out
+
+
+def _open_hrrr(filename):
+    # A hrrrstore column store or an ncl_convert2nc netCDF file
+    return ColumnStore(filename) if ColumnStore.is_store(filename) else NcFile(filename)
+
+
+def hrrr_columns(nc, rows, cols):
+    # Every variable SoundingData needs at many grid columns from one open file
+    if isinstance(nc, ColumnStore):
+        # One record per column, and the store knows its own levels
+        fields = nc.gather(rows, cols)
+        columns = {k: fields[v] for k, v in {**HRRR_SURFACE_VARS, **HRRR_PROFILE_VARS}.items()}
+        columns["P"] = nc.levels
+        return columns
+    columns = {k: _gather(nc, v, rows, cols) for k, v in HRRR_SURFACE_VARS.items()}
+    columns.update({k: _gather(nc, v, rows, cols) for k, v in HRRR_PROFILE_VARS.items()})
+    return columns
+
+
 class SoundingData:
+    @staged("SoundingData")
     def __init__(self, type: str, filename: str, lat: float, lon: float):
         if (type == 'hrrr'):
-            #Input
-            self.lat = lat
-            self.lon = lon
-            hrrr_sounding = Dataset(filename)
-            distances = _haversine((hrrr_sounding["gridlon_0"][:,:]), (hrrr_sounding["gridlat_0"][:,:]), lon, lat)
-            row, col = np.unravel_index(distances.argmin(), distances.shape)
-
-            #Raw
-            self.ter = hrrr_sounding["HGT_P0_L1_GLC0"][row, col]
-            col_vars = {
-                "P": (list(range(50, 1001, 25)) + [1013.2])[::-1],
-                "Z": np.flip(hrrr_sounding["HGT_P0_L100_GLC0"][:,row,col] - self.ter),
-                "T": np.flip(hrrr_sounding["TMP_P0_L100_GLC0"][:,row,col]),
-                "q": np.flip(hrrr_sounding["SPFH_P0_L100_GLC0"][:,row,col]),
-                "Td": np.flip(hrrr_sounding["DPT_P0_L100_GLC0"][:,row,col]),
-                "U": np.flip(hrrr_sounding["UGRD_P0_L100_GLC0"][:,row,col]),
-                "V": np.flip(hrrr_sounding["VGRD_P0_L100_GLC0"][:,row,col]),
-            }
-            self.profile = pd.DataFrame(col_vars)
-            self.profile = (self.profile[self.profile['Z'] >= 0]).reset_index()
-            self.sfc_P = hrrr_sounding["PRES_P0_L1_GLC0"][row, col]/100
-            self.sfc_Theta = hrrr_sounding["POT_P0_L103_GLC0"][row, col]
-            self.sfc_q = hrrr_sounding["SPFH_P0_L103_GLC0"][row, col]
-            self.lat = hrrr_sounding["gridlat_0"][row, col]
-            self.lon = hrrr_sounding["gridlon_0"][row, col]
-
-            #Derived
-            self.profile["Theta"] = self.profile["T"]*(1000/self.profile["P"])**0.2854
-            self.profile["w"] = self.profile["q"]/(1-self.profile["q"])
-            self.profile["wspeed"] = np.hypot(self.profile["U"], self.profile["V"])
-            self.profile["wspeedkt"] = np.hypot(self.profile["U"], self.profile["V"])*1.94384
-            self.profile["wdir"] = np.abs((np.sign(self.profile["U"])-1)/2) * np.degrees(np.arccos(-self.profile["V"]/self.profile["wspeed"])) + \
-                                   np.abs((np.sign(self.profile["U"])+1)/2) * (360-np.degrees(np.arccos(-self.profile["V"]/self.profile["wspeed"])))
-            self.sfc_w = self.sfc_q/(1-self.sfc_q)
-            self.sfc_q *= 1000
-            self.sfc_w *= 1000
-            self.profile["q"] *= 1000
-            self.profile["w"] *= 1000
+            with _open_hrrr(filename) as hrrr_sounding:
+                with stage("grid_index"):
+                    rows, cols, _ = GridIndex.for_file(hrrr_sounding).query([lat], [lon])
+                with stage("read"):
+                    columns = hrrr_columns(hrrr_sounding, rows, cols)
+            with stage("derive"):
+                self._from_columns(columns, 0)
         else:
             raise TypeError("Invalid model type")
-    
+
+    @classmethod
+    @staged("SoundingData.from_points")
+    def from_points(cls, type: str, filename: str, lats, lons):
+        # Many soundings out of one open file, e.g. points around a fire perimeter
+        if (type != 'hrrr'):
+            raise TypeError("Invalid model type")
+        with _open_hrrr(filename) as hrrr_sounding:
+            with stage("grid_index"):
+                rows, cols, _ = GridIndex.for_file(hrrr_sounding).query(np.atleast_1d(lats), np.atleast_1d(lons))
+            with stage("read"):
+                columns = hrrr_columns(hrrr_sounding, rows, cols)
+        soundings = []
+        with stage("derive"):
+            for i in range(len(rows)):
+                sounding = cls.__new__(cls)
+                sounding._from_columns(columns, i)
+                soundings.append(sounding)
+        return soundings
+
+    def _from_columns(self, columns, i):
+        #Raw
+        self.ter = columns["ter"][i]
+        col_vars = {"P": np.flip(columns["P"]) if "P" in columns else HRRR_LEVELS}
+        for k in HRRR_PROFILE_VARS:
+            col_vars[k] = np.flip(columns[k][:, i])
+        col_vars["Z"] = col_vars["Z"] - self.ter
+        self.profile = pd.DataFrame(col_vars)
+        self.profile = (self.profile[self.profile['Z'] >= 0]).reset_index()
+        self.sfc_P = columns["sfc_P"][i]/100
+        self.sfc_Theta = columns["sfc_Theta"][i]
+        self.sfc_q = columns["sfc_q"][i]
+        self.lat = columns["lat"][i]
+        self.lon = columns["lon"][i]
+
+        #Derived
+        self.profile["Theta"] = self.profile["T"]*(1000/self.profile["P"])**0.2854
+        self.profile["w"] = self.profile["q"]/(1-self.profile["q"])
+        self.profile["wspeed"] = np.hypot(self.profile["U"], self.profile["V"])
+        self.profile["wspeedkt"] = np.hypot(self.profile["U"], self.profile["V"])*1.94384
+        self.profile["wdir"] = wind_direction(self.profile["U"], self.profile["V"])
+        self.sfc_w = self.sfc_q/(1-self.sfc_q)
+        self.sfc_q *= 1000
+        self.sfc_w *= 1000
+        self.profile["q"] *= 1000
+        self.profile["w"] *= 1000
+
     def gen_wrf_sounding(self, filename: str):
-        sounding_str = ""
-        #sfc
-        sounding_str += " " + str(self.sfc_P) + " " + str(self.sfc_Theta) + " " + str(self.sfc_w) + "\n"
-        #profile
-        for _, row in self.profile.iterrows():
-            sounding_str += "  " + str(row["Z"]) + " " + str(row["Theta"]) + " " + str(row["w"]) + " " + str(row["U"]) + " " + str(row["V"]) + "\n"
-        with open(filename, "w") as f:
-            f.write(sounding_str)
+        write_input_sounding(filename, (self.sfc_P, self.sfc_Theta, self.sfc_w),
+                             self.profile[["Z", "Theta", "w", "U", "V"]].to_numpy(np.float64))
 
     def modify_from_wrf(self, filename: str):
-        with open(filename, "r") as f:
-            wrf = f.read().split('\n')
-            wrf = wrf[1:len(wrf)-1]
-        for i in range(len(wrf)):
-            wrf[i] = wrf[i].split()
-        wrf = np.asarray(wrf, np.float32)
-        U = wrf[:,3]
-        V = wrf[:,4]
+        _, wrf = read_input_sounding(filename)
+        wrf = wrf.astype(np.float32)
         length_needed = len(self.profile.index)
-        U = np.append(U, np.zeros(length_needed-len(U))-9999.00)
-        V = np.append(V, np.zeros(length_needed-len(V))-9999.00)
+        U = np.full(length_needed, MISSING, dtype=np.float64)
+        V = np.full(length_needed, MISSING, dtype=np.float64)
+        U[:len(wrf)] = wrf[:, 3]
+        V[:len(wrf)] = wrf[:, 4]
         self.profile["U"] = U
         self.profile["V"] = V
         self.profile["wspeed"] = np.hypot(self.profile["U"], self.profile["V"])
         self.profile["wspeedkt"] = np.hypot(self.profile["U"], self.profile["V"])*1.94384
-        self.profile["wdir"] = np.abs((np.sign(self.profile["U"])-1)/2) * np.degrees(np.arccos(-self.profile["V"]/self.profile["wspeed"])) + \
-                                np.abs((np.sign(self.profile["U"])+1)/2) * (360-np.degrees(np.arccos(-self.profile["V"]/self.profile["wspeed"])))
-        for i in self.profile.index:
-            if self.profile["U"][i] == -9999.00 or self.profile["V"][i] == -9999.00:
-                self.profile["wspeed"][i] = -9999.00
-                self.profile["wspeedkt"][i] = -9999.00
-                self.profile["wdir"][i] = -9999.00
+        self.profile["wdir"] = wind_direction(self.profile["U"], self.profile["V"])
+        missing = (self.profile["U"] == MISSING) | (self.profile["V"] == MISSING)
+        self.profile.loc[missing, ["wspeed", "wspeedkt", "wdir"]] = MISSING
 
 
     def print_profile(self):
         print(self.profile)
 
+    def _profile_args(self, date):
+        return (self.profile["P"], self.profile["Z"]+self.ter, self.profile["T"]-273.15,
+                self.profile["Td"]-273.15, self.profile["wspeedkt"], self.profile["wdir"], date)
+
+    def sharppy_profile(self, date):
+        return _sharppy_profile(*self._profile_args(date))
+
+    def indices(self, date):
+        return sounding_indices(self.sharppy_profile(date))
+
+    @staged("SoundingData.plot")
     def plot(self, date, filename: str = None, title: str = ''):
-        prof = profile.create_profile(pres=self.profile["P"], hght=(self.profile["Z"]+self.ter), tmpc=(self.profile["T"]-273.15), 
-                                      dwpc=self.profile["Td"]-273.15, wspd=self.profile["wspeedkt"], wdir=self.profile["wdir"], missing=-9999.00,
-                                      strictQC=False, profile='convective', date=date)
+        with stage("profile"):
+            prof = self.sharppy_profile(date)
         # pb_plot=1050
         # pt_plot=100
         # dp_plot=10
@@ -174,54 +393,13 @@ class SoundingData:
         ax3 = plt.subplot(gs[3,0:3])
         skew.plot_wind_axes(ax2)
         skew.plot_wind_barbs(ax2, prof.pres, prof.u, prof.v)
-        srwind = params.bunkers_storm_motion(prof)
         gs.update(left=0.05, bottom=0.05, top=0.95, right=1, wspace=0.025)
 
-        # Calculate indices to be shown.  More indices can be calculated here using the tutorial and reading the params module.
-        p1km = interp.pres(prof, interp.to_msl(prof, 1000.))
-        p6km = interp.pres(prof, interp.to_msl(prof, 6000.))
-        sfc = prof.pres[prof.sfc]
-        sfc_1km_shear = winds.wind_shear(prof, pbot=sfc, ptop=p1km)
-        sfc_6km_shear = winds.wind_shear(prof, pbot=sfc, ptop=p6km)
-        srh3km = winds.helicity(prof, 0, 3000., stu = srwind[0], stv = srwind[1])
-        srh1km = winds.helicity(prof, 0, 1000., stu = srwind[0], stv = srwind[1])
-        scp = params.scp(prof.mupcl.bplus, prof.right_esrh[0], prof.ebwspd)
-        stp_cin = params.stp_cin(prof.mlpcl.bplus, prof.right_esrh[0], prof.ebwspd, prof.mlpcl.lclhght, prof.mlpcl.bminus)
-        stp_fixed = params.stp_fixed(prof.sfcpcl.bplus, prof.sfcpcl.lclhght, srh1km[0], utils.comp2vec(prof.sfc_6km_shear[0], prof.sfc_6km_shear[1])[1])
-        ship = params.ship(prof)
-
         # Setting a dictionary that is a collection of all of the indices we'll be showing on the figure.
         # the dictionary includes the index name, the actual value, and the units.
-        indices = {'SBCAPE': [_fmt(prof.sfcpcl.bplus), 'J/kg'],\
-                'SBCIN': [_fmt(prof.sfcpcl.bminus), 'J/kg'],\
-                'SBLCL': [_fmt(prof.sfcpcl.lclhght), 'm AGL'],\
-                'SBLFC': [_fmt(prof.sfcpcl.lfchght), 'm AGL'],\
-                'SBEL': [_fmt(prof.sfcpcl.elhght), 'm AGL'],\
-                'SBLI': [_fmt(prof.sfcpcl.li5), 'C'],\
-                'MLCAPE': [_fmt(prof.mlpcl.bplus), 'J/kg'],\
-                'MLCIN': [_fmt(prof.mlpcl.bminus), 'J/kg'],\
-                'MLLCL': [_fmt(prof.mlpcl.lclhght), 'm AGL'],\
-                'MLLFC': [_fmt(prof.mlpcl.lfchght), 'm AGL'],\
-                'MLEL': [_fmt(prof.mlpcl.elhght), 'm AGL'],\
-                'MLLI': [_fmt(prof.mlpcl.li5), 'C'],\
-                'MUCAPE': [_fmt(prof.mupcl.bplus), 'J/kg'],\
-                'MUCIN': [_fmt(prof.mupcl.bminus), 'J/kg'],\
-                'MULCL': [_fmt(prof.mupcl.lclhght), 'm AGL'],\
-                'MULFC': [_fmt(prof.mupcl.lfchght), 'm AGL'],\
-                'MUEL': [_fmt(prof.mupcl.elhght), 'm AGL'],\
-                'MULI': [_fmt(prof.mupcl.li5), 'C'],\
-                '0-1 km SRH': [_fmt(srh1km[0]), 'm2/s2'],\
-                '0-1 km Shear': [_fmt(utils.comp2vec(sfc_1km_shear[0], sfc_1km_shear[1])[1]), 'kts'],\
-                '0-3 km SRH': [_fmt(srh3km[0]), 'm2/s2'],\
-                '0-6 km Shear': [_fmt(utils.comp2vec(sfc_6km_shear[0], sfc_6km_shear[1])[1]), 'kts'],\
-                'Eff. SRH': [_fmt(prof.right_esrh[0]), 'm2/s2'],\
-                'EBWD': [_fmt(prof.ebwspd), 'kts'],\
-                'PWV': [round(prof.pwat, 2), 'inch'],\
-                'K-index': [_fmt(params.k_index(prof)), ''],\
-                'STP(fix)': [_fmt(stp_fixed, 'flt'), ''],\
-                'SHIP': [_fmt(ship, 'flt'), ''],\
-                'SCP': [_fmt(scp, 'flt'), ''],\
-                'STP(cin)': [_fmt(stp_cin, 'flt'), '']}
+        with stage("indices"):
+            values = sounding_indices(prof)
+        indices = {key: [_fmt(values[key], fmt), units] for key, (units, fmt) in INDEX_FORMAT.items()}
 
         string = ''
         keys = np.sort(list(indices.keys()))
@@ -243,7 +421,132 @@ class SoundingData:
         # Finalize the image formatting and alignments, and save the image to the file.
         if not(filename is None):
             print("SHARPpy Skew-T image output at: ", filename)
-            plt.savefig(filename, bbox_inches='tight', dpi=180)
+            with stage("savefig"):
+                plt.savefig(filename, bbox_inches='tight', dpi=180)
             plt.close()
         else:
             plt.show()
+
+
+def _index_float(value):
+    if np.ma.is_masked(value) or value is None:
+        return np.nan
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return np.nan
+    return np.nan if value == -9999.00 else value
+
+
+# What SHARPpy raises for a profile it can't use (too few levels above
+# ground, all missing, ...). Anything else is a bug and is raised.
+PROFILE_ERRORS = (AssertionError, ValueError, IndexError, ZeroDivisionError, FloatingPointError)
+
+
+def _member_indices(args):
+    # (indices, error): one bad profile shouldn't sink a whole screening run
+    P, hght, tmpc, dwpc, wspd, wdir, date = args
+    try:
+        values = sounding_indices(_sharppy_profile(P, hght, tmpc, dwpc, wspd, wdir, date))
+    except PROFILE_ERRORS as e:
+        return {key: np.nan for key in INDEX_FORMAT}, "{}: {}".format(type(e).__name__, e)
+    return {key: _index_float(values[key]) for key in INDEX_FORMAT}, None
+
+
+class SoundingEnsemble:
+    # Many HRRR soundings as (member, level) arrays, surface first like
+    # SoundingData.profile. Levels below the surface are NaN.
+    def __init__(self, columns, dates):
+        # columns: as returned by hrrr_columns, i.e. (level, member) profiles;
+        # dates: the valid time, one for all members or one per member
+        self.columns = columns
+        n = np.size(columns["ter"])
+        self.dates = list(dates) if np.ndim(dates) else [dates]*n
+        self.ter = np.asarray(columns["ter"], dtype=np.float64)
+        self.lat = np.asarray(columns["lat"], dtype=np.float64)
+        self.lon = np.asarray(columns["lon"], dtype=np.float64)
+        self.sfc_P = np.asarray(columns["sfc_P"], dtype=np.float64)/100
+        self.sfc_Theta = np.asarray(columns["sfc_Theta"], dtype=np.float64)
+        sfc_q = np.asarray(columns["sfc_q"], dtype=np.float64)
+        self.sfc_w = sfc_q/(1-sfc_q)*1000
+        self.sfc_q = sfc_q*1000
+
+        prof = {k: np.flip(np.asarray(columns[k], dtype=np.float64), axis=0).T for k in HRRR_PROFILE_VARS}
+        self.Z = prof["Z"] - self.ter[:, None]
+        self.valid = self.Z >= 0
+        levels = np.flip(columns["P"]) if "P" in columns else HRRR_LEVELS
+        self.P = np.broadcast_to(np.asarray(levels, dtype=np.float64), self.Z.shape)
+        self.T = prof["T"]
+        self.Td = prof["Td"]
+        self.U = prof["U"]
+        self.V = prof["V"]
+        q = prof["q"]
+        self.Theta = self.T*(1000/self.P)**0.2854
+        self.w = q/(1-q)*1000
+        self.q = q*1000
+        self.wspeed = np.hypot(self.U, self.V)
+        self.wspeedkt = self.wspeed*1.94384
+        self.wdir = wind_direction(self.U, self.V)
+        for name in ("Z", "T", "Td", "U", "V", "Theta", "w", "q", "wspeed", "wspeedkt", "wdir"):
+            setattr(self, name, np.where(self.valid, getattr(self, name), np.nan))
+
+    def __len__(self):
+        return self.ter.size
+
+    @classmethod
+    def from_points(cls, filename: str, date, lats, lons):
+        with _open_hrrr(filename) as hrrr_sounding:
+            rows, cols, _ = GridIndex.for_file(hrrr_sounding).query(np.atleast_1d(lats), np.atleast_1d(lons))
+            return cls(hrrr_columns(hrrr_sounding, rows, cols), date)
+
+    @classmethod
+    def from_grid(cls, filename: str, date, stride=1, rows=slice(None), cols=slice(None)):
+        # Every stride-th column of (a window of) the grid
+        with _open_hrrr(filename) as hrrr_sounding:
+            ny, nx = hrrr_sounding.shape("gridlat_0")
+            r = np.arange(ny)[rows][::stride]
+            c = np.arange(nx)[cols][::stride]
+            rr, cc = np.meshgrid(r, c, indexing="ij")
+            return cls(hrrr_columns(hrrr_sounding, rr.ravel(), cc.ravel()), date)
+
+    @classmethod
+    def concat(cls, ensembles):
+        # e.g. the same points over a series of HRRR cycles
+        # (the cycles have to share their levels)
+        columns = {k: np.concatenate([e.columns[k] for e in ensembles], axis=-1)
+                   for k in ensembles[0].columns if k != "P"}
+        if "P" in ensembles[0].columns:
+            columns["P"] = ensembles[0].columns["P"]
+        return cls(columns, [d for e in ensembles for d in e.dates])
+
+    def member(self, i):
+        # One member as a SoundingData, e.g. to plot it
+        sounding = SoundingData.__new__(SoundingData)
+        sounding._from_columns(self.columns, i)
+        return sounding
+
+    def _profile_args(self, i):
+        v = self.valid[i]
+        return (self.P[i][v], self.Z[i][v]+self.ter[i], self.T[i][v]-273.15, self.Td[i][v]-273.15,
+                self.wspeedkt[i][v], self.wdir[i][v], self.dates[i])
+
+    def indices(self, processes=None, chunksize=8):
+        # One row of SHARPpy indices per member (NaN where missing). Members
+        # SHARPpy can't use get NaN everywhere and their error in "error";
+        # how many there were is printed to stderr.
+        args = (self._profile_args(i) for i in range(len(self)))
+        if processes == 1:
+            results = list(map(_member_indices, args))
+        else:
+            with ProcessPoolExecutor(processes) as pool:
+                results = list(pool.map(_member_indices, args, chunksize=chunksize))
+        table = pd.DataFrame([values for values, _ in results], columns=list(INDEX_FORMAT))
+        table.insert(0, "lat", self.lat)
+        table.insert(1, "lon", self.lon)
+        errors = [error for _, error in results]
+        table["error"] = errors
+        failed = Counter(error for error in errors if error is not None)
+        if failed:
+            print("SoundingEnsemble.indices: {} of {} members failed, most often with {} ({})".format(
+                sum(failed.values()), len(errors), *failed.most_common(1)[0]), file=sys.stderr)
+        return table
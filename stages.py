@@ -0,0 +1,215 @@
+import atexit
+import functools
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+# Wall time, CPU time and peak RSS for named stages of the pipelines, e.g.
+#
+#     with stage("interp", file=name):
+#         ...
+#
+# Off unless WRF_STAGES is set or enable() is called, and then stage() only
+# hands back a shared do-nothing context manager. WRF_STAGES=1 prints a
+# summary table at exit; WRF_STAGES=<path> also keeps every stage in <path>,
+# as JSON lines, or as a Chrome trace (chrome://tracing, ui.perfetto.dev)
+# when the path ends in .json. Worker processes inherit the variable and
+# append to the same file, so the summary covers them too.
+#
+# cpu is the process CPU time over the stage (all threads). maxrss_mb is the
+# process's peak RSS when the stage ended, and maxrss_growth_mb is how much
+# the stage raised that peak.
+
+ENV = "WRF_STAGES"
+# pid of the process that owns the file and the summary
+ENV_OWNER = "WRF_STAGES_OWNER"
+_NULL = nullcontext()
+_recorder = None
+
+
+def stage(name, **args):
+    if _recorder is None:
+        return _NULL
+    return _recorder.stage(name, args)
+
+
+def staged(name):
+    # stage() around every call of the decorated function
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return fn(*args, **kwargs)
+            with _recorder.stage(name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def _maxrss_mb():
+    # kB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/2**20 if sys.platform == "darwin" else rss/1024
+
+
+class StageRecorder:
+    def __init__(self, path, append=False):
+        self.path = Path(path)
+        self.trace = self.path.suffix == ".json"
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        if not append:
+            self.path.write_text("")
+        # Always in append mode, even in the process that started the file:
+        # workers append to it too, and a write at this process's own offset
+        # would land on top of their lines
+        self._file = open(self.path, "a")
+        if self.trace and self.path.stat().st_size == 0:
+            # Chrome's array format; the closing ] is optional, which is what
+            # lets several processes append to one file
+            self._file.write("[\n")
+            self._file.flush()
+
+    @contextmanager
+    def stage(self, name, args):
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(name)
+        rss0 = _maxrss_mb()
+        cpu0 = time.process_time()
+        start = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - t0
+            cpu = time.process_time() - cpu0
+            rss1 = _maxrss_mb()
+            self._write({
+                "name": "/".join(stack), "start": start, "wall": wall, "cpu": cpu,
+                "maxrss_mb": rss1, "maxrss_growth_mb": rss1 - rss0,
+                "pid": os.getpid(), "tid": threading.get_ident(), "args": args,
+            })
+            stack.pop()
+
+    def _write(self, event):
+        if self.trace:
+            line = json.dumps({
+                "name": event["name"].rsplit("/", 1)[-1], "cat": "stage", "ph": "X",
+                "ts": event["start"]*1e6, "dur": event["wall"]*1e6, "pid": event["pid"], "tid": event["tid"],
+                "args": dict(event["args"], path=event["name"], cpu=event["cpu"], maxrss_mb=event["maxrss_mb"],
+                             maxrss_growth_mb=event["maxrss_growth_mb"]),
+            }, default=str) + ",\n"
+        else:
+            line = json.dumps(event, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_stages(path):
+    # The stages in a JSON lines file or Chrome trace, as JSON lines events
+    path = Path(path)
+    text = path.read_text()
+    if path.suffix != ".json":
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    text = text.strip().rstrip(",")
+    events = json.loads(text if text.endswith("]") else text + "]")
+    return [{"name": e["args"]["path"], "wall": e["dur"]/1e6, "cpu": e["args"]["cpu"],
+             "maxrss_mb": e["args"]["maxrss_mb"], "pid": e["pid"]} for e in events if e.get("cat") == "stage"]
+
+
+def summary(events):
+    # One row per stage path: count, total and mean wall time, CPU time and
+    # the highest peak RSS seen
+    rows = defaultdict(lambda: [0, 0., 0., 0.])
+    for e in events:
+        row = rows[e["name"]]
+        row[0] += 1
+        row[1] += e["wall"]
+        row[2] += e["cpu"]
+        row[3] = max(row[3], e["maxrss_mb"])
+    width = max([len(name) for name in rows] + [5])
+    lines = ["{:{w}s} {:>7s} {:>10s} {:>10s} {:>10s} {:>6s} {:>10s}".format(
+        "stage", "count", "wall s", "mean s", "cpu s", "cpu/wl", "peak MB", w=width)]
+    for name, (count, wall, cpu, rss) in sorted(rows.items()):
+        lines.append("{:{w}s} {:7d} {:10.3f} {:10.4f} {:10.3f} {:6.2f} {:10.1f}".format(
+            name, count, wall, wall/count, cpu, cpu/wall if wall else 0., rss, w=width))
+    return "\n".join(lines)
+
+
+def _print_summary(path, remove):
+    try:
+        events = read_stages(path)
+        if events:
+            print("\nStages ({} processes):".format(len({e["pid"] for e in events})), file=sys.stderr)
+            print(summary(events), file=sys.stderr)
+            if not remove:
+                print("all stages in {}".format(path), file=sys.stderr)
+    finally:
+        if remove:
+            os.unlink(path)
+
+
+def enable(path=None, print_summary=True):
+    # Starts recording in this process and, through WRF_STAGES, in any worker
+    # processes started after this. Without a path the stages go to a
+    # temporary file that only lives for the summary.
+    global _recorder
+    disable()
+    remove = path is None
+    if remove:
+        fd, path = tempfile.mkstemp(prefix="wrf_stages_", suffix=".jsonl")
+        os.close(fd)
+    os.environ[ENV] = str(path)
+    os.environ[ENV_OWNER] = str(os.getpid())
+    _recorder = StageRecorder(path)
+    if print_summary:
+        atexit.register(_print_summary, str(path), remove)
+    return _recorder
+
+
+def disable():
+    global _recorder
+    os.environ.pop(ENV, None)
+    os.environ.pop(ENV_OWNER, None)
+    if _recorder is not None:
+        _recorder.close()
+        _recorder = None
+
+
+def enabled():
+    return _recorder is not None
+
+
+def _from_env():
+    global _recorder
+    value = os.environ.get(ENV, "")
+    if value in ("", "0"):
+        return
+    # Not multiprocessing.parent_process(): a spawned worker imports this
+    # while it is still unpickling its main module, before that is set
+    if os.environ.get(ENV_OWNER, str(os.getpid())) == str(os.getpid()):
+        # The main process owns the file and the summary
+        enable(None if value == "1" else value)
+    elif value != "1":
+        # Workers only append to the file the main process set up
+        _recorder = StageRecorder(value, append=True)
+
+
+_from_env()
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        print(path)
+        print(summary(read_stages(path)))
@@ -0,0 +1,350 @@
+import argparse
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+from netCDF4 import Dataset
+
+from wrfout import format_wrf_time
+
+# Synthetic wrfout (and HRRR extract) files with the layout the plotting code
+# reads, for benchmarks and trying things out without the real runs. The
+# fields are smooth and plausible (sheared wind, a hill, a growing fire and
+# smoke plume) but not a simulation.
+
+G = 9.81
+
+
+def read_namelist(path):
+    # {group: {key: [values]}} from a Fortran namelist; values stay strings
+    groups = {}
+    group = None
+    with open(path) as f:
+        for line in f:
+            line = line.split("!", 1)[0].strip()
+            if line.startswith("&"):
+                group = groups.setdefault(line[1:].strip().lower(), {})
+            elif line == "/":
+                group = None
+            elif group is not None and "=" in line:
+                key, value = line.split("=", 1)
+                group[key.strip().lower()] = [v.strip().strip("'\"") for v in value.split(",") if v.strip()]
+    return groups
+
+
+def grid_from_namelist(path, domain=0):
+    # Mass-grid sizes and spacing of one domain: e_we/e_sn/e_vert count the
+    # staggered points, so the mass grid is one smaller
+    nl = read_namelist(path)
+    dom = nl["domains"]
+    get = lambda key, default: dom[key][min(domain, len(dom[key])-1)] if key in dom else default
+    tc = nl.get("time_control", {})
+    start = datetime(*(int(tc.get("start_" + k, ["1"])[domain]) for k in ("year", "month", "day")),
+                     *(int(tc.get("start_" + k, ["0"])[domain]) for k in ("hour", "minute", "second")))
+    end = datetime(*(int(tc.get("end_" + k, ["1"])[domain]) for k in ("year", "month", "day")),
+                   *(int(tc.get("end_" + k, ["0"])[domain]) for k in ("hour", "minute", "second")))
+    return {
+        "nx": int(get("e_we", 101)) - 1,
+        "ny": int(get("e_sn", 101)) - 1,
+        "nz": int(get("e_vert", 41)) - 1,
+        "dx": float(get("dx", 50)),
+        "dy": float(get("dy", 50)),
+        "sr_x": int(get("sr_x", 4)),
+        "sr_y": int(get("sr_y", 4)),
+        "start": start,
+        "end": end,
+        "history_interval_s": int(tc.get("history_interval_s", ["120"])[domain]),
+    }
+
+
+def _var(nc, name, dims, data, units="", description="", stagger="", memory_order=None):
+    var = nc.createVariable(name, "f4", dims)
+    # The attributes wrf-python looks at
+    var.FieldType = np.int32(104)
+    var.MemoryOrder = memory_order or {4: "XYZ", 3: "XY "}.get(len(dims), "0  ")
+    var.description = description
+    var.units = units
+    var.stagger = stagger
+    if dims[-2:] in (("south_north", "west_east"), ("south_north_stag", "west_east"), ("south_north", "west_east_stag")):
+        var.coordinates = "XLONG XLAT XTIME"
+    var[0] = data
+    return var
+
+
+def _eta_heights(nz, ztop, stretch=2.5):
+    # Heights of the nz+1 w levels above the surface, finer near the ground
+    s = np.linspace(0., 1., nz+1)
+    return ztop*(np.exp(stretch*s) - 1)/(np.exp(stretch) - 1)
+
+
+def write_wrfout(path, nx=205, ny=205, nz=50, dx=50., dy=50., sr_x=4, sr_y=4, time=datetime(1, 1, 1),
+                 frame=0, num_frames=1, ztop=6000., fire=None, seed=0):
+    # One history frame. frame/num_frames set how far the fire and smoke have
+    # grown; fire: (x, y) of the ignition in m (default: a quarter of the way
+    # into the domain)
+    rng = np.random.default_rng([seed, frame])
+    progress = (frame + 1)/max(num_frames, 1)
+    fx, fy = fire if fire is not None else (0.25*nx*dx, 0.5*ny*dy)
+
+    with Dataset(path, "w", format="NETCDF3_64BIT_OFFSET") as nc:
+        for name, size in [("Time", None), ("DateStrLen", 19), ("bottom_top", nz), ("bottom_top_stag", nz+1),
+                           ("south_north", ny), ("south_north_stag", ny+1), ("west_east", nx), ("west_east_stag", nx+1),
+                           ("south_north_subgrid", (ny+1)*sr_y), ("west_east_subgrid", (nx+1)*sr_x)]:
+            nc.createDimension(name, size)
+        nc.TITLE = " OUTPUT FROM SYNTHETIC WRF (synthwrf.py)"
+        nc.START_DATE = nc.SIMULATION_START_DATE = format_wrf_time(time)
+        setattr(nc, "WEST-EAST_GRID_DIMENSION", np.int32(nx+1))
+        setattr(nc, "SOUTH-NORTH_GRID_DIMENSION", np.int32(ny+1))
+        setattr(nc, "BOTTOM-TOP_GRID_DIMENSION", np.int32(nz+1))
+        nc.DX = np.float32(dx)
+        nc.DY = np.float32(dy)
+        nc.MAP_PROJ = np.int32(0)
+        for name, value in [("CEN_LAT", 38.), ("CEN_LON", -120.), ("TRUELAT1", 0.), ("TRUELAT2", 0.),
+                            ("MOAD_CEN_LAT", 38.), ("STAND_LON", -120.), ("POLE_LAT", 90.), ("POLE_LON", 0.)]:
+            setattr(nc, name, np.float32(value))
+
+        times = nc.createVariable("Times", "S1", ("Time", "DateStrLen"))
+        times[0] = np.array(list(format_wrf_time(time)), dtype="S1")
+        xtime = nc.createVariable("XTIME", "f4", ("Time",))
+        xtime.units = "minutes since " + format_wrf_time(time).replace("_", " ")
+        xtime[0] = 0.
+
+        x = np.arange(nx)*dx
+        y = np.arange(ny)*dy
+        X, Y = np.meshgrid(x, y)
+        lat = 38. + (Y - Y.mean())/111e3
+        lon = -120. + (X - X.mean())/(111e3*np.cos(np.radians(38.)))
+        _var(nc, "XLAT", ("Time", "south_north", "west_east"), lat, "degree_north", "LATITUDE, SOUTH IS NEGATIVE")
+        _var(nc, "XLONG", ("Time", "south_north", "west_east"), lon, "degree_east", "LONGITUDE, WEST IS NEGATIVE")
+
+        # A hill in the far half of the domain
+        hgt = 300.*np.exp(-((X - 0.7*nx*dx)**2 + (Y - 0.5*ny*dy)**2)/(2*(0.15*nx*dx)**2))
+        _var(nc, "HGT", ("Time", "south_north", "west_east"), hgt, "m", "Terrain Height")
+
+        zw = _eta_heights(nz, ztop)[:, None, None]
+        zw = zw*(1 - hgt/ztop) + hgt                       # terrain following, flat at the top
+        _var(nc, "PHB", ("Time", "bottom_top_stag", "south_north", "west_east"), G*zw, "m2 s-2",
+             "base-state geopotential", "Z")
+        _var(nc, "PH", ("Time", "bottom_top_stag", "south_north", "west_east"),
+             G*rng.normal(0., 0.5, zw.shape)*(zw > hgt), "m2 s-2", "perturbation geopotential", "Z")
+        z = 0.5*(zw[1:] + zw[:-1]) - hgt                    # mass levels above ground
+        del zw
+
+        # Plume leaning downwind of the fire, taller and wider as the run goes on
+        r_fire = 100. + 900.*progress
+        top = 500. + 3000.*progress
+        px = X[None] - fx - 0.8*z
+        py = Y[None] - fy
+        core = np.exp(-(px**2 + py**2)/(0.5*r_fire + 0.1*z)**2)*np.exp(-(z/top)**2)
+        turb = core*rng.normal(0., 1., core.shape)
+
+        # Sheared westerly and a weak southerly wave, with a cyclonic swirl
+        # and turbulence in the plume
+        swirl = 0.02*progress*core
+        u = 4. + 8.*np.tanh(z/1500.) - swirl*py + turb
+        _var(nc, "U", ("Time", "bottom_top", "south_north", "west_east_stag"),
+             np.concatenate([u, u[:, :, -1:]], axis=2), "m s-1", "x-wind component", "X")
+        del u
+        v = 2.*np.sin(2*np.pi*X/(nx*dx))[None]*np.exp(-z/3000.) + swirl*px + turb
+        _var(nc, "V", ("Time", "bottom_top", "south_north_stag", "west_east"),
+             np.concatenate([v, v[:, -1:]], axis=1), "m s-1", "y-wind component", "Y")
+        del v, swirl, px, py
+
+        smoke = 10.*progress*core
+        smoke[smoke < 1e-4] = 0.
+        _var(nc, "fire_smoke", ("Time", "bottom_top", "south_north", "west_east"), smoke, "g kg-1", "smoke tracer")
+        del smoke
+
+        # Stable atmosphere, a little warmer in the plume
+        zmsl = z + hgt
+        mass = ("Time", "bottom_top", "south_north", "west_east")
+        _var(nc, "T", mass, 295. + 0.004*zmsl + 5.*progress*core - 300., "K",
+             "perturbation potential temperature theta-t0")
+        _var(nc, "P", mass, np.zeros_like(zmsl), "Pa", "perturbation pressure")
+        _var(nc, "PB", mass, 1e5*np.exp(-zmsl/8000.), "Pa", "BASE STATE PRESSURE")
+        _var(nc, "QVAPOR", mass, 0.008*np.exp(-zmsl/2500.), "kg kg-1", "Water vapor mixing ratio")
+        del zmsl
+        psfc = 1e5*np.exp(-hgt/8000.)
+        surface = ("Time", "south_north", "west_east")
+        _var(nc, "PSFC", surface, psfc, "Pa", "SFC PRESSURE")
+        _var(nc, "T2", surface, (295. + 0.004*hgt)*(psfc/1e5)**0.2854, "K", "TEMP at 2 M")
+        _var(nc, "Q2", surface, 0.008*np.exp(-hgt/2500.), "kg kg-1", "QV at 2 M")
+        _var(nc, "U10", surface, np.full_like(hgt, 4. + 8.*np.tanh(10./1500.)), "m s-1", "U at 10 M")
+        _var(nc, "V10", surface, 2.*np.sin(2*np.pi*X/(nx*dx)), "m s-1", "V at 10 M")
+
+        w = 8.*progress*core + 2.*turb
+        w = np.concatenate([np.zeros((1, ny, nx)), w], axis=0)
+        _var(nc, "W", ("Time", "bottom_top_stag", "south_north", "west_east"), w, "m s-1", "z-wind component", "Z")
+        del w, core, turb
+
+        # Burnt fraction on the refined fire grid: an ellipse stretched downwind
+        xs = (np.arange((nx+1)*sr_x) + 0.5)*dx/sr_x
+        ys = (np.arange((ny+1)*sr_y) + 0.5)*dy/sr_y
+        XS, YS = np.meshgrid(xs, ys)
+        dist = np.hypot((XS - fx - 0.5*r_fire)/2., YS - fy)
+        area = np.clip((0.5*r_fire - dist)/(dx/sr_x) + 0.5, 0., 1.)
+        _var(nc, "FIRE_AREA", ("Time", "south_north_subgrid", "west_east_subgrid"), area, "",
+             "fraction of cell area on fire", memory_order="XY ")
+    return Path(path)
+
+
+def wrfout_name(time, domain=1, colons=False):
+    name = "wrfout_d{:02d}_{}".format(domain, format_wrf_time(time))
+    return name if colons else name.replace(":", "_")
+
+
+def write_case(ncdir, frames=None, namelist=None, colons=False, **grid):
+    # A case's nc/ folder, one file per history interval. Grid sizes come
+    # from namelist (e_we/e_sn/e_vert, dx/dy, sr_x/sr_y) unless given.
+    ncdir = Path(ncdir)
+    ncdir.mkdir(parents=True, exist_ok=True)
+    settings = grid_from_namelist(namelist) if namelist is not None else {}
+    settings.update(grid)
+    start = settings.pop("start", datetime(1, 1, 1))
+    end = settings.pop("end", None)
+    interval = timedelta(seconds=settings.pop("history_interval_s", 120))
+    if frames is None:
+        frames = int((end - start)/interval) + 1 if end is not None else 1
+    paths = []
+    for frame in range(frames):
+        t = start + frame*interval
+        paths.append(write_wrfout(ncdir/wrfout_name(t, colons=colons), time=t, frame=frame, num_frames=frames,
+                                  **settings))
+    return paths
+
+
+HRRR_FILE_LEVELS = np.array((list(range(50, 1001, 25)) + [1013.2]), dtype=np.float32)
+
+
+# The HRRR's Lambert conformal grid, with the spacing stretched so a grid of
+# any size covers the whole domain
+HRRR_GRID = {"latitudeOfFirstGridPointInDegrees": 21.138123, "longitudeOfFirstGridPointInDegrees": 237.280472,
+             "LaDInDegrees": 38.5, "LoVInDegrees": 262.5, "Latin1InDegrees": 38.5, "Latin2InDegrees": 38.5,
+             "latitudeOfSouthernPoleInDegrees": -90., "longitudeOfSouthernPoleInDegrees": 0.}
+HRRR_NX, HRRR_NY, HRRR_DX = 1799, 1059, 3000.
+# GRIB parameter and level of each field, by its ncl_convert2nc name
+HRRR_GRIB_PARAMS = {
+    "HGT_P0_L1_GLC0": ("orog", "surface", 0),
+    "PRES_P0_L1_GLC0": ("sp", "surface", 0),
+    "POT_P0_L103_GLC0": ("pt", "heightAboveGround", 2),
+    "SPFH_P0_L103_GLC0": ("2sh", "heightAboveGround", 2),
+    "HGT_P0_L100_GLC0": ("gh", "isobaricInhPa", None),
+    "TMP_P0_L100_GLC0": ("t", "isobaricInhPa", None),
+    "SPFH_P0_L100_GLC0": ("q", "isobaricInhPa", None),
+    "DPT_P0_L100_GLC0": ("dpt", "isobaricInhPa", None),
+    "UGRD_P0_L100_GLC0": ("u", "isobaricInhPa", None),
+    "VGRD_P0_L100_GLC0": ("v", "isobaricInhPa", None),
+}
+
+
+def _hrrr_fields(lat, lon, seed=0):
+    # {ncl name: (level, y, x) or (y, x) array} of a plausible HRRR analysis
+    # on the given grid, levels top first
+    rng = np.random.default_rng(seed)
+    p = HRRR_FILE_LEVELS[:, None, None]
+    ter = np.clip(1500.*np.exp(-((lon + 112.)/8.)**2) + rng.normal(0., 50., lat.shape), 0., None)
+    sfc_T = 300. - 0.0065*ter + rng.normal(0., 1., lat.shape)
+    z = 44330.*(1 - (p/1013.25)**0.1903)
+    T = np.maximum(sfc_T - 0.0065*(z - ter), 210.)
+    Td = T - np.clip(8. + z/800., 1., 40.)
+    e = 6.112*np.exp(17.67*(Td - 273.15)/(Td - 29.65))
+    q = 0.622*e/(p - 0.378*e)
+    return {
+        "gridlat_0": lat,
+        "gridlon_0": lon,
+        "HGT_P0_L1_GLC0": ter,
+        "PRES_P0_L1_GLC0": 101325.*(1 - ter/44330.)**5.255,
+        "POT_P0_L103_GLC0": sfc_T + 0.0098*ter,
+        "SPFH_P0_L103_GLC0": q[-1],
+        "HGT_P0_L100_GLC0": z + 0.*ter,
+        "TMP_P0_L100_GLC0": T,
+        "SPFH_P0_L100_GLC0": q,
+        "DPT_P0_L100_GLC0": Td,
+        "UGRD_P0_L100_GLC0": 5. + z/600. + rng.normal(0., 2., T.shape),
+        "VGRD_P0_L100_GLC0": 3.*np.sin(z/3000.) + rng.normal(0., 1., T.shape),
+    }
+
+
+def write_hrrr(path, ny=300, nx=400, seed=0, lat=None, lon=None):
+    # An ncl_convert2nc'd HRRR pressure-level file with the variables
+    # sounding.SoundingData reads. Levels are stored top first, like the real one.
+    # lat/lon: the grid, e.g. one from write_hrrr_grib; default a curved one
+    # over the HRRR domain.
+    if lat is None:
+        j, i = np.mgrid[0:ny, 0:nx]
+        lat = 21.14 + 31.9*j/max(ny-1, 1) + 2.*np.sin(np.pi*i/max(nx-1, 1))
+        lon = -122.72 + 62.*i/max(nx-1, 1) - 12.*(j/max(ny-1, 1))*np.cos(np.pi*i/max(nx-1, 1))
+    ny, nx = lat.shape
+    fields = _hrrr_fields(lat, lon, seed)
+    with Dataset(path, "w", format="NETCDF4") as nc:
+        nc.createDimension("lv_ISBL0", len(HRRR_FILE_LEVELS))
+        nc.createDimension("ygrid_0", ny)
+        nc.createDimension("xgrid_0", nx)
+        lv = nc.createVariable("lv_ISBL0", "f4", ("lv_ISBL0",))
+        lv[:] = HRRR_FILE_LEVELS*100
+        for name, data in fields.items():
+            dims = ("lv_ISBL0", "ygrid_0", "xgrid_0") if data.ndim == 3 else ("ygrid_0", "xgrid_0")
+            nc.createVariable(name, "f4", dims)[:] = data
+    return Path(path)
+
+
+def write_hrrr_grib(path, ny=60, nx=90, seed=0, time=datetime(2020, 9, 5, 18)):
+    # The same fields as a wrfprs-like GRIB2 on the HRRR's projection (needs
+    # eccodes), for hrrrstore.ingest_grib. Returns the grid's lat/lon, which
+    # write_hrrr takes to write the matching netCDF.
+    import eccodes
+    grid = eccodes.codes_grib_new_from_samples("GRIB2")
+    try:
+        # The template first: it decides which of the other keys exist
+        eccodes.codes_set(grid, "gridDefinitionTemplateNumber", 30)
+        for key, value in dict(HRRR_GRID, shapeOfTheEarth=6, scanningMode=64, Nx=nx, Ny=ny,
+                               DxInMetres=HRRR_DX*(HRRR_NX-1)/max(nx-1, 1), DyInMetres=HRRR_DX*(HRRR_NY-1)/max(ny-1, 1),
+                               dataDate=int(time.strftime("%Y%m%d")), dataTime=int(time.strftime("%H%M")),
+                               packingType="grid_simple", bitsPerValue=24).items():
+            eccodes.codes_set(grid, key, value)
+        eccodes.codes_set_values(grid, np.zeros(nx*ny))
+        lat = eccodes.codes_get_array(grid, "latitudes").reshape(ny, nx)
+        lon = (eccodes.codes_get_array(grid, "longitudes").reshape(ny, nx) + 180.) % 360. - 180.
+        fields = _hrrr_fields(lat, lon, seed)
+        with open(path, "wb") as f:
+            for name, (param, level_type, level) in HRRR_GRIB_PARAMS.items():
+                data = fields[name]
+                # 1013.2 hPa is written in Pa, like the HRRR does
+                levels = [(level, data)] if level is not None else \
+                    [(int(round(p*100)), d) for p, d in zip(HRRR_FILE_LEVELS, data)]
+                for value, d in levels:
+                    msg = eccodes.codes_clone(grid)
+                    try:
+                        eccodes.codes_set(msg, "typeOfLevel", level_type)
+                        if level is None:
+                            eccodes.codes_set(msg, "scaleFactorOfFirstFixedSurface", 0)
+                            eccodes.codes_set(msg, "scaledValueOfFirstFixedSurface", value)
+                        else:
+                            eccodes.codes_set(msg, "level", value)
+                        eccodes.codes_set(msg, "shortName", param)
+                        eccodes.codes_set_values(msg, np.asarray(d, dtype=np.float64).ravel())
+                        eccodes.codes_write(msg, f)
+                    finally:
+                        eccodes.codes_release(msg)
+    finally:
+        eccodes.codes_release(grid)
+    return lat, lon
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic wrfout case (nc/ folder).")
+    parser.add_argument("ncdir")
+    parser.add_argument("--namelist", help="take e_we/e_sn/e_vert, dx/dy, sr_x/sr_y and the run length from here")
+    parser.add_argument("--frames", type=int)
+    parser.add_argument("--nx", type=int)
+    parser.add_argument("--ny", type=int)
+    parser.add_argument("--nz", type=int)
+    parser.add_argument("--colons", action="store_true", help="name files with colons, like WRF does")
+    args = parser.parse_args(argv)
+    grid = {k: getattr(args, k) for k in ("nx", "ny", "nz") if getattr(args, k) is not None}
+    for path in write_case(args.ncdir, args.frames, args.namelist, args.colons, **grid):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import os
+
+import numpy as np
+from netCDF4 import Dataset
+
+from lru import LRUCache
+
+# Same levels the plotting code has always used
+SMOKE_LEVELS = np.arange(50, 4001, 50)
+JVORT_LEVELS = np.arange(150, 4000, 50)
+
+
+class Weights:
+    def __init__(self, hgt, levels):
+        hgt = np.asarray(np.ma.getdata(hgt), dtype=np.float64)
+        levels = np.asarray(levels, dtype=np.float64).reshape(-1)
+        nz = hgt.shape[0]
+
+        # Number of model levels strictly below each target height, per column.
+        # Looping over the (short) model axis keeps the temporaries at one
+        # output cube instead of nz of them.
+        below = np.zeros((levels.size,) + hgt.shape[1:], dtype=np.int16)
+        target = levels.reshape((-1,) + (1,)*(hgt.ndim-1))
+        for k in range(nz):
+            below += hgt[k] < target
+
+        upper = np.clip(below, 1, nz-1).astype(np.intp)
+        lower = upper - 1
+        z0 = np.take_along_axis(hgt, lower, axis=0)
+        z1 = np.take_along_axis(hgt, upper, axis=0)
+
+        # interplevel only interpolates when the target lies strictly between
+        # two model levels, so exact hits and out-of-column targets are missing
+        self.valid = (z0 < target) & (z1 > target)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.w = np.where(self.valid, (target - z0)/(z1 - z0), 0.)
+        self.lower = lower
+        self.upper = upper
+        self.levels = levels
+        self.shape = hgt.shape
+
+    def subset(self, *index):
+        # Weights for a hyperslab of the columns, e.g. subset(js) for some j slices
+        index = (slice(None),) + index
+        sub = Weights.__new__(Weights)
+        sub.lower = self.lower[index]
+        sub.upper = self.upper[index]
+        sub.w = self.w[index]
+        sub.valid = self.valid[index]
+        sub.levels = self.levels
+        sub.shape = self.shape[:1] + sub.lower.shape[1:]
+        return sub
+
+    def window(self):
+        # The model levels the targets fall between, as a slice, and weights
+        # for a field read for only those levels
+        k0, k1 = int(self.lower.min()), int(self.upper.max()) + 1
+        sub = self.subset()
+        sub.lower = self.lower - k0
+        sub.upper = self.upper - k0
+        sub.shape = (k1 - k0,) + self.shape[1:]
+        return slice(k0, k1), sub
+
+    @property
+    def nbytes(self):
+        return self.lower.nbytes + self.upper.nbytes + self.w.nbytes + self.valid.nbytes
+
+    def interp(self, field, missing=np.nan, out=None):
+        data = np.ma.getdata(field)
+        if data.shape != self.shape:
+            raise ValueError("field shape {} does not match height shape {}".format(data.shape, self.shape))
+        dtype = np.result_type(data.dtype, np.float32)
+        if out is None:
+            out = np.empty(self.w.shape, dtype=dtype)
+        f = np.asarray(data, dtype=np.float64)
+        f0 = np.take_along_axis(f, self.lower, axis=0)
+        f1 = np.take_along_axis(f, self.upper, axis=0)
+        res = (1. - self.w)*f0 + self.w*f1
+        res[~self.valid] = missing
+        out[...] = res
+        return out
+
+
+def interp_levels(field, hgt, levels, missing=np.nan):
+    return Weights(hgt, levels).interp(field, missing=missing)
+
+
+class WeightsCache:
+    def __init__(self, max_bytes=512*2**20, reuse_tol=None):
+        self.reuse_tol = reuse_tol
+        self._lru = LRUCache(max_bytes)
+        # Keys of the last height field and the weights built from it for
+        # each set of levels, used to carry weights over to the next frame
+        # when heights barely move. Both live in the LRU, so they count
+        # against max_bytes, and there's nothing to reuse once they're evicted.
+        self._recent = {}
+
+    @staticmethod
+    def _path(nc):
+        # The file with its size and mtime, so a file rewritten in place
+        # (e.g. while watch.py follows a run) isn't served stale weights
+        path = nc.filepath() if isinstance(nc, Dataset) else str(nc)
+        st = os.stat(path)
+        return path, st.st_size, st.st_mtime_ns
+
+    def height(self, nc, timeidx=0):
+        key = ("hgt", self._path(nc), timeidx)
+        hgt = self._lru.get(key)
+        if hgt is None:
+            # wrf-python only here, so vinterp users that get their heights
+            # from WrfoutFile.height_agl don't need it
+            from wrf import getvar, to_np
+            if isinstance(nc, Dataset):
+                hgt = to_np(getvar(nc, 'height_agl', timeidx=timeidx, units='m'))
+            else:
+                with Dataset(nc) as ds:
+                    hgt = to_np(getvar(ds, 'height_agl', timeidx=timeidx, units='m'))
+            self._lru.put(key, hgt)
+        return hgt
+
+    def weights(self, nc, levels, timeidx=0):
+        path = self._path(nc)
+        levels = np.asarray(levels, dtype=np.float64).reshape(-1)
+        lkey = levels.tobytes()
+        key = ("weights", path, timeidx, lkey)
+        weights = self._lru.get(key)
+        if weights is not None:
+            return weights
+
+        hgt = self.height(nc, timeidx)
+        hkey = ("hgt", path, timeidx)
+        recent = self._recent.get(lkey)
+        if self.reuse_tol is not None and recent is not None:
+            recent_hgt, weights = self._lru.get(recent[0]), self._lru.get(recent[1])
+            if recent_hgt is not None and weights is not None and recent_hgt.shape == hgt.shape \
+                    and np.max(np.abs(recent_hgt - hgt)) <= self.reuse_tol:
+                return self._lru.put(key, weights)
+        weights = self._lru.put(key, Weights(hgt, levels))
+        self._recent[lkey] = (hkey, key)
+        return weights
+
+    def interp(self, nc, field, levels, timeidx=0, missing=np.nan):
+        return self.weights(nc, levels, timeidx).interp(field, missing=missing)
+
+    def clear(self):
+        self._lru.clear()
+        self._recent.clear()
@@ -1,61 +1,48 @@
 import numpy as np
-from netCDF4 import Dataset
 from pathlib import Path
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from matplotlib.ticker import FormatStrFormatter
-from wrf import interplevel, to_np, getvar
-
-def _discrete_curl(a0, a1, b0, b1, da, db):
-    return ((b1-b0)/da)-((a1-a0)/db)
-
-def _mean_interp(x0, x1, y0, y1):
-    return np.mean([x0, x1, y0, y1])
-
-def kvort(U_wrf, V_wrf, level):
-    u = U_wrf.transpose(2, 1, 0)[:,:,level]
-    v = V_wrf.transpose(2, 1, 0)[:,:,level]
-
-    _,usize = u.shape
-    vsize,_ = v.shape
-    u0 = u[1:usize,0:usize-1]
-    u1 = u[1:usize,1:usize]
-    v0 = v[0:vsize-1,1:vsize]
-    v1 = v[1:vsize,1:vsize]
-    curl = np.vectorize(_discrete_curl, excluded=['da', 'db'])
-    interp = np.vectorize(_mean_interp)
-    rawvort = curl(u0, u1, v0, v1, 50, 50)
-    num_x, num_y = rawvort.shape
-    rawvortx1y1 = rawvort[0:num_x-1,0:num_y-1]
-    rawvortx1y2 = rawvort[0:num_x-1,1:num_y]
-    rawvortx2y1 = rawvort[1:num_x,0:num_y-1]
-    rawvortx2y2 = rawvort[1:num_x,1:num_y]
-    a = np.zeros((usize,vsize))
-    a[1:usize-1, 1:vsize-1] = interp(rawvortx1y1, rawvortx1y2, rawvortx2y1, rawvortx2y2)
-    return a
+from framesink import figure_rgb
+from stages import stage
+from vinterp import Weights, JVORT_LEVELS
+from wrfout import WrfoutFile
 
-def plotkvortw(frame, file, bounds, datapath, targetdir, level):
-    nc = Dataset(datapath/file)
-    U = nc["U"][0,:,:,:]
-    V = nc["V"][0,:,:,:]
-    W = nc["W"][0,:,:,:]
+def _corner_mean(raw):
+    return (raw[..., :-1, :-1] + raw[..., 1:, :-1] + raw[..., :-1, 1:] + raw[..., 1:, 1:])/4
 
-    x1, x2, y1, y2 = bounds
-
-    aspect_ratio = 16*(x2-x1)/(y2-y1)
+def kvort3d(U_wrf, V_wrf, dx=50., dy=50., levels=None):
+    # U (nz, ny, nx+1) and V (nz, ny+1, nx) as stored in wrfout; returns the
+    # vertical vorticity on the mass grid, (nz, ny, nx), zero on the edges
+    U = np.asarray(np.ma.getdata(U_wrf), dtype=np.float64)
+    V = np.asarray(np.ma.getdata(V_wrf), dtype=np.float64)
+    if levels is not None:
+        U = U[levels]
+        V = V[levels]
+    nz, ny, nxs = U.shape
+    nx = nxs - 1
+    dvdx = (V[:, 1:ny, 1:nx] - V[:, 1:ny, 0:nx-1])/dx
+    dudy = (U[:, 1:ny, 1:nx] - U[:, 0:ny-1, 1:nx])/dy
+    a = np.zeros((nz, ny, nx))
+    a[:, 1:ny-1, 1:nx-1] = _corner_mean(dvdx - dudy)
+    return a
 
-    avo = kvort(U, V, level)[x1:x2,y1:y2]
-    w = W.transpose(2, 1, 0)[x1:x2,y1:y2,level]
+def kvort(U_wrf, V_wrf, level, dx=50., dy=50.):
+    return kvort3d(U_wrf, V_wrf, dx, dy, levels=[level])[0].T
 
-    xm, ym = 50*np.mgrid[x1:x2, y1:y2]
-    
-    fig = plt.figure(figsize=(aspect_ratio, 12))
-    ax = plt.axes()
+def _vort_shading(ax, xm, ym, avo):
+    return ax.contourf(xm, ym, avo, np.linspace(-0.2, 0.2, 33), cmap=plt.get_cmap("bwr").with_extremes(over='darkred', under='darkblue'), extend='both')
 
-    if not(np.all(w==0)):
-        cont = plt.contour(xm, ym, w, [0, 5, 15], cmap=plt.get_cmap("rainbow"))
-        ax.clabel(cont, [0, 5, 15], inline=True)
+def _w_contours(ax, xm, ym, w):
+    # [] when there is no vertical motion to draw
+    if np.all(w==0):
+        return []
+    cont = ax.contour(xm, ym, w, [0, 5, 15], cmap=plt.get_cmap("rainbow"))
+    ax.clabel(cont, [0, 5, 15], inline=True)
+    return [cont]
 
-    contf = plt.contourf(xm, ym, avo, np.linspace(-0.2, 0.2, 33), cmap=plt.get_cmap("bwr").with_extremes(over='darkred', under='darkblue'), extend='both')
+def _vort_decorate(fig, ax, contf, title, ylabel):
     cb = fig.colorbar(contf, orientation='horizontal', fraction=0.2, pad=0.075, shrink=0.8, ticks=np.linspace(-0.2, 0.2, 9), extend='both')
     cb.set_label(label='Vorticity (s$^{-1}$)', size=15, weight='bold')
     cb.ax.set_xticklabels(np.linspace(-0.2, 0.2, 9))
@@ -63,80 +50,208 @@ def plotkvortw(frame, file, bounds, datapath, targetdir, level):
 
     ax.set_aspect('equal')
 
-    plt.title("K Component Vorticity (s$^{-1}$, shaded) and Vertical Velocity ($\\frac{m}{s}$, contour lines) ", pad=15, size=15, weight='bold')
-    plt.xlabel("x coordinate (m)", size=10)
-    plt.ylabel("y coordinate (m)", size=10)
-    plt.savefig(targetdir/(str(frame)+".png"), dpi=fig.dpi, bbox_inches='tight')
-    plt.close(fig)
+    ax.set_title(title, pad=15, size=15, weight='bold')
+    ax.set_xlabel("x coordinate (m)", size=10)
+    ax.set_ylabel(ylabel, size=10)
 
-def jvort(U_wrf, W_wrf, level):
-    u = U_wrf.transpose(2, 1, 0)[:,level,:]
-    w = W_wrf.transpose(2, 1, 0)[:,level,:]
-
-    usize,_ = u.shape
-    usize-=1
-    _,wsize = w.shape
-    wsize-=1
-    u0 = u[0:usize,0:wsize]
-    u1 = u[0:usize,1:wsize+1]
-    w0 = w[0:usize,0:wsize]
-    w1 = w[1:usize+1,0:wsize]
-    curl = np.vectorize(_discrete_curl, excluded=['da', 'db'])
-    interp = np.vectorize(_mean_interp)
-    rawvort = curl(w0, w1, u0, u1, 50, 50)
-    num_x, num_y = rawvort.shape
-    rawvortx1y1 = rawvort[0:num_x-1,0:num_y-1]
-    rawvortx1y2 = rawvort[0:num_x-1,1:num_y]
-    rawvortx2y1 = rawvort[1:num_x,0:num_y-1]
-    rawvortx2y2 = rawvort[1:num_x,1:num_y]
-    a = np.zeros((usize+1,wsize+1))
-    a[1:usize, 1:wsize] = interp(rawvortx1y1, rawvortx1y2, rawvortx2y1, rawvortx2y2)
-    return a
+KVORTW_TITLE = "K Component Vorticity (s$^{-1}$, shaded) and Vertical Velocity ($\\frac{m}{s}$, contour lines) "
+JVORT_TITLE = "J Component Vorticity (s$^{-1}$, shaded)"
 
-def plotjvort(frame, file, datapath, targetdir, level):
-    nc = Dataset(datapath/file)
-    hgt = to_np(getvar(nc, 'height_agl', units='m'))
-    U = nc["U"][0,:,:,:]
-    _, _, usize = U.shape
-    U = U[:,:,1:usize]
-    W = nc["W"][0,:,:,:]
-    wsize, _, _ = W.shape
-    W = W[1:wsize,:,:]
-
-    Uinterp = interplevel(U, hgt, 150)
-    for h in range(200,4000,50):
-        Uinterp = np.dstack((Uinterp, interplevel(U, hgt, h)))
-    Winterp = interplevel(W, hgt, 150)
-    for h in range(200,4000,50):
-        Winterp = np.dstack((Winterp, interplevel(W, hgt, h)))
-    Uinterp = Uinterp.transpose(2, 0, 1)
-    Winterp = Winterp.transpose(2, 0, 1)
-
-    avo = jvort(Uinterp, Winterp, level)
+def _kvortw_figsize(avo):
     x, y = avo.shape
+    return (16*x/y, 12)
 
-    xm, ym = 50*np.mgrid[0:x, 0:y]
-    
-    fig = plt.figure(figsize=(round(x*12/y), 12))
-    ax = plt.axes()
+def _jvort_figsize(avo):
+    x, y = avo.shape
+    return (round(x*12/y), 12)
 
+def _draw_kvortw(avo, w, xm, ym, filename):
+    with stage("draw"):
+        fig = plt.figure(figsize=_kvortw_figsize(avo))
+        ax = plt.axes()
 
-    contf = plt.contourf(xm, ym, avo, np.linspace(-0.2, 0.2, 33), cmap=plt.get_cmap("bwr").with_extremes(over='darkred', under='darkblue'), extend='both')
-    cb = fig.colorbar(contf, orientation='horizontal', fraction=0.2, pad=0.075, shrink=0.8, ticks=np.linspace(-0.2, 0.2, 9), extend='both')
-    cb.set_label(label='Vorticity (s$^{-1}$)', size=15, weight='bold')
-    cb.ax.set_xticklabels(np.linspace(-0.2, 0.2, 9))
-    cb.ax.xaxis.set_major_formatter(FormatStrFormatter('%.2f'))
+        _w_contours(ax, xm, ym, w)
+        contf = _vort_shading(ax, xm, ym, avo)
+        _vort_decorate(fig, ax, contf, KVORTW_TITLE, "y coordinate (m)")
+    with stage("savefig"):
+        plt.savefig(filename, dpi=fig.dpi, bbox_inches='tight')
+    plt.close(fig)
 
-    ax.set_aspect('equal')
+class VortAnimation:
+    # Sends plotkvortw/plotjvort frames to a framesink sink. The figure,
+    # axes, colorbar and labels are built once; each frame only replaces
+    # the vorticity shading (and w contours) and grabs the raw pixels.
+    # kind: "k" (plotkvortw layout) or "j" (plotjvort layout)
+    def __init__(self, sink, kind="k", dpi=100):
+        self.sink = sink
+        self.kind = kind
+        self.dpi = dpi
+        self.fig = None
+        self._layers = []
+
+    def _build(self, avo, xm, ym):
+        figsize = _kvortw_figsize(avo) if self.kind == "k" else _jvort_figsize(avo)
+        self.fig = Figure(figsize=figsize, dpi=self.dpi)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot()
+        contf = _vort_shading(self.ax, xm, ym, avo)
+        if self.kind == "k":
+            _vort_decorate(self.fig, self.ax, contf, KVORTW_TITLE, "y coordinate (m)")
+        else:
+            _vort_decorate(self.fig, self.ax, contf, JVORT_TITLE, "z coordinate (m)")
+        self._layers = [contf]
+        self._shape = avo.shape
+        # Fixed crop to the first frame's tight bbox (what bbox_inches='tight'
+        # does for the pngs), so every frame has the same size
+        self.fig.canvas.draw()
+        bbox = self.fig.get_tightbbox(self.fig.canvas.get_renderer()).padded(0.1)
+        h = self.fig.bbox.height
+        self._crop = (slice(max(int(h - bbox.y1*self.dpi), 0), int(np.ceil(h - bbox.y0*self.dpi))),
+                      slice(max(int(bbox.x0*self.dpi), 0), int(np.ceil(bbox.x1*self.dpi))))
 
-    plt.title("J Component Vorticity (s$^{-1}$, shaded)", pad=15, size=15, weight='bold')
-    plt.xlabel("x coordinate (m)", size=10)
-    plt.ylabel("z coordinate (m)", size=10)
-    plt.savefig(targetdir/(str(frame)+".png"), dpi=fig.dpi, bbox_inches='tight')
+    def draw(self, avo, xm, ym, w=None):
+        with stage("draw"):
+            if self.fig is None or avo.shape != self._shape:
+                self._build(avo, xm, ym)
+            else:
+                for layer in self._layers:
+                    # clabel texts aren't always removed with their contours
+                    for text in getattr(layer, "labelTexts", []):
+                        text.remove()
+                    getattr(layer, "labelTexts", []).clear()
+                    layer.remove()
+                # Same levels and colormap, so the existing colorbar still applies
+                self._layers = [_vort_shading(self.ax, xm, ym, avo)]
+            if w is not None:
+                self._layers += _w_contours(self.ax, xm, ym, w)
+        with stage("rasterize"):
+            rgb = figure_rgb(self.fig)[self._crop]
+        with stage("encode"):
+            self.sink.write(rgb)
+
+def plotkvortw(frame, file, bounds, datapath, targetdir, level):
+    plotkvortw_sweep(file, bounds, datapath, targetdir, [level], frames=[frame])
+
+def _kvort_box(wf, levels, bounds):
+    # Read the box plus a one-cell halo so its edge cells come out the same
+    # as when the whole domain is computed
+    x1, x2, y1, y2 = bounds
+    xa, xb = max(x1-1, 0), min(x2+1, wf.nx)
+    ya, yb = max(y1-1, 0), min(y2+1, wf.ny)
+    with stage("read"):
+        U = wf.levels("U", levels, slice(ya, yb), slice(xa, xb+1))
+        V = wf.levels("V", levels, slice(ya, yb+1), slice(xa, xb))
+    with stage("curl"):
+        return kvort3d(U, V, wf.dx, wf.dy)[:, y1-ya:y2-ya, x1-xa:x2-xa]
+
+def plotkvortw_sweep(file, bounds, datapath, targetdir, levels, frames=None, animation=None):
+    # animation: a VortAnimation to send the frames to instead of writing pngs
+    x1, x2, y1, y2 = bounds
+    if frames is None:
+        frames = range(len(levels))
+
+    with stage("plotkvortw", file=str(file)):
+        with WrfoutFile(datapath/file) as wf:
+            avo = _kvort_box(wf, levels, bounds).transpose(0, 2, 1)
+            with stage("read"):
+                w = wf.levels("W", levels, slice(y1, y2), slice(x1, x2)).transpose(0, 2, 1)
+            dx, dy = wf.dx, wf.dy
+
+        xm, ym = np.mgrid[x1:x2, y1:y2]
+        xm, ym = dx*xm, dy*ym
+
+        for frame, a, wk in zip(frames, avo, w):
+            if animation is not None:
+                animation.draw(a, xm, ym, wk)
+            else:
+                _draw_kvortw(a, wk, xm, ym, targetdir/(str(frame)+".png"))
+
+def jvort3d(U_wrf, W_wrf, dx=50., dz=50., slices=None):
+    # U and W already on common (nz, ny, nx) points, e.g. height levels;
+    # returns the y vorticity for every j slice as (ny, nx, nz)
+    U = np.asarray(np.ma.getdata(U_wrf), dtype=np.float64)
+    W = np.asarray(np.ma.getdata(W_wrf), dtype=np.float64)
+    if slices is not None:
+        U = U[:, slices]
+        W = W[:, slices]
+    nz, ny, nx = U.shape
+    dudz = (U[1:nz, :, 0:nx-1] - U[0:nz-1, :, 0:nx-1])/dz
+    dwdx = (W[0:nz-1, :, 1:nx] - W[0:nz-1, :, 0:nx-1])/dx
+    raw = (dudz - dwdx).transpose(1, 2, 0)
+    a = np.zeros((ny, nx, nz))
+    a[:, 1:nx-1, 1:nz-1] = _corner_mean(raw)
+    return a
+
+def jvort(U_wrf, W_wrf, level, dx=50., dz=50.):
+    return jvort3d(U_wrf, W_wrf, dx, dz, slices=[level])[0]
+
+def _draw_jvort(avo, xm, ym, filename):
+    with stage("draw"):
+        fig = plt.figure(figsize=_jvort_figsize(avo))
+        ax = plt.axes()
+
+        contf = _vort_shading(ax, xm, ym, avo)
+        _vort_decorate(fig, ax, contf, JVORT_TITLE, "z coordinate (m)")
+    with stage("savefig"):
+        plt.savefig(filename, dpi=fig.dpi, bbox_inches='tight')
     plt.close(fig)
 
+UW_SETTINGS = {"levels": JVORT_LEVELS, "version": 1}
+
+def interp_uw(wf, weights_cache=None, slices=None, product_cache=None):
+    # U and W on the height levels, for all j or only the given j slices
+    js = slice(None) if slices is None else slices
+    if product_cache is not None:
+        def compute():
+            Uinterp, Winterp = interp_uw(wf, weights_cache)
+            dims = ("level", "south_north", "west_east")
+            return {"U": (dims, Uinterp), "W": (dims, Winterp)}
+        # Chunked by j slice, so slice plots only decompress the slices they draw
+        chunk = (len(JVORT_LEVELS), 1, wf.nx)
+        with product_cache.get_or_compute(wf.path, "uw", UW_SETTINGS, compute, {"U": chunk, "W": chunk}) as entry, \
+                stage("cache_read"):
+            return entry.read("U", slice(None), js, slice(None)), entry.read("W", slice(None), js, slice(None))
+    with stage("read"):
+        U = wf.read("U", slice(None), js, slice(1, None))
+        W = wf.read("W", slice(1, None), js, slice(None))
+
+    with stage("height"):
+        if weights_cache is None:
+            weights = Weights(wf.height_agl(js), JVORT_LEVELS)
+        else:
+            weights = weights_cache.weights(wf.nc, JVORT_LEVELS, wf.timeidx)
+            if slices is not None:
+                weights = weights.subset(js)
+    with stage("interp"):
+        return weights.interp(U), weights.interp(W)
+
+def plotjvort(frame, file, datapath, targetdir, level, weights_cache=None, product_cache=None):
+    plotjvort_sweep(file, datapath, targetdir, [level], frames=[frame], weights_cache=weights_cache,
+                    product_cache=product_cache)
+
+def plotjvort_sweep(file, datapath, targetdir, levels, frames=None, weights_cache=None, product_cache=None,
+                    animation=None):
+    if frames is None:
+        frames = range(len(levels))
+    with stage("plotjvort", file=str(file)):
+        with WrfoutFile(datapath/file) as wf:
+            Uinterp, Winterp = interp_uw(wf, weights_cache, slices=list(levels), product_cache=product_cache)
+            dx = wf.dx
+
+        dz = JVORT_LEVELS[1] - JVORT_LEVELS[0]
+        with stage("curl"):
+            avo = jvort3d(Uinterp, Winterp, dx, dz)
+        _, x, y = avo.shape
+
+        xm, ym = np.mgrid[0:x, 0:y]
+        xm, ym = dx*xm, dz*ym
+
+        for frame, a in zip(frames, avo):
+            if animation is not None:
+                animation.draw(a, xm, ym)
+            else:
+                _draw_jvort(a, xm, ym, targetdir/(str(frame)+".png"))
+
 def getnumj(file, datapath):
-    nc = Dataset(datapath/file)
-    U = nc["U"][0,:,:,:]
-    _, y, _ = U.shape
-    return y
\ No newline at end of file
+    with WrfoutFile(datapath/file) as wf:
+        return wf.ny
\ No newline at end of file
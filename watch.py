@@ -0,0 +1,314 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from multiprocessing import get_context
+from pathlib import Path
+
+from netCDF4 import Dataset
+
+from input_sounding import wrfout_column, write_input_sounding
+from productcache import ProductCache
+from smoke import smoke_and_area, aniFunc
+from stages import stage, enable as enable_stages
+from synthwrf import grid_from_namelist
+from vort import plotkvortw_sweep, plotjvort_sweep
+from wrfout import WrfoutFile, list_wrfout
+
+# Post-processes a case while WRF is still writing it: every poll, the
+# wrfout files in <case>/nc that have stopped changing are renamed like
+# rename.py does (colons to underscores) and the chosen stages are run on
+# them in a process pool. What's been done is kept in <case>/watch.json, so
+# a restarted watch only does the frames and stages that are missing, and
+# redoes a frame whose file, or the settings of the stage, have changed since.
+#
+# Stages, each writing where the batch tools do:
+#   smoke     interpolated smoke cube + fire area into <case>/cache
+#   kvort     plotkvortw pngs, <case>/plots/kvort/<frame>/<level>.png
+#   jvort     plotjvort pngs, <case>/plots/yvort/<frame>/<j>.png
+#   sounding  the model column as <case>/soundings/wrf/<frame>/input_sounding
+#   frame3d   the mayavi frame, <case>/plots/smoke/<frame>.png
+
+DEFAULT_STAGES = ("smoke", "kvort", "jvort")
+# Times a stage is resubmitted after a dead worker took it down
+POOL_RETRIES = 2
+DEFAULT_SETTINGS = {
+    "kvort_levels": [5, 10, 20],        # model levels
+    "jvort_stride": 5,                  # every 5th j slice, like the notebooks
+    "sounding_point": None,             # (i, j); default the domain centre
+    "num_frames": None,                 # last frame number, for the frame3d camera path
+    "plot_kwargs": {"r_mv_cmap": True, "squish": 19.5, "disp": 0.5},
+}
+
+
+def _smoke(case_dir, file, frame, settings):
+    product_cache = ProductCache(case_dir/"cache")
+    smoke_and_area(file, product_cache=product_cache)
+    return [product_cache.path(file, "smoke")]
+
+
+def _kvort(case_dir, file, frame, settings):
+    outdir = case_dir/"plots"/"kvort"/str(frame)
+    outdir.mkdir(parents=True, exist_ok=True)
+    with WrfoutFile(file) as wf:
+        bounds = (0, wf.nx, 0, wf.ny)
+    levels = settings["kvort_levels"]
+    plotkvortw_sweep(file.name, bounds, file.parent, outdir, levels, frames=levels)
+    return [outdir]
+
+
+def _jvort(case_dir, file, frame, settings):
+    outdir = case_dir/"plots"/"yvort"/str(frame)
+    outdir.mkdir(parents=True, exist_ok=True)
+    with WrfoutFile(file) as wf:
+        js = list(range(0, wf.ny, settings["jvort_stride"]))
+    plotjvort_sweep(file.name, file.parent, outdir, js, frames=js, product_cache=ProductCache(case_dir/"cache"))
+    return [outdir]
+
+
+def _sounding(case_dir, file, frame, settings):
+    out = case_dir/"soundings"/"wrf"/str(frame)/"input_sounding"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    with WrfoutFile(file) as wf:
+        i, j = settings["sounding_point"] or (wf.nx//2, wf.ny//2)
+        sfc, profile = wrfout_column(wf, i, j)
+    write_input_sounding(out, sfc, profile)
+    return [out]
+
+
+def _frame3d(case_dir, file, frame, settings):
+    # Colours are scaled per frame: the run's global ranges aren't known yet
+    import render_smoke
+    render_smoke._init_worker()
+    out = case_dir/"plots"/"smoke"/(str(frame) + ".png")
+    out.parent.mkdir(parents=True, exist_ok=True)
+    render_smoke._render_frame(case_dir.name, file, frame, settings["num_frames"], out, settings["plot_kwargs"],
+                               ProductCache(case_dir/"cache"))
+    return [out]
+
+
+STAGES = {
+    "smoke": _smoke,
+    "kvort": _kvort,
+    "jvort": _jvort,
+    "sounding": _sounding,
+    "frame3d": _frame3d,
+}
+
+# The settings each stage's outputs depend on
+STAGE_SETTINGS = {
+    "smoke": (),
+    "kvort": ("kvort_levels",),
+    "jvort": ("jvort_stride",),
+    "sounding": ("sounding_point",),
+    "frame3d": ("num_frames", "plot_kwargs"),
+}
+
+
+def stage_settings(name, settings):
+    # As they'd come back from watch.json, so they compare equal
+    return json.loads(json.dumps({k: settings[k] for k in STAGE_SETTINGS[name]}, sort_keys=True))
+
+
+def _run_stage(name, case_dir, file, frame, settings):
+    t0 = time.perf_counter()
+    with stage("watch_" + name, frame=frame):
+        outputs = STAGES[name](Path(case_dir), Path(file), frame, settings)
+    return time.perf_counter() - t0, [str(p) for p in outputs]
+
+
+class Manifest:
+    # <case>/watch.json: for each wrfout file, its frame, the size and mtime
+    # it had when processed and the stages done on it (or that failed), with
+    # the settings they were done with
+    def __init__(self, path):
+        self.path = Path(path)
+        self.files = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.files = json.load(f)["files"]
+
+    @staticmethod
+    def _stat(file):
+        st = file.stat()
+        return st.st_size, st.st_mtime
+
+    def done(self, file, name, settings=None):
+        entry = self.files.get(file.name)
+        if entry is None or (entry["size"], entry["mtime"]) != self._stat(file):
+            return False
+        result = entry["stages"].get(name)
+        return result is not None and "error" not in result and result.get("settings") == settings
+
+    def record(self, file, frame, name, seconds=None, outputs=(), error=None, settings=None):
+        size, mtime = self._stat(file)
+        entry = self.files.get(file.name)
+        if entry is None or (entry["size"], entry["mtime"]) != (size, mtime):
+            entry = self.files[file.name] = {"frame": frame, "size": size, "mtime": mtime, "stages": {}}
+        result = {"finished": datetime.now().isoformat(timespec="seconds"), "settings": settings}
+        if error is None:
+            result.update(seconds=round(seconds, 3), outputs=list(outputs))
+        else:
+            result["error"] = error
+        entry["stages"][name] = result
+        self.save()
+
+    def save(self):
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"files": self.files}, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+def _readable(path):
+    try:
+        with Dataset(path) as nc:
+            return len(nc.dimensions["Time"]) > 0
+    except (OSError, KeyError):
+        return False
+
+
+def completed_files(ncdir, seen, settle=30.):
+    # The wrfout files WRF has finished writing, in time order: unchanged
+    # since the last poll, not modified for settle seconds and readable.
+    # Stops at the first file that isn't, so frame numbers never shift.
+    # Finished files with colons in their names are renamed to underscores.
+    # seen: {name: (size, mtime)} carried between polls.
+    now = time.time()
+    done = []
+    for path in list_wrfout(ncdir):
+        st = path.stat()
+        key = (st.st_size, st.st_mtime)
+        stable = seen.get(path.name, key) == key and now - st.st_mtime >= settle
+        seen[path.name] = key
+        if not stable or not _readable(path):
+            break
+        if ":" in path.name:
+            renamed = path.with_name(path.name.replace(":", "_"))
+            if not renamed.exists():
+                os.replace(path, renamed)
+                seen[renamed.name] = key
+                path = renamed
+        done.append(path)
+    return done
+
+
+def watch(case_dir, stages=DEFAULT_STAGES, settings=None, processes=1, poll=10., settle=30., once=False,
+          idle_exit=None):
+    # Runs until the run's last frame (from <case>/namelist.input) is done,
+    # after idle_exit seconds without a new file, or with once, as soon as
+    # the files there are now are done. Returns the manifest.
+    case_dir = Path(case_dir)
+    ncdir = case_dir/"nc"
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError("unknown stages: {}".format(", ".join(sorted(unknown))))
+    settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+    expected = None
+    if (case_dir/"namelist.input").exists():
+        grid = grid_from_namelist(case_dir/"namelist.input")
+        expected = int((grid["end"] - grid["start"]).total_seconds()//grid["history_interval_s"]) + 1
+        if settings["num_frames"] is None:
+            settings["num_frames"] = max(expected - 1, 1)
+    if "frame3d" in stages:
+        if case_dir.name not in aniFunc:
+            raise ValueError("no camera path for case {!r} in smoke.aniFunc".format(case_dir.name))
+        if settings["num_frames"] is None:
+            raise ValueError("frame3d needs num_frames when there is no namelist.input")
+
+    manifest = Manifest(case_dir/"watch.json")
+    done_with = {name: stage_settings(name, settings) for name in stages}
+    seen, submitted, running, retries = {}, set(), {}, {}
+    last_new, count = time.time(), 0
+    # spawn, so frame3d workers don't inherit a VTK/GL context
+    new_pool = lambda: ProcessPoolExecutor(processes, mp_context=get_context("spawn"))
+    pool = new_pool()
+    try:
+        while True:
+            files = completed_files(ncdir, seen, settle)
+            if len(files) > count:
+                last_new, count = time.time(), len(files)
+            for frame, file in enumerate(files):
+                for name in stages:
+                    key = (file.name, name, seen[file.name])
+                    if key in submitted or manifest.done(file, name, done_with[name]):
+                        continue
+                    submitted.add(key)
+                    try:
+                        future = pool.submit(_run_stage, name, case_dir, file, frame, settings)
+                    except BrokenProcessPool:
+                        # A worker died (a crash in VTK/GL, the OOM killer)
+                        # after the last results came in
+                        pool.shutdown(wait=False)
+                        pool = new_pool()
+                        future = pool.submit(_run_stage, name, case_dir, file, frame, settings)
+                    running[future] = (name, file, frame, key)
+            if not running and (once or (expected is not None and count >= expected) or
+                                (idle_exit is not None and time.time() - last_new > idle_exit)):
+                break
+            if not running:
+                time.sleep(poll)
+                continue
+            done, _ = wait(running, timeout=poll, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                name, file, frame, key = running.pop(future)
+                try:
+                    seconds, outputs = future.result()
+                except Exception as e:
+                    error = "{}: {}".format(type(e).__name__, e)
+                    manifest.record(file, frame, name, error=error, settings=done_with[name])
+                    print("frame {:4d} {:9s} failed: {}".format(frame, name, error), flush=True)
+                    # Every stage running when a worker dies fails with
+                    # BrokenProcessPool, mostly through no fault of its own,
+                    # so they go round again on the new pool (a few times)
+                    if isinstance(e, BrokenProcessPool):
+                        broken = True
+                        retries[key] = retries.get(key, 0) + 1
+                        if retries[key] <= POOL_RETRIES:
+                            submitted.discard(key)
+                else:
+                    manifest.record(file, frame, name, seconds, outputs, settings=done_with[name])
+                    print("frame {:4d} {:9s} {:7.1f} s  {}".format(frame, name, seconds, file.name), flush=True)
+            if broken:
+                print("a worker process died, starting a new pool", flush=True)
+                pool.shutdown(wait=False)
+                pool = new_pool()
+    finally:
+        pool.shutdown()
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Post-process a case's wrfout files as WRF writes them.")
+    parser.add_argument("case", help="case name (creek, loyalton, tor) or case directory, with the files in nc/")
+    parser.add_argument("--stages", nargs="+", choices=sorted(STAGES), default=list(DEFAULT_STAGES))
+    parser.add_argument("-j", "--processes", type=int, default=1)
+    parser.add_argument("--poll", type=float, default=10., help="seconds between looks at nc/")
+    parser.add_argument("--settle", type=float, default=30.,
+                        help="seconds a file must go unmodified before it counts as finished")
+    parser.add_argument("--once", action="store_true", help="process the finished files there are now and exit")
+    parser.add_argument("--idle-exit", type=float, metavar="SECONDS", help="exit after this long without a new file")
+    parser.add_argument("--kvort-levels", type=int, nargs="+", default=DEFAULT_SETTINGS["kvort_levels"])
+    parser.add_argument("--jvort-stride", type=int, default=DEFAULT_SETTINGS["jvort_stride"])
+    parser.add_argument("--sounding-point", type=int, nargs=2, metavar=("I", "J"))
+    parser.add_argument("--num-frames", type=int, help="last frame number for frame3d (default from namelist.input)")
+    parser.add_argument("--stages-log", nargs="?", const="-", metavar="PATH",
+                        help="time the stages of every frame and print a summary at exit (see stages.py)")
+    args = parser.parse_args(argv)
+    if args.stages_log:
+        enable_stages(None if args.stages_log == "-" else args.stages_log)
+
+    case_dir = Path(args.case)
+    if not case_dir.is_dir():
+        case_dir = Path(__file__).resolve().parent/args.case
+    settings = {"kvort_levels": args.kvort_levels, "jvort_stride": args.jvort_stride,
+                "sounding_point": args.sounding_point, "num_frames": args.num_frames}
+    watch(case_dir, args.stages, settings, args.processes, args.poll, args.settle, args.once, args.idle_exit)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from netCDF4 import Dataset, chartostring
+
+# wrfout_d01_2020-09-05_21:00:00, or with underscores once rename.py has run
+_WRFOUT_RE = re.compile(r"^wrfout_d(\d+)_(\d{4}-\d{2}-\d{2})_(\d{2})[_:](\d{2})[_:](\d{2})")
+
+
+def wrfout_time(name):
+    m = _WRFOUT_RE.match(Path(name).name)
+    if m is None:
+        raise ValueError("not a wrfout file name: {}".format(name))
+    return datetime.strptime("{} {}:{}:{}".format(*m.groups()[1:]), "%Y-%m-%d %H:%M:%S")
+
+
+def format_wrf_time(t):
+    # As in Times and the file names; strftime doesn't zero pad years before
+    # 1000, and ideal runs start in year 1
+    return "{:04d}-{:02d}-{:02d}_{:02d}:{:02d}:{:02d}".format(t.year, t.month, t.day, t.hour, t.minute, t.second)
+
+
+def list_wrfout(ncdir):
+    ncdir = Path(ncdir)
+    files = [f for f in os.listdir(ncdir) if _WRFOUT_RE.match(f)]
+    files.sort(key=lambda f: (wrfout_time(f), f))
+    return [ncdir/f for f in files]
+
+
+class NcFile:
+    # Opens the file on first use and only reads the hyperslabs asked for
+    def __init__(self, path):
+        self.path = Path(path)
+        self._nc = None
+
+    @property
+    def nc(self):
+        if self._nc is None:
+            self._nc = Dataset(self.path)
+        return self._nc
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._nc is not None:
+            self._nc.close()
+            self._nc = None
+
+    @property
+    def dims(self):
+        return {name: len(dim) for name, dim in self.nc.dimensions.items()}
+
+    def shape(self, name):
+        return self.nc[name].shape
+
+    def read(self, name, *index):
+        return self.nc[name][index]
+
+
+class WrfoutFile(NcFile):
+    # read() indexes (bottom_top, south_north, west_east) of one time; the
+    # Time dimension is filled in from timeidx
+    def __init__(self, path, timeidx=0):
+        super().__init__(path)
+        self.timeidx = timeidx
+
+    @property
+    def nx(self):
+        return len(self.nc.dimensions["west_east"])
+
+    @property
+    def ny(self):
+        return len(self.nc.dimensions["south_north"])
+
+    @property
+    def nz(self):
+        return len(self.nc.dimensions["bottom_top"])
+
+    @property
+    def dx(self):
+        return float(self.nc.DX)
+
+    @property
+    def dy(self):
+        return float(self.nc.DY)
+
+    @property
+    def refinement(self):
+        # Fire grid refinement (sr_x, sr_y): the subgrid holds sr points per staggered atmospheric point
+        dims = self.nc.dimensions
+        return (len(dims["west_east_subgrid"]) // len(dims["west_east_stag"]),
+                len(dims["south_north_subgrid"]) // len(dims["south_north_stag"]))
+
+    def fire_area(self):
+        # FIRE_AREA on the fire subgrid, without the padding past the last
+        # staggered point
+        sr_x, sr_y = self.refinement
+        return self.read("FIRE_AREA", slice(0, sr_y*self.ny), slice(0, sr_x*self.nx))
+
+    @property
+    def times(self):
+        return [datetime.strptime(t, "%Y-%m-%d_%H:%M:%S") for t in chartostring(self.nc["Times"][:])]
+
+    @property
+    def time(self):
+        return self.times[self.timeidx]
+
+    def read(self, name, *index):
+        var = self.nc[name]
+        if var.dimensions[0] == "Time":
+            index = (self.timeidx,) + index
+        return var[index]
+
+    def levels(self, name, levels, *index):
+        # Stack single-level reads, so scattered levels never pull in the ones between them
+        return np.ma.stack([self.read(name, k, *index) for k in levels])
+
+    def level(self, name, k, *index):
+        return self.read(name, k, *index)
+
+    def jslice(self, name, j, *index):
+        return self.read(name, slice(None), j, *index)
+
+    def box(self, name, bounds, levels=slice(None)):
+        # bounds (x1, x2, y1, y2) on the mass grid; staggered dims get the extra point
+        x1, x2, y1, y2 = bounds
+        dims = self.nc[name].dimensions
+        xs = slice(x1, x2+1) if dims[-1].endswith("_stag") else slice(x1, x2)
+        ys = slice(y1, y2+1) if dims[-2].endswith("_stag") else slice(y1, y2)
+        if len(dims) - (dims[0] == "Time") == 2:
+            return self.read(name, ys, xs)
+        return self.read(name, levels, ys, xs)
+
+    def height_agl(self, *index):
+        # Same as getvar(nc, 'height_agl', units='m'), but only for the
+        # requested (south_north, west_east) hyperslab
+        index = index + (slice(None),)*(2 - len(index))
+        geopt = self.read("PH", slice(None), *index) + self.read("PHB", slice(None), *index)
+        z = 0.5*(geopt[:-1] + geopt[1:])/9.81
+        return np.ma.getdata(z - self.read("HGT", *index))
+
+
+class WrfoutCase:
+    # All frames of a case's nc/ directory as one time axis. Only the Times
+    # variable of each file is read up front; frames are opened on demand.
+    def __init__(self, ncdir, _index=None):
+        self.ncdir = Path(ncdir)
+        if _index is None:
+            _index = []
+            for path in list_wrfout(self.ncdir):
+                with WrfoutFile(path) as wf:
+                    _index += [(t, path, i) for i, t in enumerate(wf.times)]
+            _index.sort(key=lambda e: e[0])
+        self._index = _index
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def times(self):
+        return [t for t, _, _ in self._index]
+
+    @property
+    def files(self):
+        return list(dict.fromkeys(path for _, path, _ in self._index))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return WrfoutCase(self.ncdir, self._index[key])
+        _, path, timeidx = self._index[key]
+        return WrfoutFile(path, timeidx)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def sel(self, start=None, end=None):
+        # Frames with start <= time <= end
+        return WrfoutCase(self.ncdir, [e for e in self._index
+                                       if (start is None or e[0] >= start) and (end is None or e[0] <= end)])
+
+    def stream(self, load, prefetch=1):
+        # Yields (time, load(frame)) in time order. load runs on a background
+        # thread up to `prefetch` frames ahead, so the next files are read while
+        # the caller works on the current one; at most prefetch+1 results are
+        # held at once. Do all netCDF reading inside load, since the library is
+        # not safe to call from two threads at the same time.
+        def _load(i):
+            with self[i] as wf:
+                return load(wf)
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = deque()
+            for i in range(len(self)):
+                pending.append((self._index[i][0], pool.submit(_load, i)))
+                if len(pending) > prefetch:
+                    t, future = pending.popleft()
+                    yield t, future.result()
+            while pending:
+                t, future = pending.popleft()
+                yield t, future.result()